@@ -0,0 +1,288 @@
+"""
+Micro-benchmarks for tdefer.py.
+
+Run all the benchmarks with
+
+    $ python bench.py
+
+or just some of them by giving their names as arguments.  Each benchmark
+prints one line per measurement.
+"""
+
+import Queue
+import multiprocessing
+import random
+import sys
+import time
+
+import tdefer as defer
+
+
+def report(name, count, elapsed):
+    print '%-50s %10d ops %10.3f us/op' % (name, count, elapsed / count * 1e6)
+
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+
+def benchAsyncio(n=100000):
+    """
+    Compare the cost of getting a result from a Deferred into a waiting
+    inlineCallbacks generator with the cost of bridging it to an asyncio
+    Future and back again.
+    """
+    if defer.asyncio is None:
+        print 'asyncio: skipped, neither asyncio nor trollius is available'
+        return
+    asyncio = defer.asyncio
+
+    def inline():
+        def wait(d):
+            result = yield d
+            defer.returnValue(result)
+        wait = defer.inlineCallbacks(wait)
+        for i in xrange(n):
+            d = defer.Deferred()
+            wait(d)
+            d.callback(i)
+    report('inlineCallbacks round trip', n, timed(inline))
+
+    loop = asyncio.new_event_loop()
+
+    def runLoopOnce():
+        loop.call_soon(loop.stop)
+        loop.run_forever()
+
+    def toFutureAndBack():
+        results = []
+        for i in xrange(n):
+            d = defer.Deferred()
+            defer.Deferred.fromFuture(d.asFuture(loop)).addCallback(
+                results.append)
+            d.callback(i)
+        runLoopOnce()
+        assert len(results) == n
+    report('Deferred -> Future -> Deferred round trip', n,
+           timed(toFutureAndBack))
+
+    def cancelThroughFuture():
+        for i in xrange(n):
+            d = defer.Deferred()
+            d.addErrback(lambda f: None)
+            d.asFuture(loop).cancel()
+        runLoopOnce()
+    report('Future.cancel() reaching the Deferred', n,
+           timed(cancelThroughFuture))
+    loop.close()
+
+
+class Pump(object):
+    """
+    A stand-in for the reactor's callFromThread, so pools can be measured
+    without running the reactor.
+    """
+
+    def __init__(self):
+        self.calls = Queue.Queue()
+
+    def callFromThread(self, f, *args):
+        self.calls.put((f, args))
+
+    def until(self, d):
+        while not d.called:
+            f, args = self.calls.get()
+            f(*args)
+
+
+def burn(n):
+    total = 0
+    for i in xrange(n):
+        total += i * i
+    return total
+
+
+def benchProcessPool(tasks=400, work=50000):
+    """
+    Measure how DeferredProcessPool.map scales with the number of worker
+    processes, for many small CPU-bound tasks.
+    """
+    cpus = multiprocessing.cpu_count()
+    counts = sorted(set([1, 2, 4, 8, cpus]))
+    baseline = None
+    for processes in counts:
+        if processes > cpus:
+            break
+        pump = Pump()
+        pool = defer.DeferredProcessPool(processes, reactor=pump)
+        pool.start()
+        start = time.time()
+        pump.until(pool.map(burn, [work] * tasks))
+        elapsed = time.time() - start
+        pool.stop()
+        if baseline is None:
+            baseline = elapsed
+        report('process pool map, %d processes (%.2fx)' % (
+                processes, baseline / elapsed), tasks, elapsed)
+
+
+def deferredsCreated(f, *args):
+    """
+    Call C{f(*args)} and return how many Deferreds were created meanwhile.
+    """
+    created = [0]
+
+    def counting(init):
+        def __init__(self, *args, **kw):
+            created[0] += 1
+            init(self, *args, **kw)
+        return __init__
+
+    classes = [defer.Deferred, defer._FiredDeferred]
+    inits = [cls.__dict__['__init__'] for cls in classes]
+    for cls, init in zip(classes, inits):
+        cls.__init__ = counting(init)
+    try:
+        f(*args)
+    finally:
+        for cls, init in zip(classes, inits):
+            cls.__init__ = init
+    return created[0]
+
+
+def benchLockRun(n=200000):
+    """
+    Measure DeferredLock.run and DeferredSemaphore.run when the lock or
+    semaphore is free, and when calls have to wait for it.
+    """
+    def synchronous(primitive):
+        for i in xrange(n):
+            primitive.run(defer.passthru, i)
+
+    def fired(primitive):
+        for i in xrange(n):
+            primitive.run(defer.succeed, i)
+
+    def pending(primitive):
+        for i in xrange(n):
+            d = defer.Deferred()
+            primitive.run(lambda: d)
+            d.callback(i)
+
+    def contended(primitive):
+        # Each release runs the next waiter, which releases in turn, so
+        # keep the queues short enough not to reach the recursion limit.
+        for batch in xrange(0, n, 20):
+            primitive.acquire()
+            for i in xrange(20):
+                primitive.run(defer.passthru, i)
+            primitive.release()
+
+    for name, primitive in [('lock', defer.DeferredLock),
+                            ('semaphore', lambda: defer.DeferredSemaphore(1))]:
+        for case in synchronous, fired, pending, contended:
+            label = '%s run, %s' % (name, case.__name__)
+            report(label, n, timed(case, primitive()))
+            print '%-50s %10.1f Deferreds/op' % (
+                '', deferredsCreated(case, primitive()) / float(n))
+
+
+def benchRWLock(n=100000, clients=50, hold=0.01):
+    """
+    Compare DeferredRWLock with DeferredLock for read-heavy workloads, with
+    clients holding the lock for C{hold} seconds of VirtualClock time per
+    operation.
+    """
+    for writes in 0.01, 0.05, 0.2:
+        lock = defer.DeferredLock()
+        rwlock = defer.DeferredRWLock()
+        preferring = defer.DeferredRWLock(writerPreference=True)
+        for name, runRead, runWrite in [
+            ('DeferredLock', lock.run, lock.run),
+            ('DeferredRWLock', rwlock.runRead, rwlock.runWrite),
+            ('DeferredRWLock(writerPreference=True)',
+             preferring.runRead, preferring.runWrite)]:
+            clock = defer.VirtualClock()
+            choose = random.Random(0).random
+            remaining = [n]
+
+            def operate():
+                d = defer.Deferred()
+                clock.callLater(hold, d.callback, None)
+                return d
+
+            def client(ignored=None):
+                if remaining[0]:
+                    remaining[0] -= 1
+                    if choose() < writes:
+                        d = runWrite(operate)
+                    else:
+                        d = runRead(operate)
+                    d.addCallback(client)
+
+            def run():
+                for i in xrange(clients):
+                    client()
+                return clock.run()
+
+            start = time.time()
+            elapsed = run()
+            report('%s, %d%% writes' % (name, writes * 100), n,
+                   time.time() - start)
+            print '%-50s %10.1f ops per virtual second' % (
+                '', n / elapsed)
+
+
+def benchCooperative(n=100000, work=200):
+    """
+    Compare the longest time the reactor is kept busy by firing a Deferred
+    with C{n} chained Deferreds, each with a callback doing C{work} units
+    of work, with and without a CooperativeRunner.
+    """
+    def fanOut():
+        root = defer.Deferred()
+        for i in xrange(n):
+            d = defer.Deferred()
+            d.addCallback(lambda result: burn(work))
+            root.chainDeferred(d)
+        return root
+
+    root = fanOut()
+    stall = timed(root.callback, None)
+    report('fan-out, callbacks run at once (%.1f ms stall)' % (
+            stall * 1e3,), n, stall)
+
+    clock = defer.VirtualClock()
+    for timeSlice in 0.001, 0.01:
+        runner = defer.CooperativeRunner(timeSlice, scheduler=clock)
+        root = fanOut()
+        defer.setCooperative(runner)
+        try:
+            start = time.time()
+            root.callback(None)
+            clock.run()
+            elapsed = time.time() - start
+        finally:
+            defer.setCooperative(None)
+        stats = runner.stats()
+        report('fan-out, %.0f ms slices (%.1f ms max, %d slices)' % (
+                timeSlice * 1e3, stats['maxSlice'] * 1e3, stats['slices']),
+               n, elapsed)
+
+
+benchmarks = [
+    ('asyncio', benchAsyncio),
+    ('processpool', benchProcessPool),
+    ('lockrun', benchLockRun),
+    ('rwlock', benchRWLock),
+    ('cooperative', benchCooperative),
+    ]
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for name, bench in benchmarks:
+        if not names or name in names:
+            bench()
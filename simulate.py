@@ -0,0 +1,220 @@
+"""
+Load simulations for the concurrency primitives in tdefer.py.
+
+Each simulation runs a number of clients written with inlineCallbacks
+against a tdefer.VirtualClock, so no real time passes and a run with a
+given seed always gives the same results.  Service and think times are
+drawn from exponential distributions.  For each simulation the throughput,
+the distribution of the time spent waiting and Jain's fairness index of
+the work done per client are printed.
+
+Run all the simulations with
+
+    $ python simulate.py
+
+or just some of them by giving their names as arguments, e.g.
+
+    $ python simulate.py semaphore --clients 200 --workers 16 --ops 1000000
+"""
+
+import optparse
+import random
+import time
+
+import tdefer as defer
+
+
+def sleep(clock, seconds):
+    """
+    Return a Deferred which fires after C{seconds} of C{clock} time.
+    """
+    d = defer.Deferred(lambda d: call.cancel())
+    call = clock.callLater(seconds, d.callback, None)
+    return d
+
+
+def percentile(values, p):
+    """
+    Return the C{p}th percentile of a sorted list.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def jain(values):
+    """
+    Return Jain's fairness index of C{values}: 1 when they are all equal,
+    down to 1 / len(values) when one has everything.
+    """
+    total = float(sum(values))
+    squares = sum([v * v for v in values])
+    if not squares:
+        return 1.0
+    return total * total / (len(values) * squares)
+
+
+class Simulation(object):
+    """
+    The clock, random numbers and measurements of one simulation.
+
+    @ivar remaining: How many more operations may be started.
+    @ivar waits: How long each operation waited, in virtual seconds.
+    @ivar completed: How many operations each client completed.
+    @ivar timedOut: How many operations gave up waiting.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.clock = defer.VirtualClock()
+        self.random = random.Random(options.seed)
+        self.remaining = options.ops
+        self.waits = []
+        self.completed = [0] * options.clients
+        self.timedOut = 0
+
+    def claim(self):
+        """
+        Return whether another operation may be started, and count it.
+        """
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+    def service(self):
+        return self.random.expovariate(1.0 / self.options.service)
+
+    def think(self):
+        return self.random.expovariate(1.0 / self.options.think)
+
+    def run(self, name, clients):
+        """
+        Start C{clients}, run the clock until nothing is left to do and
+        report on what happened.
+        """
+        start = time.time()
+        for client in clients:
+            client()
+        elapsed = self.clock.run()
+        wall = time.time() - start
+        waits = sorted(self.waits)
+        done = sum(self.completed)
+        print '%s: %d ops in %.1f virtual s (%.1f ops/s), %.2f s wall, ' \
+            '%d timer calls' % (name, done, elapsed, done / (elapsed or 1),
+                                wall, self.clock.calls)
+        print '  wait p50 %.4f p90 %.4f p99 %.4f max %.4f, ' \
+            'fairness %.4f, timed out %d' % (
+            percentile(waits, 50), percentile(waits, 90),
+            percentile(waits, 99), percentile(waits, 100),
+            jain(self.completed), self.timedOut)
+
+
+def acquireLoop(sim, primitive, index, patience=None, wheel=None):
+    """
+    Return a client which repeatedly acquires C{primitive}, holds it for a
+    service time, releases it and thinks.  With C{patience}, the client
+    gives up waiting after that many seconds.
+    """
+    clock = sim.clock
+
+    def client():
+        while sim.claim():
+            start = clock.seconds()
+            d = primitive.acquire()
+            if patience is not None:
+                d.addTimeout(patience, wheel)
+            try:
+                yield d
+            except defer.TimeoutError:
+                sim.timedOut += 1
+            else:
+                sim.waits.append(clock.seconds() - start)
+                yield sleep(clock, sim.service())
+                primitive.release()
+                sim.completed[index] += 1
+            yield sleep(clock, sim.think())
+    return defer.inlineCallbacks(client)
+
+
+def simulateLock(options):
+    sim = Simulation(options)
+    lock = defer.DeferredLock()
+    sim.run('lock', [acquireLoop(sim, lock, i)
+                     for i in xrange(options.clients)])
+
+
+def simulateSemaphore(options):
+    sim = Simulation(options)
+    semaphore = defer.DeferredSemaphore(options.workers)
+    sim.run('semaphore', [acquireLoop(sim, semaphore, i)
+                          for i in xrange(options.clients)])
+
+
+def simulateTimeouts(options):
+    sim = Simulation(options)
+    semaphore = defer.DeferredSemaphore(options.workers)
+    wheel = defer.TimerWheel(sim.clock, resolution=options.service / 10)
+    sim.run('timeouts', [acquireLoop(sim, semaphore, i, options.patience,
+                                     wheel)
+                         for i in xrange(options.clients)])
+
+
+def simulateQueue(options):
+    """
+    Clients between them put work on a queue once per think time, on
+    average; workers take it off and serve it.  The wait is how long work
+    spent on the queue, and fairness is between the workers.
+    """
+    options.clients, clients = options.workers, options.clients
+    sim = Simulation(options)
+    clock = sim.clock
+    queue = defer.DeferredQueue()
+
+    def producer():
+        while sim.claim():
+            queue.put(clock.seconds())
+            yield sleep(clock, sim.think() * clients)
+
+    def consumer(index):
+        while True:
+            queued = yield queue.get()
+            sim.waits.append(clock.seconds() - queued)
+            yield sleep(clock, sim.service())
+            sim.completed[index] += 1
+
+    producer = defer.inlineCallbacks(producer)
+    consumer = defer.inlineCallbacks(consumer)
+    sim.run('queue',
+            [producer] * clients +
+            [lambda i=i: consumer(i) for i in xrange(options.workers)])
+
+
+simulations = [
+    ('lock', simulateLock),
+    ('semaphore', simulateSemaphore),
+    ('timeouts', simulateTimeouts),
+    ('queue', simulateQueue),
+    ]
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] [simulation ...]')
+    parser.add_option('--clients', type='int', default=100,
+                      help='number of clients')
+    parser.add_option('--workers', type='int', default=8,
+                      help='semaphore tokens, or queue consumers')
+    parser.add_option('--ops', type='int', default=100000,
+                      help='number of operations to simulate')
+    parser.add_option('--service', type='float', default=0.01,
+                      help='mean service time, in seconds')
+    parser.add_option('--think', type='float', default=0.1,
+                      help='mean think time between operations, in seconds')
+    parser.add_option('--patience', type='float', default=0.02,
+                      help='how long clients wait in the timeouts simulation')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed')
+    options, names = parser.parse_args()
+    for name, simulate in simulations:
+        if not names or name in names:
+            simulate(optparse.Values(options.__dict__))
@@ -0,0 +1,333 @@
+"""
+Scaling checks for tdefer.py.
+
+Each workload is run at sizes growing by powers of ten, and its time and
+peak memory are measured.  A growth exponent is fitted to each: 1 means
+the workload scales linearly, 2 quadratically.  A workload fails if
+either exponent is more than the tolerance above what it should be, and
+the script then exits with status 1, so it can be run to catch
+regressions:
+
+    $ python stress.py
+    $ python stress.py --max 100000 deferredlist callbacks
+
+Peak memory is measured with tracemalloc where it is available.
+Elsewhere the number of objects left alive by the workload is counted
+instead.  The garbage collector is disabled while a workload is timed.
+"""
+
+import gc
+import math
+import optparse
+import random
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import tdefer as defer
+
+
+def ignore(result):
+    return None
+
+
+def chainDepth(n):
+    """
+    Fire the first of n Deferreds, each chained to the one after it.
+    """
+    ds = [defer.Deferred() for i in xrange(n)]
+    for parent, child in zip(ds[1:], ds):
+        parent.chainDeferred(child)
+    ds[-1].callback(None)
+    return ds
+
+
+def nestedLoop(n):
+    """
+    Run a loop of n iterations, each of which returns the Deferred for the
+    next from a callback, and fire them in turn.
+    """
+    pending = []
+
+    def iterate(i):
+        d = defer.Deferred()
+        pending.append(d)
+        if i:
+            d.addCallback(lambda ignored: iterate(i - 1))
+        return d
+
+    d = iterate(n)
+    while pending:
+        pending.pop().callback(None)
+    return d
+
+
+def chainBreadth(n):
+    """
+    Fire a Deferred with n Deferreds chained to it.
+    """
+    d = defer.Deferred()
+    ds = [defer.Deferred() for i in xrange(n)]
+    for child in ds:
+        d.chainDeferred(child)
+    d.callback(None)
+    return d, ds
+
+
+def deferredList(n):
+    """
+    Fire each of n Deferreds in a DeferredList.
+    """
+    ds = [defer.Deferred() for i in xrange(n)]
+    dl = defer.DeferredList(ds)
+    for d in ds:
+        d.callback(None)
+    return dl
+
+
+def callbacks(n):
+    """
+    Fire a Deferred with n callbacks.
+    """
+    d = defer.Deferred()
+    for i in xrange(n):
+        d.addCallback(defer.passthru)
+    d.callback(None)
+    return d
+
+
+def semaphoreWaiters(n):
+    """
+    Queue n waiters on a semaphore, then let each of them through.
+    """
+    semaphore = defer.DeferredSemaphore(1)
+    semaphore.acquire()
+    ds = [semaphore.acquire() for i in xrange(n)]
+    for i in xrange(n):
+        semaphore.release()
+    return semaphore, ds
+
+
+def queueWaiters(n):
+    """
+    Queue n gets on a DeferredQueue, then put n objects.
+    """
+    queue = defer.DeferredQueue()
+    ds = [queue.get() for i in xrange(n)]
+    for i in xrange(n):
+        queue.put(i)
+    return queue, ds
+
+
+def cancelWaiters(n, order=list):
+    """
+    Queue n waiters on a lock, then cancel them in the order they came, or
+    in the order C{order} puts them in.
+    """
+    lock = defer.DeferredLock()
+    lock.acquire()
+    ds = [lock.acquire().addErrback(ignore) for i in xrange(n)]
+    for d in order(ds):
+        d.cancel()
+    return lock, ds
+
+
+def shuffled(ds):
+    ds = list(ds)
+    random.Random(0).shuffle(ds)
+    return ds
+
+
+def cancelWaitersReversed(n):
+    """
+    Queue n waiters on a lock, then cancel them newest first.
+    """
+    return cancelWaiters(n, reversed)
+
+
+def cancelWaitersRandomly(n):
+    """
+    Queue n waiters on a lock, then cancel them in random order.
+    """
+    return cancelWaiters(n, shuffled)
+
+
+def cancelGets(n):
+    """
+    Queue n gets on a DeferredQueue, cancel them in random order, then put
+    an object, which must get past all the cancelled gets.
+    """
+    queue = defer.DeferredQueue()
+    ds = [queue.get().addErrback(ignore) for i in xrange(n)]
+    for d in shuffled(ds):
+        d.cancel()
+    queue.put(None)
+    return queue, ds
+
+
+def cancelChained(n):
+    """
+    Cancel a Deferred with n Deferreds chained to it.
+    """
+    d = defer.Deferred()
+    ds = [defer.Deferred() for i in xrange(n)]
+    for child in ds:
+        child.addErrback(ignore)
+        d.chainDeferred(child)
+    d.addErrback(ignore)
+    d.cancel()
+    return d, ds
+
+
+def cancelScope(n):
+    """
+    Cancel n Deferreds with one CancelScope.
+    """
+    scope = defer.CancelScope()
+    scope.__enter__()
+    try:
+        ds = [defer.Deferred().addErrback(ignore) for i in xrange(n)]
+    finally:
+        scope.__exit__(None, None, None)
+    scope.cancel()
+    return ds
+
+
+# chainDeferred recurses once per level of depth, so chains deeper than
+# the recursion limit allows are not measured.
+maxDepth = sys.getrecursionlimit() // 4
+
+# Names, functions, the exponent their time and memory should grow with,
+# and the largest size each can be run at, or None for no limit.
+workloads = [
+    ('depth', chainDepth, 1, maxDepth),
+    ('nested', nestedLoop, 1, None),
+    ('breadth', chainBreadth, 1, None),
+    ('deferredlist', deferredList, 1, None),
+    ('callbacks', callbacks, 1, None),
+    ('semaphore', semaphoreWaiters, 1, None),
+    ('queue', queueWaiters, 1, None),
+    ('cancelwaiters', cancelWaiters, 1, None),
+    ('cancelreversed', cancelWaitersReversed, 1, None),
+    ('cancelrandom', cancelWaitersRandomly, 1, None),
+    ('cancelgets', cancelGets, 1, None),
+    ('cancelchained', cancelChained, 1, None),
+    ('cancelscope', cancelScope, 1, None),
+    ]
+
+
+def timeOf(f, n, minimum=0.05):
+    """
+    Return how long C{f(n)} takes, repeating it until at least C{minimum}
+    seconds have passed so that small sizes can be measured.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        runs = 0
+        start = time.time()
+        while True:
+            f(n)
+            runs += 1
+            elapsed = time.time() - start
+            if elapsed >= minimum:
+                return elapsed / runs
+    finally:
+        gc.enable()
+
+
+def memoryOf(f, n):
+    """
+    Return the peak number of bytes allocated by C{f(n)}, or without
+    tracemalloc the number of objects it left alive.
+    """
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            f(n)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    before = len(gc.get_objects())
+    kept = f(n)
+    after = len(gc.get_objects())
+    del kept
+    return after - before
+
+
+def exponent(points):
+    """
+    Fit C{y = a * x ** k} to C{(x, y)} points by least squares on their
+    logarithms, and return C{k}.
+    """
+    points = [(math.log(x), math.log(y)) for (x, y) in points if y > 0]
+    if len(points) < 2:
+        return 0.0
+    meanX = sum([x for (x, y) in points]) / len(points)
+    meanY = sum([y for (x, y) in points]) / len(points)
+    covariance = sum([(x - meanX) * (y - meanY) for (x, y) in points])
+    variance = sum([(x - meanX) ** 2 for (x, y) in points])
+    return covariance / variance
+
+
+def sizes(smallest, largest):
+    n = smallest
+    while n <= largest:
+        yield n
+        if n * 3 <= largest:
+            yield n * 3
+        n *= 10
+
+
+def check(name, f, expected, largest, options):
+    """
+    Measure a workload, print its measurements and return whether its
+    growth is within the tolerance.
+    """
+    fitFrom = min(options.fitFrom, largest // 10)
+    times = []
+    memory = []
+    for n in sizes(10, largest):
+        t = timeOf(f, n)
+        m = memoryOf(f, n)
+        print '  %-14s %8d %12.6f s %12d %s' % (
+            name, n, t, m, tracemalloc and 'bytes' or 'objects')
+        sys.stdout.flush()
+        if n >= fitFrom:
+            times.append((n, t))
+            memory.append((n, m))
+    if len(times) < 2:
+        print '%-16s skipped: too few sizes above %d' % (name, fitFrom)
+        return True
+    timeExponent = exponent(times)
+    memoryExponent = exponent(memory)
+    ok = max(timeExponent, memoryExponent) <= expected + options.tolerance
+    print '%-16s time ~ n^%.2f, memory ~ n^%.2f, expected n^%d: %s' % (
+        name, timeExponent, memoryExponent, expected, ok and 'ok' or 'FAIL')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] [workload ...]')
+    parser.add_option('--max', type='int', default=10 ** 6,
+                      help='largest size to run workloads at')
+    parser.add_option('--fit-from', dest='fitFrom', type='int', default=1000,
+                      help='smallest size to fit growth exponents from')
+    parser.add_option('--tolerance', type='float', default=0.3,
+                      help='how far exponents may exceed what is expected')
+    options, names = parser.parse_args()
+    failed = []
+    for name, f, expected, largest in workloads:
+        if not names or name in names:
+            if largest is None or largest > options.max:
+                largest = options.max
+            if not check(name, f, expected, largest, options):
+                failed.append(name)
+    if failed:
+        print 'Failed: %s' % (', '.join(failed),)
+        sys.exit(1)
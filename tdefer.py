@@ -8,14 +8,37 @@ Support for results that aren't immediately available.
 Maintainer: Glyph Lefkowitz
 """
 
+import collections
+import heapq
+import json
+import math
+import random
+import sys
+import threading
+import time
 import traceback
+import types
 import warnings
+import weakref
 from sys import exc_info
 
 # Twisted imports
-from twisted.python import log, failure, lockfile
+from twisted.python import log, failure, lockfile, reflect
 from twisted.python.util import unsignedID, mergeFunctionMetadata
 
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 
 
 class AlreadyCalledError(Exception):
@@ -30,8 +53,9 @@ class CancelledError(Exception):
 
 class TimeoutError(Exception):
     """
-    This exception is deprecated.  It is used only by the deprecated
-    L{Deferred.setTimeout} method.
+    This error is raised when a L{Deferred} is cancelled because the timeout
+    given to L{Deferred.addTimeout} has passed.  It is also used by the
+    deprecated L{Deferred.setTimeout} method.
     """
 
 
@@ -59,9 +83,11 @@ def succeed(result):
 
     @rtype: L{Deferred}
     """
-    d = Deferred()
-    d.callback(result)
-    return d
+    if Deferred.debug:
+        d = Deferred()
+        d.callback(result)
+        return d
+    return _FiredDeferred(result)
 
 
 
@@ -78,9 +104,13 @@ def fail(result=None):
 
     @rtype: L{Deferred}
     """
-    d = Deferred()
-    d.errback(result)
-    return d
+    if Deferred.debug:
+        d = Deferred()
+        d.errback(result)
+        return d
+    if not isinstance(result, failure.Failure):
+        result = Deferred._failureType(result)
+    return _FiredDeferred(result)
 
 
 
@@ -124,7 +154,7 @@ def maybeDeferred(f, *args, **kw):
     try:
         result = f(*args, **kw)
     except:
-        return fail(failure.Failure())
+        return fail(Deferred._failureType())
 
     if isinstance(result, Deferred):
         return result
@@ -164,6 +194,109 @@ def getDebugging():
 
 
 
+def setProfiler(profiler):
+    """
+    Install a L{CallbackProfiler} to time every callback and errback run by
+    L{Deferred}s, or remove the current one.
+
+    @param profiler: A L{CallbackProfiler}, or C{None} to turn profiling off.
+    """
+    Deferred._profiler = profiler
+
+
+
+def getProfiler():
+    """
+    Return the L{CallbackProfiler} installed by L{setProfiler}, or C{None}.
+    """
+    return Deferred._profiler
+
+
+
+def setPendingRegistry(registry):
+    """
+    Install a L{PendingDeferredRegistry} to keep track of L{Deferred}s which
+    have not been fired yet, or remove the current one.
+
+    @param registry: A L{PendingDeferredRegistry}, or C{None}.
+    """
+    Deferred._registry = registry
+
+
+
+def getPendingRegistry():
+    """
+    Return the L{PendingDeferredRegistry} installed by L{setPendingRegistry},
+    or C{None}.
+    """
+    return Deferred._registry
+
+
+
+def setTracer(tracer):
+    """
+    Install a L{CausalTracer} to record how L{Deferred}s fire each other, or
+    remove the current one.
+
+    @param tracer: A L{CausalTracer}, or C{None} to turn tracing off.
+    """
+    Deferred._tracer = tracer
+
+
+
+def getTracer():
+    """
+    Return the L{CausalTracer} installed by L{setTracer}, or C{None}.
+    """
+    return Deferred._tracer
+
+
+
+def setCooperative(runner):
+    """
+    Install a L{CooperativeRunner} to run the callbacks of L{Deferred}s in
+    bounded time slices, or remove the current one.
+
+    @param runner: A L{CooperativeRunner}, or C{None} to run callbacks as
+        soon as L{Deferred}s fire again.
+    """
+    Deferred._cooperative = runner
+
+
+
+def getCooperative():
+    """
+    Return the L{CooperativeRunner} installed by L{setCooperative}, or
+    C{None}.
+    """
+    return Deferred._cooperative
+
+
+
+def setLightweightFailures(on):
+    """
+    Enable or disable the use of L{LightweightFailure} for the exceptions
+    caught by L{Deferred}s.
+
+    L{Deferred}s then only keep the exception and traceback of errors raised
+    by callbacks, or passed to C{errback}, rather than copying the local and
+    global variables of every frame.
+    """
+    if on:
+        Deferred._failureType = LightweightFailure
+    else:
+        Deferred._failureType = failure.Failure
+
+
+
+def getLightweightFailures():
+    """
+    Determine whether L{LightweightFailure}s are enabled.
+    """
+    return Deferred._failureType is LightweightFailure
+
+
+
 class Deferred:
     """
     This is a callback which will be put off until later.
@@ -205,7 +338,29 @@ class Deferred:
 
     # Will be set to 1 if we are ever chained to another callback.
     chained = 0
-    
+
+    # The CallbackProfiler installed by setProfiler, if any.
+    _profiler = None
+
+    # The PendingDeferredRegistry installed by setPendingRegistry, if any.
+    _registry = None
+
+    # The Failure class used for exceptions we catch; see
+    # setLightweightFailures.
+    _failureType = failure.Failure
+
+    # The CausalTracer installed by setTracer, if any.
+    _tracer = None
+
+    # The Deferred we handed our only waiter over to, if _runCallbacks
+    # collapsed a chain of Deferreds through us; see _relink.
+    _collapsedInto = None
+
+    # The CooperativeRunner installed by setCooperative, if any, and whether
+    # we are waiting in its queue.
+    _cooperative = None
+    _queued = False
+
     def __init__(self, canceller=None):
         """
         Initialize a L{Deferred}.
@@ -235,6 +390,12 @@ class Deferred:
         if self.debug:
             self._debugInfo = DebugInfo()
             self._debugInfo.creator = traceback.format_stack()[:-1]
+        if self._registry is not None:
+            self._registry.track(self)
+        if self._tracer is not None:
+            self._tracer.created(self)
+        if _scopes:
+            _scopes[-1].add(self)
 
 
     def addCallbacks(self, callback, errback=None,
@@ -252,6 +413,45 @@ class Deferred:
                (errback or (passthru), errbackArgs, errbackKeywords))
         self.callbacks.append(cbs)
 
+        if self._collapsedInto is not None:
+            self._relink()
+        if self.called:
+            self._runCallbacks()
+        return self
+
+
+    def extendCallbacks(self, stages):
+        """
+        Add several pairs of callbacks to this L{Deferred} in one go.
+
+        This is equivalent to calling L{addCallbacks} once for each stage,
+        in order, except that if this L{Deferred} has already been called
+        its callbacks are run once, after all the stages have been added.
+
+        @param stages: A sequence of C{(callback, errback, args, kw)}
+            tuples.  C{args} and C{kw} (either of which may be C{None}) are
+            passed to whichever of C{callback} and C{errback} is run.
+            Either function may be C{None}, in which case the result is
+            passed on unchanged.
+        """
+        assert not self.chained, "Can't add to an already chained deferred."
+        items = []
+        for callback, errback, args, kw in stages:
+            assert callback is None or callable(callback)
+            assert errback is None or callable(errback)
+            if callback is None:
+                callbackStage = (passthru, None, None)
+            else:
+                callbackStage = (callback, args, kw)
+            if errback is None:
+                errbackStage = (passthru, None, None)
+            else:
+                errbackStage = (errback, args, kw)
+            items.append((callbackStage, errbackStage))
+        self.callbacks.extend(items)
+
+        if self._collapsedInto is not None:
+            self._relink()
         if self.called:
             self._runCallbacks()
         return self
@@ -307,6 +507,8 @@ class Deferred:
         affected.
         """
         d.chained = 1
+        if self._registry is not None:
+            self._registry.chained(self, d)
         return self.addBoth(self._callChainedDeferred, d)
 
 
@@ -363,7 +565,7 @@ class Deferred:
             return
         assert not self.chained, "Can't errback an already chained deferred."
         if not isinstance(fail, failure.Failure):
-            fail = failure.Failure(fail)
+            fail = self._failureType(fail)
 
         self._startRunCallbacks(fail)
 
@@ -410,7 +612,7 @@ class Deferred:
             if not self.called:
                 # There was no canceller, or the canceller didn't call
                 # callback or errback.
-                self._startRunCallbacks(failure.Failure(CancelledError()))
+                self._startRunCallbacks(self._failureType(CancelledError()))
         elif isinstance(self.result, Deferred):
             # Waiting for another deferred -- cancel it instead.
             self.result.cancel()
@@ -418,9 +620,43 @@ class Deferred:
 
     def _continue(self, result):
         self.result = result
+        if self._tracer is not None:
+            self._tracer.resumed(self)
         self.unpause()
 
 
+    def _relink(self):
+        """
+        Wait again for the L{Deferred} a collapsed chain was handed over
+        to, now that callbacks have been added to this one.
+
+        Its result will have been passed on to the waiter we handed over,
+        which leaves it as C{None}, just as ours would have been had we
+        passed it on ourselves.
+        """
+        target = self._collapsedInto
+        self._collapsedInto = None
+        target.addBoth(self._continue)
+
+
+    def _soleWaiter(self):
+        """
+        Return the L{Deferred} waiting for this one, if resuming it is all
+        that is left for this one to do, or C{None}.
+        """
+        if len(self.callbacks) != 1:
+            return None
+        callback, errback = self.callbacks[0]
+        method = callback[0]
+        if (getattr(method, 'im_func', None) is not _continue or
+            errback[0] is not method or callback[1] or callback[2]):
+            return None
+        waiter = method.im_self
+        if waiter.result is not self:
+            return None
+        return waiter
+
+
     def _startRunCallbacks(self, result):
         if self.called:
             if self._suppressAlreadyCalled:
@@ -438,6 +674,10 @@ class Deferred:
             self._debugInfo.invoker = traceback.format_stack()[:-2]
         self.called = True
         self.result = result
+        if self._registry is not None:
+            self._registry.discard(self)
+        if self._tracer is not None:
+            self._tracer.fired(self)
         if self.timeoutCall:
             try:
                 self.timeoutCall.cancel()
@@ -452,9 +692,22 @@ class Deferred:
         if self._runningCallbacks:
             # Don't recursively run callbacks
             return
+        cooperative = self._cooperative
+        if cooperative is not None and cooperative._current is not self:
+            cooperative._schedule(self)
+            return
         if not self.paused:
-            while self.callbacks:
-                item = self.callbacks.pop(0)
+            tracer = self._tracer
+            if tracer is not None:
+                tracer.enter(self)
+            # Step through the callbacks rather than popping each one off
+            # the front of the list, which would take quadratic time, and
+            # trim the ones which have been run when stopping.
+            callbacks = self.callbacks
+            index = 0
+            while index < len(callbacks):
+                item = callbacks[index]
+                index += 1
                 callback, args, kw = item[
                     isinstance(self.result, failure.Failure)]
                 args = args or ()
@@ -462,10 +715,52 @@ class Deferred:
                 try:
                     self._runningCallbacks = True
                     try:
-                        self.result = callback(self.result, *args, **kw)
+                        if self._profiler is None:
+                            self.result = callback(self.result, *args, **kw)
+                        else:
+                            self.result = self._profiler.runCallback(
+                                callback, self.result, args, kw)
                     finally:
                         self._runningCallbacks = False
                     if isinstance(self.result, Deferred):
+                        inner = self.result
+                        if (inner.called and not inner.paused and
+                            not inner.callbacks and inner is not self and
+                            not inner._runningCallbacks and
+                            not inner._queued):
+                            # The inner Deferred has its result and nothing
+                            # left to do with it, so take the result
+                            # straight away instead of pausing.  Like a
+                            # Deferred which passes its result to a waiter,
+                            # it is left with None.
+                            self.result = inner.result
+                            inner.result = None
+                            if inner._debugInfo is not None:
+                                inner._debugInfo.failResult = None
+                            continue
+                        del callbacks[:index]
+                        index = 0
+                        waiter = self._soleWaiter()
+                        if waiter is not None:
+                            # All that is left for us to do is to pass the
+                            # inner result on to a Deferred waiting for us,
+                            # so have it wait for the inner Deferred
+                            # directly.  Otherwise a loop which returns a new
+                            # Deferred from a callback each time round would
+                            # build a chain of waiting Deferreds as long as
+                            # the number of iterations, and unwind it
+                            # recursively when the last one fires.  We stay
+                            # paused on the inner Deferred, so that
+                            # cancelling us still cancels it, and only wait
+                            # for it ourselves if callbacks are added to us.
+                            del callbacks[:]
+                            self.pause()
+                            self._collapsedInto = inner
+                            waiter.result = inner
+                            if tracer is not None:
+                                tracer.paused(waiter, inner)
+                            inner.addBoth(waiter._continue)
+                            break
                         # note: this will cause _runCallbacks to be called
                         # recursively if self.result already has a result.
                         # This shouldn't cause any problems, since there is no
@@ -475,10 +770,25 @@ class Deferred:
                         # where there is no more work to be done, so this call
                         # will return as well.
                         self.pause()
-                        self.result.addBoth(self._continue)
+                        if tracer is not None:
+                            tracer.paused(self, inner)
+                        inner.addBoth(self._continue)
                         break
                 except:
-                    self.result = failure.Failure()
+                    self.result = self._failureType()
+                if (cooperative is not None and index < len(callbacks) and
+                    cooperative._timer() >= cooperative._deadline):
+                    # The slice is over, so leave the rest of our callbacks
+                    # for the next one.
+                    del callbacks[:index]
+                    index = 0
+                    cooperative._resume(self)
+                    break
+            if index:
+                # A _FiredDeferred with no callbacks has a tuple here.
+                del callbacks[:index]
+            if tracer is not None:
+                tracer.leave(self)
 
         if isinstance(self.result, failure.Failure):
             self.result.cleanFailure()
@@ -490,6 +800,48 @@ class Deferred:
                 self._debugInfo.failResult = None
 
 
+    def addTimeout(self, timeout, wheel=None):
+        """
+        Cancel this L{Deferred} if it has not been called after C{timeout}
+        seconds.
+
+        Cancelling means that the canceller given to the constructor is
+        called, and that L{Deferred}s chained to this one with
+        L{chainDeferred} are cancelled too.  If the cancellation results
+        in a L{CancelledError}, it is replaced with a L{TimeoutError}.
+
+        The timeout is added to the callback chain, so it is stopped when
+        the result reaches that point.  Unlike L{setTimeout}, this does not
+        cost a reactor timer per L{Deferred}: all timeouts share one
+        L{TimerWheel}.
+
+        @param timeout: The number of seconds to wait.
+        @param wheel: The L{TimerWheel} to use, by default the one returned
+            by L{getTimerWheel}.
+
+        @return: C{self}.
+        """
+        if wheel is None:
+            wheel = getTimerWheel()
+        timedOut = []
+
+        def timeItOut():
+            timedOut.append(True)
+            self.cancel()
+
+        timer = wheel.callLater(timeout, timeItOut)
+
+        def cancelTimeout(result):
+            timer.cancel()
+            if (timedOut and isinstance(result, failure.Failure) and
+                result.check(CancelledError)):
+                return self._failureType(TimeoutError(
+                        "Deferred timed out after %s seconds" % (timeout,)))
+            return result
+
+        return self.addBoth(cancelTimeout)
+
+
     def setTimeout(self, seconds, timeoutFunc=timeout, *args, **kw):
         """
         Set a timeout function to be triggered if I am not called.
@@ -516,6 +868,69 @@ class Deferred:
             lambda: self.called or timeoutFunc(self, *args, **kw))
         return self.timeoutCall
 
+
+    def asFuture(self, loop=None):
+        """
+        Adapt this L{Deferred} into an asyncio C{Future}.
+
+        The C{Future} gets the result of this L{Deferred}, or the exception
+        of its L{failure.Failure}, at this point in the callback chain;
+        after that, the result of this L{Deferred} is C{None}.  Cancelling
+        the C{Future} cancels this L{Deferred}.
+
+        @param loop: The asyncio event loop the C{Future} belongs to, by
+            default the current one.
+
+        @rtype: C{asyncio.Future}
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        future = asyncio.Future(loop=loop)
+
+        def checkCancel(futureAgain):
+            if futureAgain.cancelled():
+                self.cancel()
+
+        def maybeFail(reason):
+            if not future.cancelled():
+                future.set_exception(reason.value)
+
+        def maybeSucceed(result):
+            if not future.cancelled():
+                future.set_result(result)
+
+        self.addCallbacks(maybeSucceed, maybeFail)
+        future.add_done_callback(checkCancel)
+        return future
+
+
+    def fromFuture(cls, future):
+        """
+        Adapt an asyncio C{Future} into a L{Deferred}.
+
+        The L{Deferred} fires with the result of the C{Future}, or fails
+        with its exception.  If the C{Future} is cancelled, the L{Deferred}
+        fails with L{CancelledError}; if the L{Deferred} is cancelled, so is
+        the C{Future}.
+
+        @rtype: L{Deferred}
+        """
+        def adapt(future):
+            if future.cancelled():
+                d.errback(cls._failureType(CancelledError()))
+                return
+            try:
+                extracted = future.result()
+            except:
+                extracted = cls._failureType()
+            d.callback(extracted)
+
+        d = cls(lambda d: future.cancel())
+        future.add_done_callback(adapt)
+        return d
+    fromFuture = classmethod(fromFuture)
+
+
     def __str__(self):
         cname = self.__class__.__name__
         if hasattr(self, 'result'):
@@ -526,6 +941,159 @@ class Deferred:
 
 
 
+_continue = Deferred.__dict__['_continue']
+
+
+
+class LightweightFailure(failure.Failure):
+    """
+    A L{failure.Failure} which only keeps the exception and the traceback
+    object, for error-heavy code paths.
+
+    A L{failure.Failure} copies the local and global variables of every frame
+    of the traceback when it is created, and formats them when it is
+    cleaned.  This one works out its frames, without variables, only when
+    they are needed: to format the traceback, or when it is cleaned and the
+    traceback object is let go.  It does not record the stack above the
+    point where the exception was caught.
+
+    It supports L{trap}, L{check}, L{raiseException} and
+    L{throwExceptionIntoGenerator} as used by L{Deferred} and
+    L{inlineCallbacks}.
+    """
+
+    count = 0
+    stack = ()
+
+    def __init__(self, exc_value=None, exc_type=None, exc_tb=None):
+        tb = None
+        if isinstance(exc_value, (str, unicode)) and exc_type is None:
+            exc_value = failure.DefaultException(exc_value)
+        if exc_value is None:
+            exc_value = self._findFailure()
+        if exc_value is None:
+            exc_type, exc_value, tb = exc_info()
+            if exc_type is None:
+                raise failure.NoCurrentExceptionError()
+        elif exc_type is None:
+            if isinstance(exc_value, Exception):
+                exc_type = exc_value.__class__
+            else:
+                exc_type = type(exc_value)
+        if isinstance(exc_value, failure.Failure):
+            self.__dict__ = exc_value.__dict__
+            return
+        self.type = exc_type
+        self.value = exc_value
+        self.tb = tb or exc_tb
+
+
+    def __getattr__(self, name):
+        if name == 'frames':
+            frames = self.frames = self._extractFrames()
+            return frames
+        if name == 'parents':
+            if isinstance(self.type, (type, types.ClassType)):
+                parents = map(reflect.qual, reflect.allYourBase(self.type))
+                parents.append(reflect.qual(self.type))
+            else:
+                parents = [self.type]
+            self.parents = parents
+            return parents
+        raise AttributeError(name)
+
+
+    def _extractFrames(self):
+        """
+        Return the frames of the traceback, in the format of
+        L{failure.Failure.frames}, but with no variables.
+        """
+        frames = []
+        tb = self.tb
+        while tb is not None:
+            code = tb.tb_frame.f_code
+            frames.append([code.co_name, code.co_filename, tb.tb_lineno,
+                           [], []])
+            tb = tb.tb_next
+        return frames
+
+
+    def check(self, *errorTypes):
+        """
+        Check if this failure's type is in a predetermined list.
+
+        See L{failure.Failure.check}.
+        """
+        for error in errorTypes:
+            if isinstance(error, (type, types.ClassType)):
+                if (isinstance(self.type, (type, types.ClassType)) and
+                    issubclass(self.type, error)):
+                    return error
+            elif error in self.parents:
+                return error
+        return None
+
+
+    def cleanFailure(self):
+        """
+        Let go of the traceback object, keeping just the names and line
+        numbers of its frames.
+        """
+        if self.tb is not None:
+            self.frames
+            self.tb = None
+
+
+
+class _FiredDeferred(Deferred):
+    """
+    A L{Deferred} which is created with its result already in place, as
+    returned by L{succeed} and L{fail}.
+
+    This skips the work of firing a new L{Deferred} with no callbacks, and
+    the callback list is only allocated when the first callback is added.
+    Debugging needs the full machinery, so L{succeed} and L{fail} only use
+    this class when debugging is off.
+    """
+
+    called = True
+    callbacks = ()
+
+    def __init__(self, result):
+        self.result = result
+        if isinstance(result, failure.Failure):
+            result.cleanFailure()
+            self._debugInfo = DebugInfo()
+            self._debugInfo.failResult = result
+
+
+    def addCallbacks(self, callback, errback=None,
+                     callbackArgs=None, callbackKeywords=None,
+                     errbackArgs=None, errbackKeywords=None):
+        """
+        Allocate the callback list, then add the callbacks as usual.
+
+        See L{Deferred.addCallbacks}.
+        """
+        if self.callbacks is _FiredDeferred.callbacks:
+            self.callbacks = []
+        return Deferred.addCallbacks(self, callback, errback,
+                                     callbackArgs, callbackKeywords,
+                                     errbackArgs, errbackKeywords)
+
+
+    def extendCallbacks(self, stages):
+        """
+        Allocate the callback list, then add the stages as usual.
+
+        See L{Deferred.extendCallbacks}.
+        """
+        if self.callbacks is _FiredDeferred.callbacks:
+            self.callbacks = []
+        return Deferred.extendCallbacks(self, stages)
+
+
+
 class DebugInfo:
     """
     Deferred debug helper.
@@ -563,741 +1131,4356 @@ class DebugInfo:
 
 
 
-class FirstError(Exception):
+# Maps Python functions to dicts mapping the classes they are methods of,
+# or None, to the keys _callbackKey made for them.  Functions are held by
+# weak reference, so closures are not kept alive.
+_callbackKeys = weakref.WeakKeyDictionary()
+
+def _callbackKey(callback):
     """
-    First error to occur in a L{DeferredList} if C{fireOnOneErrback} is set.
+    Identify a callback for L{CallbackProfiler}.
 
-    @ivar subFailure: The L{Failure} that occurred.
-    @type subFailure: L{Failure}
+    @return: A C{(name, location)} tuple, where C{name} is the qualified name
+        of C{callback} and C{location} is C{"filename:lineno"} of its
+        definition, or C{"?"} if it has no Python code object.
+    """
+    func = getattr(callback, '__func__', callback)
+    owner = getattr(callback, '__self__', None)
+    if owner is not None and not isinstance(owner, (type, types.ClassType)):
+        owner = owner.__class__
+    code = getattr(func, '__code__', None)
+    if code is not None:
+        keys = _callbackKeys.get(func)
+        if keys is not None and owner in keys:
+            return keys[owner]
+    name = getattr(func, '__name__', None) or func.__class__.__name__
+    if owner is not None:
+        name = '%s.%s' % (owner.__name__, name)
+    module = getattr(func, '__module__', None)
+    if module:
+        name = '%s.%s' % (module, name)
+    if code is None:
+        key = (name, '?')
+    else:
+        key = (name, '%s:%d' % (code.co_filename, code.co_firstlineno))
+        _callbackKeys.setdefault(func, {})[owner] = key
+    return key
 
-    @ivar index: The index of the L{Deferred} in the L{DeferredList} where
-        it happened.
-    @type index: C{int}
+
+
+class CallbackProfiler(object):
+    """
+    Per-callback profile of L{Deferred} callback chains.
+
+    Once installed with L{setProfiler}, every callback and errback run by
+    L{Deferred._runCallbacks} is timed and accounted to the function that
+    was called, rather than to C{_runCallbacks} itself.  Callbacks which fire
+    other L{Deferred}s synchronously are nested, so the time of the inner
+    callbacks is also available as a stack for flame graphs.
+
+    @ivar stats: A C{dict} mapping the C{(name, location)} key of a callback
+        to a C{[calls, failures, cumulative, own]} list.  C{failures} counts
+        calls which raised or returned a L{failure.Failure}; C{cumulative}
+        is the total wall time spent in the callback and C{own} the part of
+        it not spent in nested callbacks.
+
+    @ivar stacks: A C{dict} mapping a tuple of keys, outermost first, to the
+        own time spent in the innermost callback when called from there.
     """
-    def __init__(self, failure, index):
-        Exception.__init__(self, failure, index)
-        self.subFailure = failure
-        self.index = index
 
+    def __init__(self, timer=time.time):
+        """
+        @param timer: A no-argument callable returning the current time in
+            seconds.
+        """
+        self._timer = timer
+        self._stack = []
+        self.reset()
 
-    def __repr__(self):
+
+    def reset(self):
         """
-        The I{repr} of L{FirstError} instances includes the repr of the
-        wrapped failure's exception and the index of the L{FirstError}.
+        Forget everything recorded so far.
         """
-        return 'FirstError[#%d, %r]' % (self.index, self.subFailure.value)
+        self.stats = {}
+        self.stacks = {}
+        _callbackKeys.clear()
 
 
-    def __str__(self):
+    def runCallback(self, callback, result, args, kw):
         """
-        The I{str} of L{FirstError} instances includes the I{str} of the
-        entire wrapped failure (including its traceback and exception) and
-        the index of the L{FirstError}.
+        Call C{callback(result, *args, **kw)} and record how it went.
         """
-        return 'FirstError[#%d, %s]' % (self.index, self.subFailure)
+        key = _callbackKey(callback)
+        frame = [key, 0.0]
+        stack = self._stack
+        stack.append(frame)
+        failed = True
+        start = self._timer()
+        try:
+            result = callback(result, *args, **kw)
+            failed = isinstance(result, failure.Failure)
+        finally:
+            elapsed = self._timer() - start
+            stack.pop()
+            if stack:
+                stack[-1][1] += elapsed
+            own = elapsed - frame[1]
+            entry = self.stats.get(key)
+            if entry is None:
+                entry = self.stats[key] = [0, 0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += failed
+            entry[2] += elapsed
+            entry[3] += own
+            path = tuple([f[0] for f in stack]) + (key,)
+            self.stacks[path] = self.stacks.get(path, 0.0) + own
+        return result
 
 
-    def __cmp__(self, other):
+    def top(self, n=20, sortBy='cumulative'):
         """
-        Comparison between L{FirstError} and other L{FirstError} instances
-        is defined as the comparison of the index and sub-failure of each
-        instance.  L{FirstError} instances don't compare equal to anything
-        that isn't a L{FirstError} instance.
+        Return the C{n} most expensive callbacks.
 
-        @since: 8.2
+        @param sortBy: One of C{'cumulative'}, C{'own'}, C{'calls'} or
+            C{'failures'}.
+
+        @return: A C{list} of C{(name, location, calls, failures,
+            cumulative, own)} tuples, most expensive first.
         """
-        if isinstance(other, FirstError):
-            return cmp(
-                (self.index, self.subFailure),
-                (other.index, other.subFailure))
-        return -1
+        index = ['calls', 'failures', 'cumulative', 'own'].index(sortBy)
+        entries = sorted(self.stats.iteritems(),
+                         key=lambda item: item[1][index], reverse=True)
+        return [key + tuple(entry) for key, entry in entries[:n]]
+
 
+    def report(self, n=20, sortBy='cumulative'):
+        """
+        Format the result of L{top} as a table.
 
+        @rtype: C{str}
+        """
+        lines = ['%8s %8s %12s %12s %12s  %s' % (
+                'calls', 'failures', 'cumulative', 'own', 'percall',
+                'callback')]
+        for name, location, calls, failures, cumulative, own in self.top(
+            n, sortBy):
+            lines.append('%8d %8d %12.6f %12.6f %12.6f  %s (%s)' % (
+                    calls, failures, cumulative, own, cumulative / calls,
+                    name, location))
+        return '\n'.join(lines)
+
+
+    def dumpFlameGraph(self, out):
+        """
+        Write the recorded stacks in the folded format read by
+        C{flamegraph.pl} and compatible tools: one line per stack, frames
+        separated by C{;}, followed by the own time in microseconds.
 
-class DeferredList(Deferred):
+        @param out: A file-like object to write to.
+        """
+        for path, own in sorted(self.stacks.iteritems()):
+            frames = ['%s (%s)' % key for key in path]
+            out.write('%s %d\n' % (';'.join(frames), int(own * 1e6)))
+
+
+
+def _callerSite():
     """
-    I combine a group of deferreds into one callback.
+    Find the code outside this module which led to the current call.
 
-    I track a list of L{Deferred}s for their callbacks, and make a single
-    callback when they have all completed, a list of (success, result)
-    tuples, 'success' being a boolean.
+    @return: A C{"filename:lineno in function"} string, or C{"?"}.
+    """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals is globals():
+        frame = frame.f_back
+    if frame is None:
+        return '?'
+    return '%s:%d in %s' % (frame.f_code.co_filename, frame.f_lineno,
+                            frame.f_code.co_name)
 
-    Note that you can still use a L{Deferred} after putting it in a
-    DeferredList.  For example, you can suppress 'Unhandled error in Deferred'
-    messages by adding errbacks to the Deferreds *after* putting them in the
-    DeferredList, as a DeferredList won't swallow the errors.  (Although a more
-    convenient way to do this is simply to set the consumeErrors flag)
+
+
+class _PendingRecord(object):
     """
+    What a L{PendingDeferredRegistry} knows about one L{Deferred}.
+
+    @ivar ref: A weak reference to the L{Deferred}.
+    @ivar site: A C{"filename:lineno in function"} string for the code which
+        created the L{Deferred}.
+    @ivar created: When the L{Deferred} was created.
+    @ivar parents: Weak references to the L{Deferred}s it was chained to
+        with L{Deferred.chainDeferred}.
+    """
+    __slots__ = ('ref', 'site', 'created', 'parents')
 
-    fireOnOneCallback = 0
-    fireOnOneErrback = 0
+    def __init__(self, ref, site, created):
+        self.ref = ref
+        self.site = site
+        self.created = created
+        self.parents = []
 
 
-    def __init__(self, deferredList, fireOnOneCallback=0, fireOnOneErrback=0,
-                 consumeErrors=0):
+
+class PendingDeferredRegistry(object):
+    """
+    A registry of L{Deferred}s which have been created but not yet fired,
+    for finding stuck chains and leaks.
+
+    Once installed with L{setPendingRegistry}, L{Deferred}s are registered
+    when they are created and removed again when they are fired or garbage
+    collected.  Only weak references are kept, so the registry never keeps
+    a L{Deferred} (or anything its callbacks refer to) alive.  To keep the
+    overhead low enough for production only one in every C{sampleEvery}
+    L{Deferred}s is registered, and the creation site is found by walking
+    a few frames rather than formatting a whole stack.
+
+    @ivar sampleEvery: Register one L{Deferred} out of this many.
+    """
+
+    def __init__(self, sampleEvery=1, clock=time.time):
         """
-        Initialize a DeferredList.
+        @param sampleEvery: Register one L{Deferred} out of this many.
+        @param clock: A no-argument callable returning the current time in
+            seconds.
+        """
+        if sampleEvery < 1:
+            raise ValueError("PendingDeferredRegistry requires sampleEvery >= 1")
+        self.sampleEvery = sampleEvery
+        self._clock = clock
+        self._countdown = 1
+        self._records = {}
 
-        @type deferredList:  C{list} of L{Deferred}s
-        @param deferredList: The list of deferreds to track.
-        @param fireOnOneCallback: (keyword param) a flag indicating that
-                             only one callback needs to be fired for me to call
-                             my callback
-        @param fireOnOneErrback: (keyword param) a flag indicating that
-                            only one errback needs to be fired for me to call
-                            my errback
-        @param consumeErrors: (keyword param) a flag indicating that any errors
-                            raised in the original deferreds should be
-                            consumed by this DeferredList.  This is useful to
-                            prevent spurious warnings being logged.
-        """
-        self.resultList = [None] * len(deferredList)
-        Deferred.__init__(self)
-        if len(deferredList) == 0 and not fireOnOneCallback:
-            self.callback(self.resultList)
 
-        # These flags need to be set *before* attaching callbacks to the
-        # deferreds, because the callbacks use these flags, and will run
-        # synchronously if any of the deferreds are already fired.
-        self.fireOnOneCallback = fireOnOneCallback
-        self.fireOnOneErrback = fireOnOneErrback
-        self.consumeErrors = consumeErrors
-        self.finishedCount = 0
-
-        index = 0
-        for deferred in deferredList:
-            deferred.addCallbacks(self._cbDeferred, self._cbDeferred,
-                                  callbackArgs=(index,SUCCESS),
-                                  errbackArgs=(index,FAILURE))
-            index = index + 1
+    def __len__(self):
+        return len(self._records)
 
 
-    def _cbDeferred(self, result, index, succeeded):
+    def track(self, d):
         """
-        (internal) Callback for when one of my deferreds fires.
+        Register a newly created L{Deferred}, if it is picked by sampling.
         """
-        self.resultList[index] = (succeeded, result)
+        self._countdown -= 1
+        if self._countdown:
+            return
+        self._countdown = self.sampleEvery
+        key = id(d)
+        records = self._records
+        ref = weakref.ref(d, lambda ref: records.pop(key, None))
+        records[key] = _PendingRecord(ref, _callerSite(), self._clock())
 
-        self.finishedCount += 1
-        if not self.called:
-            if succeeded == SUCCESS and self.fireOnOneCallback:
-                self.callback((result, index))
-            elif succeeded == FAILURE and self.fireOnOneErrback:
-                self.errback(failure.Failure(FirstError(result, index)))
-            elif self.finishedCount == len(self.resultList):
-                self.callback(self.resultList)
 
-        if succeeded == FAILURE and self.consumeErrors:
-            result = None
+    def discard(self, d):
+        """
+        Forget about a L{Deferred}, because it has been fired.
+        """
+        self._records.pop(id(d), None)
 
-        return result
 
+    def chained(self, parent, child):
+        """
+        Note that C{parent.chainDeferred(child)} has been called.
+        """
+        record = self._records.get(id(child))
+        if record is not None:
+            record.parents.append(weakref.ref(parent))
 
 
-def _parseDListResult(l, fireOnOneErrback=0):
-    if __debug__:
-        for success, value in l:
-            assert success
-    return [x[1] for x in l]
+    def _live(self):
+        """
+        Return C{(deferred, record)} pairs for the registered L{Deferred}s
+        which are still alive.
+        """
+        pairs = []
+        for record in self._records.values():
+            d = record.ref()
+            if d is not None:
+                pairs.append((d, record))
+        return pairs
 
 
+    def oldest(self, n=10):
+        """
+        Return the C{n} L{Deferred}s which have been pending the longest.
 
-def gatherResults(deferredList):
-    """
-    Returns list with result of given L{Deferred}s.
+        @return: A C{list} of C{(age, site, deferred)} tuples, oldest first.
+        """
+        now = self._clock()
+        pairs = sorted(self._live(), key=lambda pair: pair[1].created)
+        return [(now - record.created, record.site, d)
+                for d, record in pairs[:n]]
 
-    This builds on L{DeferredList} but is useful since you don't
-    need to parse the result for success/failure.
 
-    @type deferredList:  C{list} of L{Deferred}s
-    """
-    d = DeferredList(deferredList, fireOnOneErrback=1)
-    d.addCallback(_parseDListResult)
-    return d
+    def countBySite(self):
+        """
+        Count the pending L{Deferred}s by the site which created them.
 
+        @return: A C{list} of C{(site, count)} tuples, largest count first.
+        """
+        counts = {}
+        for d, record in self._live():
+            counts[record.site] = counts.get(record.site, 0) + 1
+        return sorted(counts.iteritems(), key=lambda item: item[1],
+                      reverse=True)
 
 
-# Constants for use with DeferredList
+    def parents(self, d):
+        """
+        Return the live L{Deferred}s which C{d} has been chained to with
+        L{Deferred.chainDeferred}.  This is only known if C{d} is registered.
+        """
+        record = self._records.get(id(d))
+        if record is None:
+            return []
+        return [p for p in [ref() for ref in record.parents] if p is not None]
 
-SUCCESS = True
-FAILURE = False
 
+    def children(self, d):
+        """
+        Return the L{Deferred}s which have been chained to C{d} with
+        L{Deferred.chainDeferred} and are still waiting for it to fire.
+        """
+        children = []
+        for item in d.callbacks:
+            callback, args, kw = item[0]
+            if (getattr(callback, '__func__', None) is
+                Deferred._callChainedDeferred.__func__):
+                children.append(args[0])
+        return children
 
 
-## deferredGenerator
 
-class waitForDeferred:
+class _TraceNode(object):
     """
-    See L{deferredGenerator}.
+    What a L{CausalTracer} knows about one L{Deferred}.
+
+    @ivar id: The integer which identifies the L{Deferred} in the trace.
+    @ivar site: Where the L{Deferred} was created, see L{_callerSite}.
+    @ivar created: When the L{Deferred} was created, or C{None} if it was
+        created before tracing started.
+    @ivar fired: When C{callback} or C{errback} was called, or C{None}.
+    @ivar firedBy: The id of the L{Deferred} whose callbacks fired this one,
+        or C{None} if it was fired from outside any callback.
+    @ivar finished: When the callback chain last ran to completion, or
+        C{None}.
+    @ivar pauses: A C{list} of C{[targetId, pausedAt, resumedAt]} lists, one
+        for each time a callback returned a L{Deferred} which this one then
+        waited on.  C{resumedAt} is C{None} while still waiting.
     """
+    __slots__ = ('id', 'site', 'created', 'fired', 'firedBy', 'finished',
+                 'pauses')
 
-    def __init__(self, d):
-        if not isinstance(d, Deferred):
-            raise TypeError("You must give waitForDeferred a Deferred. You gave it %r." % (d,))
-        self.d = d
+    def __init__(self, id, site, created):
+        self.id = id
+        self.site = site
+        self.created = created
+        self.fired = None
+        self.firedBy = None
+        self.finished = None
+        self.pauses = []
 
 
-    def getResult(self):
-        if isinstance(self.result, failure.Failure):
-            self.result.raiseException()
-        return self.result
+    def asDict(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
 
 
 
-def _deferGenerator(g, deferred):
+class CausalTracer(object):
     """
-    See L{deferredGenerator}.
+    Record the causal graph of L{Deferred}s, for working out which one held
+    up a slow request.
+
+    Once installed with L{setTracer}, the tracer records when each
+    L{Deferred} is created, fired and finished, which L{Deferred} fired it
+    (because it was chained with L{Deferred.chainDeferred}, or a callback
+    called its C{callback} method), and which L{Deferred}s it paused on
+    because a callback returned them.  L{Deferred}s are identified by
+    integers, which the tracer maps them to with weak references, so the
+    trace does not keep them alive.  Ids are never reused, even after
+    L{reset}.
+
+    @ivar nodes: A C{dict} mapping ids to L{_TraceNode}s.
     """
-    result = None
 
-    # This function is complicated by the need to prevent unbounded recursion
-    # arising from repeatedly yielding immediately ready deferreds.  This while
-    # loop and the waiting variable solve that by manually unfolding the
-    # recursion.
+    def __init__(self, clock=time.time):
+        """
+        @param clock: A no-argument callable returning the current time in
+            seconds.
+        """
+        self._clock = clock
+        self._nextId = 0
+        self.reset()
 
-    waiting = [True, # defgen is waiting for result?
-               None] # result
 
-    while 1:
-        try:
-            result = g.next()
-        except StopIteration:
-            deferred.callback(result)
-            return deferred
-        except:
-            deferred.errback()
-            return deferred
+    def reset(self):
+        """
+        Forget everything recorded so far.
+        """
+        self.nodes = {}
+        self._ids = weakref.WeakKeyDictionary()
+        self._running = []
 
-        # Deferred.callback(Deferred) raises an error; we catch this case
-        # early here and give a nicer error message to the user in case
-        # they yield a Deferred.
-        if isinstance(result, Deferred):
-            return fail(TypeError("Yield waitForDeferred(d), not d!"))
 
-        if isinstance(result, waitForDeferred):
-            # a waitForDeferred was yielded, get the result.
-            # Pass result in so it don't get changed going around the loop
-            # This isn't a problem for waiting, as it's only reused if
-            # gotResult has already been executed.
-            def gotResult(r, result=result):
-                result.result = r
-                if waiting[0]:
-                    waiting[0] = False
-                    waiting[1] = r
-                else:
-                    _deferGenerator(g, deferred)
-            result.d.addBoth(gotResult)
-            if waiting[0]:
-                # Haven't called back yet, set flag so that we get reinvoked
-                # and return from the loop
-                waiting[0] = False
-                return deferred
-            # Reset waiting to initial values for next loop
-            waiting[0] = True
-            waiting[1] = None
+    def _node(self, d):
+        """
+        Return the L{_TraceNode} for C{d}, creating it if C{d} predates the
+        tracer, or the last L{reset}.
+        """
+        node = self.nodes.get(self._ids.get(d))
+        if node is None:
+            node = self.created(d)
+            node.created = None
+        return node
 
-            result = None
 
+    def created(self, d):
+        """
+        Start tracing a new L{Deferred}.
+        """
+        self._nextId += 1
+        self._ids[d] = self._nextId
+        node = self.nodes[self._nextId] = _TraceNode(
+            self._nextId, _callerSite(), self._clock())
+        return node
 
 
-def deferredGenerator(f):
-    """
-    deferredGenerator and waitForDeferred help you write L{Deferred}-using code
-    that looks like a regular sequential function. If your code has a minimum
-    requirement of Python 2.5, consider the use of L{inlineCallbacks} instead,
-    which can accomplish the same thing in a more concise manner.
+    def fired(self, d):
+        """
+        Note that C{d} has been given its result.
+        """
+        node = self._node(d)
+        node.fired = self._clock()
+        if self._running:
+            node.firedBy = self._running[-1]
 
-    There are two important functions involved: L{waitForDeferred}, and
-    L{deferredGenerator}.  They are used together, like this::
 
-        def thingummy():
-            thing = waitForDeferred(makeSomeRequestResultingInDeferred())
-            yield thing
-            thing = thing.getResult()
-            print thing #the result! hoorj!
-        thingummy = deferredGenerator(thingummy)
+    def enter(self, d):
+        """
+        Note that the callbacks of C{d} are about to run.
+        """
+        self._running.append(self._node(d).id)
 
-    L{waitForDeferred} returns something that you should immediately yield; when
-    your generator is resumed, calling C{thing.getResult()} will either give you
-    the result of the L{Deferred} if it was a success, or raise an exception if it
-    was a failure.  Calling C{getResult} is B{absolutely mandatory}.  If you do
-    not call it, I{your program will not work}.
 
-    L{deferredGenerator} takes one of these waitForDeferred-using generator
-    functions and converts it into a function that returns a L{Deferred}. The
-    result of the L{Deferred} will be the last value that your generator yielded
-    unless the last value is a L{waitForDeferred} instance, in which case the
-    result will be C{None}.  If the function raises an unhandled exception, the
-    L{Deferred} will errback instead.  Remember that C{return result} won't work;
-    use C{yield result; return} in place of that.
+    def leave(self, d):
+        """
+        Note that the callbacks of C{d} have stopped running, because there
+        are none left or it has paused.
+        """
+        self._running.pop()
+        if not d.paused and not d.callbacks:
+            self._node(d).finished = self._clock()
 
-    Note that not yielding anything from your generator will make the L{Deferred}
-    result in C{None}. Yielding a L{Deferred} from your generator is also an error
-    condition; always yield C{waitForDeferred(d)} instead.
 
-    The L{Deferred} returned from your deferred generator may also errback if your
-    generator raised an exception.  For example::
+    def paused(self, d, target):
+        """
+        Note that C{d} is waiting for the result of C{target}.
+        """
+        self._node(d).pauses.append(
+            [self._node(target).id, self._clock(), None])
 
-        def thingummy():
-            thing = waitForDeferred(makeSomeRequestResultingInDeferred())
-            yield thing
-            thing = thing.getResult()
-            if thing == 'I love Twisted':
-                # will become the result of the Deferred
-                yield 'TWISTED IS GREAT!'
-                return
-            else:
-                # will trigger an errback
-                raise Exception('DESTROY ALL LIFE')
-        thingummy = deferredGenerator(thingummy)
 
-    Put succinctly, these functions connect deferred-using code with this 'fake
-    blocking' style in both directions: L{waitForDeferred} converts from a
-    L{Deferred} to the 'blocking' style, and L{deferredGenerator} converts from the
-    'blocking' style to a L{Deferred}.
-    """
+    def resumed(self, d):
+        """
+        Note that the L{Deferred} which C{d} was waiting for has fired.
+        """
+        pauses = self._node(d).pauses
+        if pauses and pauses[-1][2] is None:
+            pauses[-1][2] = self._clock()
 
-    def unwindGenerator(*args, **kwargs):
-        return _deferGenerator(f(*args, **kwargs), Deferred())
-    return mergeFunctionMetadata(f, unwindGenerator)
 
+    def criticalPath(self, root):
+        """
+        Find the chain of L{Deferred}s which held up C{root}.
 
-## inlineCallbacks
+        Starting from C{root}, repeatedly step to whatever the current
+        L{Deferred} was last waiting for: the L{Deferred} it last paused on,
+        or failing that the one which fired it.
 
-# BaseException is only in Py 2.5.
-try:
-    BaseException
-except NameError:
-    BaseException=Exception
+        @param root: A L{Deferred}, or its id in the trace.
 
+        @return: A C{list} of L{_TraceNode}s, the original cause first and
+            C{root} last.
+        """
+        if not isinstance(root, (int, long)):
+            root = self._node(root).id
+        path = []
+        seen = set()
+        node = self.nodes.get(root)
+        while node is not None and node.id not in seen:
+            path.append(node)
+            seen.add(node.id)
+            if node.pauses:
+                node = self.nodes.get(node.pauses[-1][0])
+            elif node.firedBy is not None:
+                node = self.nodes.get(node.firedBy)
+            else:
+                node = None
+        path.reverse()
+        return path
 
 
-class _DefGen_Return(BaseException):
-    def __init__(self, value):
-        self.value = value
+    def _edges(self):
+        """
+        Return the edges of the graph as C{(kind, source, target)} tuples,
+        where C{kind} is C{"fired"} or C{"paused"}.
+        """
+        edges = []
+        for node in self.nodes.itervalues():
+            if node.firedBy is not None:
+                edges.append(('fired', node.firedBy, node.id))
+            for target, pausedAt, resumedAt in node.pauses:
+                edges.append(('paused', node.id, target))
+        return edges
 
 
+    def toJSON(self, root=None):
+        """
+        Export the graph as a JSON document with C{"nodes"} and C{"edges"}
+        lists, plus C{"criticalPath"} (a list of ids) if C{root} is given.
+        """
+        graph = {
+            'nodes': [node.asDict() for node in self.nodes.itervalues()],
+            'edges': [dict(kind=kind, source=source, target=target)
+                      for kind, source, target in self._edges()]}
+        if root is not None:
+            graph['criticalPath'] = [
+                node.id for node in self.criticalPath(root)]
+        return json.dumps(graph)
 
-def returnValue(val):
+
+    def toDOT(self, root=None):
+        """
+        Export the graph in Graphviz DOT format.  If C{root} is given, the
+        nodes on its critical path are highlighted.
+        """
+        critical = set()
+        if root is not None:
+            critical = set([node.id for node in self.criticalPath(root)])
+        lines = ['digraph deferreds {']
+        for node in self.nodes.itervalues():
+            duration = ''
+            if node.created is not None and node.finished is not None:
+                duration = '\\n%.6fs' % (node.finished - node.created,)
+            attrs = 'label="%d %s%s"' % (
+                node.id, node.site.replace('"', '\\"'), duration)
+            if node.id in critical:
+                attrs += ' color=red'
+            lines.append('  d%d [%s];' % (node.id, attrs))
+        for kind, source, target in self._edges():
+            attrs = 'label="%s"' % (kind,)
+            if kind == 'paused':
+                attrs += ' style=dashed'
+            lines.append('  d%d -> d%d [%s];' % (source, target, attrs))
+        lines.append('}')
+        return '\n'.join(lines)
+
+
+
+class CooperativeRunner(object):
+    """
+    Run the callbacks of L{Deferred}s in bounded time slices, so that firing
+    a L{Deferred} with many callbacks or descendants does not keep the
+    reactor from everything else for too long.
+
+    Once installed with L{setCooperative}, a L{Deferred} which has callbacks
+    to run is put on a queue instead of running them straight away.  If no
+    slice is running or due, one is started at once, so a L{Deferred} fired
+    from the reactor still runs its callbacks before the call which fired
+    it returns.  A slice runs the L{Deferred}s on the queue in the order
+    they were put there, and L{Deferred}s fired by their callbacks join the
+    end of the queue rather than running inside the callback which fired
+    them.  Once a slice has taken C{timeSlice} seconds, the rest of the
+    queue is left for another slice, scheduled with C{callLater(0, ...)} so
+    the reactor can handle I/O and timers in between.
+
+    The callbacks of each L{Deferred} still run in the order they were
+    added, but callbacks of different L{Deferred}s now run breadth first:
+    code which fires a L{Deferred} and expects its callbacks to have run
+    when that returns will see them run later.  A slice always runs at
+    least one callback, and a L{Deferred} whose callbacks are cut short
+    by the end of a slice carries on at the start of the next, so a slice
+    only overruns by as long as a single callback takes.
+
+    @ivar timeSlice: How long a slice may run for, in seconds.
+
+    @ivar history: A C{deque} of C{(started, duration, ran, left)} tuples
+        for the most recent slices: when each slice started and how long it
+        took, how many L{Deferred}s it ran, and how many were left on the
+        queue after it.
+
+    @ivar slices: How many slices have been run.
+    @ivar ran: How many L{Deferred}s have been run.
+    @ivar yields: How many slices left work for another slice.
+    @ivar maxSlice: The longest a slice has taken, in seconds.
+    @ivar maxQueued: The most L{Deferred}s there have been on the queue.
     """
-    Return val from a L{inlineCallbacks} generator.
 
-    Note: this is currently implemented by raising an exception
-    derived from L{BaseException}.  You might want to change any
-    'except:' clauses to an 'except Exception:' clause so as not to
-    catch this exception.
+    _current = None
 
-    Also: while this function currently will work when called from
-    within arbitrary functions called from within the generator, do
-    not rely upon this behavior.
-    """
-    raise _DefGen_Return(val)
+    def __init__(self, timeSlice=0.005, scheduler=None, timer=time.time,
+                 history=1000):
+        """
+        @param timeSlice: How long a slice may run for, in seconds.
+        @param scheduler: An L{IReactorTime} provider to schedule slices
+            with, by default the reactor.  This is parameterized for
+            testing.
+        @param timer: A no-argument callable returning the current time in
+            seconds, used to time slices.
+        @param history: How many recent slices to keep in L{history}.
+        """
+        if scheduler is None:
+            from twisted.internet import reactor
+            scheduler = reactor
+        self._scheduler = scheduler
+        self._timer = timer
+        self.timeSlice = timeSlice
+        self._queue = collections.deque()
+        self._running = False
+        self._call = None
+        self.history = collections.deque(maxlen=history)
+        self.slices = 0
+        self.ran = 0
+        self.yields = 0
+        self.maxSlice = 0.0
+        self.maxQueued = 0
 
 
+    def __len__(self):
+        return len(self._queue)
 
-def _inlineCallbacks(result, g, deferred):
-    """
-    See L{inlineCallbacks}.
-    """
-    # This function is complicated by the need to prevent unbounded recursion
-    # arising from repeatedly yielding immediately ready deferreds.  This while
-    # loop and the waiting variable solve that by manually unfolding the
-    # recursion.
 
-    waiting = [True, # waiting for result?
-               None] # result
+    def _schedule(self, d):
+        """
+        Put C{d} on the queue, and run a slice now if none is running or
+        due.
+        """
+        if d._queued:
+            return
+        d._queued = True
+        queue = self._queue
+        queue.append(d)
+        if len(queue) > self.maxQueued:
+            self.maxQueued = len(queue)
+        if not self._running and self._call is None:
+            self._runSlice()
 
-    while 1:
-        try:
-            # Send the last result back as the result of the yield expression.
-            isFailure = isinstance(result, failure.Failure)
-            if isFailure:
-                result = result.throwExceptionIntoGenerator(g)
+
+    def _resume(self, d):
+        """
+        Put C{d}, which ran out of time with callbacks left to run, at the
+        front of the queue so it carries on first in the next slice.
+        """
+        d._queued = True
+        self._queue.appendleft(d)
+
+
+    def _runSlice(self):
+        """
+        Run L{Deferred}s off the queue until it is empty or the slice has
+        taken C{timeSlice} seconds, then schedule another slice for what is
+        left.
+        """
+        self._call = None
+        queue = self._queue
+        timer = self._timer
+        ran = 0
+        self._running = True
+        start = timer()
+        self._deadline = start + self.timeSlice
+        try:
+            while queue:
+                d = queue.popleft()
+                d._queued = False
+                self._current = d
+                d._runCallbacks()
+                ran += 1
+                if timer() >= self._deadline:
+                    break
+        finally:
+            self._current = None
+            self._running = False
+            duration = timer() - start
+            self.history.append((start, duration, ran, len(queue)))
+            self.slices += 1
+            self.ran += ran
+            if duration > self.maxSlice:
+                self.maxSlice = duration
+            if queue:
+                self.yields += 1
+                self._call = self._scheduler.callLater(0, self._runSlice)
+
+
+    def flush(self):
+        """
+        Run everything on the queue now, without time slices, for instance
+        before shutting down.
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        timeSlice = self.timeSlice
+        self.timeSlice = float('inf')
+        try:
+            self._runSlice()
+        finally:
+            self.timeSlice = timeSlice
+
+
+    def stats(self):
+        """
+        Return a C{dict} summarizing the slices run so far.
+        """
+        durations = sorted([entry[1] for entry in self.history])
+        if durations:
+            median = durations[len(durations) // 2]
+            p99 = durations[min(len(durations) - 1,
+                                int(len(durations) * 0.99))]
+        else:
+            median = p99 = 0.0
+        return {'slices': self.slices,
+                'ran': self.ran,
+                'yields': self.yields,
+                'queued': len(self._queue),
+                'maxQueued': self.maxQueued,
+                'maxSlice': self.maxSlice,
+                'medianSlice': median,
+                'p99Slice': p99}
+
+
+
+class _WheelTimer(object):
+    """
+    A call scheduled with L{TimerWheel.callLater}.
+
+    @ivar time: When the call is due, in seconds.
+    @ivar tick: When the call is due, in ticks of the wheel.
+    @ivar slot: The C{set} of the L{TimerWheel} this timer is in, or C{None}
+        once it has been called or cancelled.
+    """
+    __slots__ = ('time', 'tick', 'func', 'args', 'kw', 'slot', 'wheel')
+
+    def __init__(self, wheel, time, tick, func, args, kw):
+        self.wheel = wheel
+        self.time = time
+        self.tick = tick
+        self.func = func
+        self.args = args
+        self.kw = kw
+        self.slot = None
+
+
+    def getTime(self):
+        """
+        Return the time at which this call is due, in seconds.
+        """
+        return self.time
+
+
+    def active(self):
+        """
+        Return C{True} if this call has been neither made nor cancelled.
+        """
+        return self.slot is not None
+
+
+    def cancel(self):
+        """
+        Cancel this call.  Unlike a C{DelayedCall}, cancelling a call which
+        has already been made or cancelled does nothing.
+        """
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel._removed()
+
+
+
+class TimerWheel(object):
+    """
+    A hierarchical timer wheel, for scheduling very many timers with only
+    one reactor timer.
+
+    Time is divided into ticks of C{resolution} seconds.  The first level of
+    the wheel has a slot for each of the next C{2 ** slotBits} ticks, and
+    each further level has slots which are C{2 ** slotBits} times as long as
+    those of the level below.  Adding or cancelling a timer takes constant
+    time, and each timer is moved to a lower level at most once per level
+    as its slot comes up.  Timers never fire early, but may fire up to one
+    tick late.
+
+    A timer wheel has the C{callLater} and C{seconds} methods of
+    L{IReactorTime}, so it can be used as a scheduler.
+
+    @ivar resolution: The length of a tick, in seconds.
+    """
+
+    def __init__(self, clock=None, resolution=0.01, slotBits=6, levels=4):
+        """
+        @param clock: The L{IReactorTime} provider which drives the wheel,
+            by default the reactor.  This is parameterized for testing.
+        @param resolution: The length of a tick, in seconds.
+        @param slotBits: The base 2 logarithm of the number of slots in each
+            level.
+        @param levels: The number of levels.  Timers further away than
+            C{2 ** (slotBits * levels)} ticks are kept in an overflow set
+            until they come into range.
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._clock = clock
+        self.resolution = resolution
+        self._bits = slotBits
+        self._mask = (1 << slotBits) - 1
+        self._wheel = [[set() for i in xrange(1 << slotBits)]
+                       for level in xrange(levels)]
+        self._overflow = set()
+        self._count = 0
+        self._now = 0
+        self._call = None
+        self._wakeTick = None
+
+
+    def __len__(self):
+        return self._count
+
+
+    def seconds(self):
+        """
+        Return the current time according to the clock driving this wheel.
+        """
+        return self._clock.seconds()
+
+
+    def callLater(self, delay, func, *args, **kw):
+        """
+        Call C{func(*args, **kw)} after C{delay} seconds.
+
+        @return: An object with C{cancel}, C{active} and C{getTime} methods.
+        """
+        now = self._clock.seconds()
+        if not self._count:
+            # Nothing is waiting, so skip over the empty ticks since the
+            # last call.
+            self._now = max(self._now, int(now / self.resolution))
+        due = now + delay
+        timer = _WheelTimer(self, due, int(math.ceil(due / self.resolution)),
+                            func, args, kw)
+        self._place(timer)
+        self._count += 1
+        if self._wakeTick is None or timer.tick < self._wakeTick:
+            self._schedule()
+        return timer
+
+
+    def _place(self, timer):
+        """
+        Put C{timer} in the slot which covers its tick.
+        """
+        tick = max(timer.tick, self._now)
+        delta = tick - self._now
+        shift = 0
+        for slots in self._wheel:
+            if delta >> shift < self._mask + 1:
+                timer.slot = slots[(tick >> shift) & self._mask]
+                break
+            shift += self._bits
+        else:
+            timer.slot = self._overflow
+        timer.slot.add(timer)
+
+
+    def _removed(self):
+        """
+        Note that a timer has been cancelled, and stop the reactor timer if
+        there are none left.
+        """
+        self._count -= 1
+        if not self._count and self._call is not None:
+            self._call.cancel()
+            self._call = None
+            self._wakeTick = None
+
+
+    def _nextTick(self):
+        """
+        Return the next tick at which there may be work to do: a timer to
+        call, or a slot to move down to a lower level.
+        """
+        now = self._now
+        best = None
+        shift = 0
+        for level, slots in enumerate(self._wheel):
+            unit = now >> shift
+            start = 0
+            if level and now & ((1 << shift) - 1):
+                # The current slot of this level has already been moved down.
+                start = 1
+            for i in xrange(start, start + self._mask + 1):
+                if slots[(unit + i) & self._mask]:
+                    tick = max((unit + i) << shift, now)
+                    if best is None or tick < best:
+                        best = tick
+                    break
+            shift += self._bits
+        if self._overflow:
+            tick = ((now + (1 << shift) - 1) >> shift) << shift
+            if best is None or tick < best:
+                best = tick
+        return best
+
+
+    def _schedule(self):
+        """
+        Set the reactor timer for the next tick with work to do.
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        self._wakeTick = None
+        if not self._count:
+            return
+        tick = self._nextTick()
+        delay = max(0, tick * self.resolution - self._clock.seconds())
+        self._wakeTick = tick
+        self._call = self._clock.callLater(delay, self._wake)
+
+
+    def _wake(self):
+        """
+        Process every tick up to the current time, then set the reactor timer
+        again.
+        """
+        # The clock has reached the tick we asked to be woken at, even if
+        # rounding says otherwise.
+        target = max(self._wakeTick,
+                     int(self._clock.seconds() / self.resolution))
+        self._call = None
+        self._wakeTick = None
+        while self._count and self._now <= target:
+            self._advance()
+        self._schedule()
+
+
+    def _advance(self):
+        """
+        Process one tick: move timers down from any higher level slots which
+        start at this tick, then call the timers which are due.
+        """
+        now = self._now
+        mask = self._mask
+        if not now & mask:
+            shift = self._bits
+            for slots in self._wheel[1:]:
+                index = (now >> shift) & mask
+                self._cascade(slots, index)
+                if index:
+                    break
+                shift += self._bits
+            else:
+                overflow = self._overflow
+                self._overflow = set()
+                for timer in overflow:
+                    self._place(timer)
+        slots = self._wheel[0]
+        due = slots[now & mask]
+        slots[now & mask] = set()
+        self._now = now + 1
+        for timer in list(due):
+            if timer.slot is None:
+                # Cancelled by one of the timers called before it.
+                continue
+            timer.slot = None
+            self._count -= 1
+            try:
+                timer.func(*timer.args, **timer.kw)
+            except:
+                log.err()
+
+
+    def _cascade(self, slots, index):
+        """
+        Move the timers in C{slots[index]} down to lower levels.
+        """
+        timers = slots[index]
+        slots[index] = set()
+        for timer in timers:
+            self._place(timer)
+
+
+
+_timerWheel = None
+
+def getTimerWheel():
+    """
+    Return the L{TimerWheel} used by L{Deferred.addTimeout} by default,
+    creating it if necessary.
+    """
+    global _timerWheel
+    if _timerWheel is None:
+        _timerWheel = TimerWheel()
+    return _timerWheel
+
+
+
+def setTimerWheel(wheel):
+    """
+    Replace the L{TimerWheel} used by L{Deferred.addTimeout} by default.
+    """
+    global _timerWheel
+    _timerWheel = wheel
+
+
+
+class _VirtualCall(object):
+    """
+    A call scheduled with L{VirtualClock.callLater}.
+
+    @ivar clock: The L{VirtualClock} this call is scheduled with, or C{None}
+        once it has been made or cancelled.
+    """
+    __slots__ = ('time', 'func', 'args', 'kw', 'clock')
+
+    def __init__(self, clock, time, func, args, kw):
+        self.clock = clock
+        self.time = time
+        self.func = func
+        self.args = args
+        self.kw = kw
+
+
+    def getTime(self):
+        """
+        Return the time at which this call is due, in seconds.
+        """
+        return self.time
+
+
+    def active(self):
+        """
+        Return C{True} if this call has been neither made nor cancelled.
+        """
+        return self.clock is not None
+
+
+    def cancel(self):
+        """
+        Cancel this call.  Cancelling a call which has already been made or
+        cancelled does nothing.
+        """
+        if self.clock is not None:
+            self.clock._count -= 1
+            self.clock = None
+
+
+
+class VirtualClock(object):
+    """
+    A clock whose time only passes when it is told to, for simulating and
+    testing timed code deterministically and much faster than real time.
+
+    A virtual clock has the C{callLater} and C{seconds} methods of
+    L{IReactorTime}, so it can be given as the scheduler or clock of
+    anything in this module which takes one.  Calls due at the same time
+    are made in the order they were scheduled.
+
+    @ivar calls: The number of calls made so far.
+    """
+
+    def __init__(self, start=0.0):
+        """
+        @param start: The time to start at, in seconds.
+        """
+        self._now = start
+        self._heap = []
+        self._sequence = 0
+        self._count = 0
+        self.calls = 0
+
+
+    def __len__(self):
+        return self._count
+
+
+    def seconds(self):
+        """
+        Return the current virtual time.
+        """
+        return self._now
+
+
+    def callLater(self, delay, func, *args, **kw):
+        """
+        Call C{func(*args, **kw)} once the clock has advanced by C{delay}
+        seconds.
+
+        @return: An object with C{cancel}, C{active} and C{getTime} methods.
+        """
+        call = _VirtualCall(self, self._now + delay, func, args, kw)
+        self._sequence += 1
+        heapq.heappush(self._heap, (call.time, self._sequence, call))
+        self._count += 1
+        return call
+
+
+    def getDelayedCalls(self):
+        """
+        Return the calls which have been neither made nor cancelled.
+        """
+        return [call for (time, sequence, call) in self._heap
+                if call.clock is not None]
+
+
+    def advance(self, amount):
+        """
+        Move time on by C{amount} seconds, making the calls which fall due.
+        """
+        self.runUntil(self._now + amount)
+
+
+    def runUntil(self, when):
+        """
+        Move time on to C{when}, making the calls which fall due, including
+        those they schedule in turn.
+        """
+        heap = self._heap
+        while heap and heap[0][0] <= when:
+            call = heapq.heappop(heap)[2]
+            if call.clock is None:
+                continue
+            call.clock = None
+            self._count -= 1
+            self.calls += 1
+            self._now = max(self._now, call.time)
+            call.func(*call.args, **call.kw)
+        self._now = max(self._now, when)
+
+
+    def run(self):
+        """
+        Make calls until none are left, moving time on to each in turn.
+
+        @return: The time when the last call was made.
+        """
+        heap = self._heap
+        while heap:
+            self.runUntil(heap[0][0])
+        return self._now
+
+
+
+# The CancelScopes which have been entered, innermost last.
+_scopes = []
+
+
+
+class CancelScope(object):
+    """
+    A group of related L{Deferred}s which can be cancelled with one call.
+
+    While a scope is entered with the C{with} statement, every L{Deferred}
+    created is added to it, as are scopes entered inside it.  Generators
+    decorated with L{inlineCallbacks} and functions run by
+    L{DeferredLock.run} or L{DeferredSemaphore.run} which were started
+    inside the scope are run inside it again whenever they resume, so the
+    L{Deferred}s they create later are added too.  Other L{Deferred}s can be
+    added explicitly with L{add}.  A generator which yields inside a scope
+    it entered keeps that scope to itself while it waits, so L{Deferred}s
+    created elsewhere in the meantime are not added to it.
+
+    Members are held by weak reference, so a scope does not keep finished
+    work alive.  L{cancel} takes time linear in the number of members.
+
+    @ivar cancelled: C{True} once L{cancel} has been called.
+
+    @ivar cancelSiblingsOnFailure: If C{True}, the whole scope is cancelled
+        as soon as any member L{Deferred} fails with an error other than
+        L{CancelledError}.
+    """
+
+    cancelled = False
+
+    def __init__(self, cancelSiblingsOnFailure=False):
+        self.cancelSiblingsOnFailure = cancelSiblingsOnFailure
+        self._members = []
+        self._live = 0
+
+
+    def __enter__(self):
+        if _scopes:
+            _scopes[-1].add(self)
+        _scopes.append(self)
+        return self
+
+
+    def __exit__(self, excType, excValue, tb):
+        # Remove ourselves rather than whatever is on top, in case a scope
+        # entered inside us was left some other way.
+        for index in xrange(len(_scopes) - 1, -1, -1):
+            if _scopes[index] is self:
+                del _scopes[index]
+                break
+
+
+    def __len__(self):
+        """
+        Return the number of members which are still alive.
+        """
+        return self._live
+
+
+    def add(self, member):
+        """
+        Add a L{Deferred}, or another L{CancelScope}, to this scope.
+        """
+        self._live += 1
+        self._members.append(weakref.ref(member, self._forget))
+        if len(self._members) > 2 * self._live + 16:
+            self._members = [ref for ref in self._members
+                             if ref() is not None]
+        if self.cancelSiblingsOnFailure and isinstance(member, Deferred):
+            member.addErrback(self._memberFailed)
+
+
+    def _forget(self, ref):
+        """
+        Note that a member has been garbage collected.
+        """
+        self._live -= 1
+
+
+    def _memberFailed(self, reason):
+        if not reason.check(CancelledError):
+            self.cancel()
+        return reason
+
+
+    def cancel(self):
+        """
+        Cancel every member of this scope, in the order they were added.
+        Members which have already fired are not affected, unless they are
+        waiting on another L{Deferred}, in which case that is cancelled.
+        """
+        self.cancelled = True
+        for ref in list(self._members):
+            member = ref()
+            if member is not None:
+                try:
+                    member.cancel()
+                except:
+                    log.err(None, "Error cancelling member of %r" % (self,))
+
+
+
+class FirstError(Exception):
+    """
+    First error to occur in a L{DeferredList} if C{fireOnOneErrback} is set.
+
+    @ivar subFailure: The L{Failure} that occurred.
+    @type subFailure: L{Failure}
+
+    @ivar index: The index of the L{Deferred} in the L{DeferredList} where
+        it happened.
+    @type index: C{int}
+    """
+    def __init__(self, failure, index):
+        Exception.__init__(self, failure, index)
+        self.subFailure = failure
+        self.index = index
+
+
+    def __repr__(self):
+        """
+        The I{repr} of L{FirstError} instances includes the repr of the
+        wrapped failure's exception and the index of the L{FirstError}.
+        """
+        return 'FirstError[#%d, %r]' % (self.index, self.subFailure.value)
+
+
+    def __str__(self):
+        """
+        The I{str} of L{FirstError} instances includes the I{str} of the
+        entire wrapped failure (including its traceback and exception) and
+        the index of the L{FirstError}.
+        """
+        return 'FirstError[#%d, %s]' % (self.index, self.subFailure)
+
+
+    def __cmp__(self, other):
+        """
+        Comparison between L{FirstError} and other L{FirstError} instances
+        is defined as the comparison of the index and sub-failure of each
+        instance.  L{FirstError} instances don't compare equal to anything
+        that isn't a L{FirstError} instance.
+
+        @since: 8.2
+        """
+        if isinstance(other, FirstError):
+            return cmp(
+                (self.index, self.subFailure),
+                (other.index, other.subFailure))
+        return -1
+
+
+
+class DeferredList(Deferred):
+    """
+    I combine a group of deferreds into one callback.
+
+    I track a list of L{Deferred}s for their callbacks, and make a single
+    callback when they have all completed, a list of (success, result)
+    tuples, 'success' being a boolean.
+
+    Note that you can still use a L{Deferred} after putting it in a
+    DeferredList.  For example, you can suppress 'Unhandled error in Deferred'
+    messages by adding errbacks to the Deferreds *after* putting them in the
+    DeferredList, as a DeferredList won't swallow the errors.  (Although a more
+    convenient way to do this is simply to set the consumeErrors flag)
+    """
+
+    fireOnOneCallback = 0
+    fireOnOneErrback = 0
+
+
+    def __init__(self, deferredList, fireOnOneCallback=0, fireOnOneErrback=0,
+                 consumeErrors=0):
+        """
+        Initialize a DeferredList.
+
+        @type deferredList:  C{list} of L{Deferred}s
+        @param deferredList: The list of deferreds to track.
+        @param fireOnOneCallback: (keyword param) a flag indicating that
+                             only one callback needs to be fired for me to call
+                             my callback
+        @param fireOnOneErrback: (keyword param) a flag indicating that
+                            only one errback needs to be fired for me to call
+                            my errback
+        @param consumeErrors: (keyword param) a flag indicating that any errors
+                            raised in the original deferreds should be
+                            consumed by this DeferredList.  This is useful to
+                            prevent spurious warnings being logged.
+        """
+        self.resultList = [None] * len(deferredList)
+        Deferred.__init__(self)
+        if len(deferredList) == 0 and not fireOnOneCallback:
+            self.callback(self.resultList)
+
+        # These flags need to be set *before* attaching callbacks to the
+        # deferreds, because the callbacks use these flags, and will run
+        # synchronously if any of the deferreds are already fired.
+        self.fireOnOneCallback = fireOnOneCallback
+        self.fireOnOneErrback = fireOnOneErrback
+        self.consumeErrors = consumeErrors
+        self.finishedCount = 0
+
+        index = 0
+        for deferred in deferredList:
+            deferred.addCallbacks(self._cbDeferred, self._cbDeferred,
+                                  callbackArgs=(index,SUCCESS),
+                                  errbackArgs=(index,FAILURE))
+            index = index + 1
+
+
+    def _cbDeferred(self, result, index, succeeded):
+        """
+        (internal) Callback for when one of my deferreds fires.
+        """
+        self.resultList[index] = (succeeded, result)
+
+        self.finishedCount += 1
+        if not self.called:
+            if succeeded == SUCCESS and self.fireOnOneCallback:
+                self.callback((result, index))
+            elif succeeded == FAILURE and self.fireOnOneErrback:
+                self.errback(failure.Failure(FirstError(result, index)))
+            elif self.finishedCount == len(self.resultList):
+                self.callback(self.resultList)
+
+        if succeeded == FAILURE and self.consumeErrors:
+            result = None
+
+        return result
+
+
+
+class QuorumError(Exception):
+    """
+    Too many of the L{Deferred}s given to a L{DeferredQuorum} failed for it
+    to succeed.
+
+    @ivar subFailures: The C{(index, failure)} pairs of the L{Deferred}s
+        which failed, in the order they failed.
+    @type subFailures: C{list}
+    """
+    def __init__(self, subFailures):
+        Exception.__init__(self, subFailures)
+        self.subFailures = subFailures
+
+
+
+class DeferredQuorum(Deferred):
+    """
+    I fire when enough of a group of L{Deferred}s have succeeded, and cancel
+    the rest.
+
+    As soon as C{required} of the L{Deferred}s have succeeded I call back
+    with a list of their C{(index, result)} pairs, in the order they
+    succeeded.  As soon as so many have failed that this is impossible, I
+    errback with a L{QuorumError}.  Either way, the L{Deferred}s which have
+    not fired yet are cancelled straight away and I drop my references to
+    them.  Cancelling me cancels them too.
+
+    Failures of the L{Deferred}s, including those caused by cancelling
+    them, are consumed; successful results are passed on unchanged.
+    """
+
+    def __init__(self, deferredList, required):
+        """
+        @type deferredList: C{list} of L{Deferred}s
+        @param deferredList: The L{Deferred}s to wait for.
+        @param required: How many of them must succeed.
+        """
+        Deferred.__init__(self, self._cancelPending)
+        deferredList = list(deferredList)
+        if not 0 <= required <= len(deferredList):
+            raise ValueError(
+                "DeferredQuorum requires 0 <= required <= %d" % (
+                    len(deferredList),))
+        self.required = required
+        self._allowedFailures = len(deferredList) - required
+        self._results = []
+        self._failures = []
+        self._pending = dict(enumerate(deferredList))
+        if not required:
+            self._finish()
+            self.callback([])
+        for index, deferred in enumerate(deferredList):
+            deferred.addCallbacks(self._cbSucceeded, self._cbFailed,
+                                  callbackArgs=(index,),
+                                  errbackArgs=(index,))
+
+
+    def _cbSucceeded(self, result, index):
+        """
+        (internal) Callback for when one of my L{Deferred}s succeeds.
+        """
+        if self._pending is not None:
+            del self._pending[index]
+            self._results.append((index, result))
+            if len(self._results) == self.required:
+                results = self._results
+                self._finish()
+                self.callback(results)
+        return result
+
+
+    def _cbFailed(self, reason, index):
+        """
+        (internal) Errback for when one of my L{Deferred}s fails.
+        """
+        if self._pending is not None:
+            del self._pending[index]
+            self._failures.append((index, reason))
+            if len(self._failures) > self._allowedFailures:
+                failures = self._failures
+                self._finish()
+                self.errback(self._failureType(QuorumError(failures)))
+
+
+    def _finish(self):
+        """
+        Drop my references to the L{Deferred}s and results, and cancel the
+        L{Deferred}s which are still pending.
+        """
+        self._results = self._failures = None
+        self._cancelPending()
+
+
+    def _cancelPending(self, ignored=None):
+        pending = self._pending
+        self._pending = None
+        if pending:
+            for deferred in pending.itervalues():
+                deferred.cancel()
+
+
+
+def race(deferredList):
+    """
+    Return a L{Deferred} which fires with the result of whichever of the
+    given L{Deferred}s succeeds first, and cancel the others.
+
+    @type deferredList: C{list} of L{Deferred}s
+
+    @return: A L{Deferred} which fires with a C{(result, index)} tuple, or
+        fails with a L{QuorumError} if all of C{deferredList} fail.
+    """
+    d = DeferredQuorum(deferredList, 1)
+    d.addCallback(lambda results: (results[0][1], results[0][0]))
+    return d
+
+
+
+def _parseDListResult(l, fireOnOneErrback=0):
+    if __debug__:
+        for success, value in l:
+            assert success
+    return [x[1] for x in l]
+
+
+
+def gatherResults(deferredList):
+    """
+    Returns list with result of given L{Deferred}s.
+
+    This builds on L{DeferredList} but is useful since you don't
+    need to parse the result for success/failure.
+
+    @type deferredList:  C{list} of L{Deferred}s
+    """
+    d = DeferredList(deferredList, fireOnOneErrback=1)
+    d.addCallback(_parseDListResult)
+    return d
+
+
+
+# Constants for use with DeferredList
+
+SUCCESS = True
+FAILURE = False
+
+
+
+## deferredGenerator
+
+class waitForDeferred:
+    """
+    See L{deferredGenerator}.
+    """
+
+    def __init__(self, d):
+        if not isinstance(d, Deferred):
+            raise TypeError("You must give waitForDeferred a Deferred. You gave it %r." % (d,))
+        self.d = d
+
+
+    def getResult(self):
+        if isinstance(self.result, failure.Failure):
+            self.result.raiseException()
+        return self.result
+
+
+
+def _deferGenerator(g, deferred):
+    """
+    See L{deferredGenerator}.
+    """
+    result = None
+
+    # This function is complicated by the need to prevent unbounded recursion
+    # arising from repeatedly yielding immediately ready deferreds.  This while
+    # loop and the waiting variable solve that by manually unfolding the
+    # recursion.
+
+    waiting = [True, # defgen is waiting for result?
+               None] # result
+
+    while 1:
+        try:
+            result = g.next()
+        except StopIteration:
+            deferred.callback(result)
+            return deferred
+        except:
+            deferred.errback()
+            return deferred
+
+        # Deferred.callback(Deferred) raises an error; we catch this case
+        # early here and give a nicer error message to the user in case
+        # they yield a Deferred.
+        if isinstance(result, Deferred):
+            return fail(TypeError("Yield waitForDeferred(d), not d!"))
+
+        if isinstance(result, waitForDeferred):
+            # a waitForDeferred was yielded, get the result.
+            # Pass result in so it don't get changed going around the loop
+            # This isn't a problem for waiting, as it's only reused if
+            # gotResult has already been executed.
+            def gotResult(r, result=result):
+                result.result = r
+                if waiting[0]:
+                    waiting[0] = False
+                    waiting[1] = r
+                else:
+                    _deferGenerator(g, deferred)
+            result.d.addBoth(gotResult)
+            if waiting[0]:
+                # Haven't called back yet, set flag so that we get reinvoked
+                # and return from the loop
+                waiting[0] = False
+                return deferred
+            # Reset waiting to initial values for next loop
+            waiting[0] = True
+            waiting[1] = None
+
+            result = None
+
+
+
+def deferredGenerator(f):
+    """
+    deferredGenerator and waitForDeferred help you write L{Deferred}-using code
+    that looks like a regular sequential function. If your code has a minimum
+    requirement of Python 2.5, consider the use of L{inlineCallbacks} instead,
+    which can accomplish the same thing in a more concise manner.
+
+    There are two important functions involved: L{waitForDeferred}, and
+    L{deferredGenerator}.  They are used together, like this::
+
+        def thingummy():
+            thing = waitForDeferred(makeSomeRequestResultingInDeferred())
+            yield thing
+            thing = thing.getResult()
+            print thing #the result! hoorj!
+        thingummy = deferredGenerator(thingummy)
+
+    L{waitForDeferred} returns something that you should immediately yield; when
+    your generator is resumed, calling C{thing.getResult()} will either give you
+    the result of the L{Deferred} if it was a success, or raise an exception if it
+    was a failure.  Calling C{getResult} is B{absolutely mandatory}.  If you do
+    not call it, I{your program will not work}.
+
+    L{deferredGenerator} takes one of these waitForDeferred-using generator
+    functions and converts it into a function that returns a L{Deferred}. The
+    result of the L{Deferred} will be the last value that your generator yielded
+    unless the last value is a L{waitForDeferred} instance, in which case the
+    result will be C{None}.  If the function raises an unhandled exception, the
+    L{Deferred} will errback instead.  Remember that C{return result} won't work;
+    use C{yield result; return} in place of that.
+
+    Note that not yielding anything from your generator will make the L{Deferred}
+    result in C{None}. Yielding a L{Deferred} from your generator is also an error
+    condition; always yield C{waitForDeferred(d)} instead.
+
+    The L{Deferred} returned from your deferred generator may also errback if your
+    generator raised an exception.  For example::
+
+        def thingummy():
+            thing = waitForDeferred(makeSomeRequestResultingInDeferred())
+            yield thing
+            thing = thing.getResult()
+            if thing == 'I love Twisted':
+                # will become the result of the Deferred
+                yield 'TWISTED IS GREAT!'
+                return
+            else:
+                # will trigger an errback
+                raise Exception('DESTROY ALL LIFE')
+        thingummy = deferredGenerator(thingummy)
+
+    Put succinctly, these functions connect deferred-using code with this 'fake
+    blocking' style in both directions: L{waitForDeferred} converts from a
+    L{Deferred} to the 'blocking' style, and L{deferredGenerator} converts from the
+    'blocking' style to a L{Deferred}.
+    """
+
+    def unwindGenerator(*args, **kwargs):
+        return _deferGenerator(f(*args, **kwargs), Deferred())
+    return mergeFunctionMetadata(f, unwindGenerator)
+
+
+## inlineCallbacks
+
+# BaseException is only in Py 2.5.
+try:
+    BaseException
+except NameError:
+    BaseException=Exception
+
+
+
+class _DefGen_Return(BaseException):
+    def __init__(self, value):
+        self.value = value
+
+
+
+def returnValue(val):
+    """
+    Return val from a L{inlineCallbacks} generator.
+
+    Note: this is currently implemented by raising an exception
+    derived from L{BaseException}.  You might want to change any
+    'except:' clauses to an 'except Exception:' clause so as not to
+    catch this exception.
+
+    Also: while this function currently will work when called from
+    within arbitrary functions called from within the generator, do
+    not rely upon this behavior.
+    """
+    raise _DefGen_Return(val)
+
+
+
+def _inlineCallbacks(result, g, deferred, scopes):
+    """
+    See L{inlineCallbacks}.
+
+    @param scopes: The C{list} of L{CancelScope}s C{g} runs in: those which
+        were active when it was started, and those it has entered since and
+        not yet left.  It is updated after each step of C{g}, and the
+        scopes of whatever resumed C{g} are put back.
+    """
+    # This function is complicated by the need to prevent unbounded recursion
+    # arising from repeatedly yielding immediately ready deferreds.  This while
+    # loop and the waiting variable solve that by manually unfolding the
+    # recursion.
+
+    waiting = [True, # waiting for result?
+               None] # result
+
+    while 1:
+        try:
+            # Send the last result back as the result of the yield expression.
+            isFailure = isinstance(result, failure.Failure)
+            # Only swap the scopes in and out if there are any, so code
+            # which does not use them pays nothing for it.
+            swap = bool(scopes or _scopes)
+            if swap:
+                saved = _scopes[:]
+                _scopes[:] = scopes
+            try:
+                if isFailure:
+                    result = result.throwExceptionIntoGenerator(g)
+                else:
+                    result = g.send(result)
+            finally:
+                if swap:
+                    scopes[:] = _scopes
+                    _scopes[:] = saved
+                elif _scopes:
+                    # g entered a scope it has not left yet.
+                    scopes[:] = _scopes
+                    del _scopes[:]
+        except StopIteration:
+            # fell off the end, or "return" statement
+            deferred.callback(None)
+            return deferred
+        except _DefGen_Return, e:
+            # returnValue() was called; time to give a result to the original
+            # Deferred.  First though, let's try to identify the potentially
+            # confusing situation which results when returnValue() is
+            # accidentally invoked from a different function, one that wasn't
+            # decorated with @inlineCallbacks.
+
+            # The traceback starts in this frame (the one for
+            # _inlineCallbacks); the next one down should be the application
+            # code.
+            appCodeTrace = exc_info()[2].tb_next
+            if isFailure:
+                # If we invoked this generator frame by throwing an exception
+                # into it, then throwExceptionIntoGenerator will consume an
+                # additional stack frame itself, so we need to skip that too.
+                appCodeTrace = appCodeTrace.tb_next
+            # Now that we've identified the frame being exited by the
+            # exception, let's figure out if returnValue was called from it
+            # directly.  returnValue itself consumes a stack frame, so the
+            # application code will have a tb_next, but it will *not* have a
+            # second tb_next.
+            if appCodeTrace.tb_next.tb_next:
+                # If returnValue was invoked non-local to the frame which it is
+                # exiting, identify the frame that ultimately invoked
+                # returnValue so that we can warn the user, as this behavior is
+                # confusing.
+                ultimateTrace = appCodeTrace
+                while ultimateTrace.tb_next.tb_next:
+                    ultimateTrace = ultimateTrace.tb_next
+                filename = ultimateTrace.tb_frame.f_code.co_filename
+                lineno = ultimateTrace.tb_lineno
+                warnings.warn_explicit(
+                    "returnValue() in %r causing %r to exit: "
+                    "returnValue should only be invoked by functions decorated "
+                    "with inlineCallbacks" % (
+                        ultimateTrace.tb_frame.f_code.co_name,
+                        appCodeTrace.tb_frame.f_code.co_name),
+                    DeprecationWarning, filename, lineno)
+            deferred.callback(e.value)
+            return deferred
+        except:
+            deferred.errback()
+            return deferred
+
+        if isinstance(result, Deferred):
+            # a deferred was yielded, get the result.
+            def gotResult(r):
+                if waiting[0]:
+                    waiting[0] = False
+                    waiting[1] = r
+                else:
+                    _inlineCallbacks(r, g, deferred, scopes)
+
+            result.addBoth(gotResult)
+            if waiting[0]:
+                # Haven't called back yet, set flag so that we get reinvoked
+                # and return from the loop
+                waiting[0] = False
+                return deferred
+
+            result = waiting[1]
+            # Reset waiting to initial values for next loop.  gotResult uses
+            # waiting, but this isn't a problem because gotResult is only
+            # executed once, and if it hasn't been executed yet, the return
+            # branch above would have been taken.
+
+
+            waiting[0] = True
+            waiting[1] = None
+
+
+    return deferred
+
+
+
+def inlineCallbacks(f):
+    """
+    WARNING: this function will not work in Python 2.4 and earlier!
+
+    inlineCallbacks helps you write Deferred-using code that looks like a
+    regular sequential function. This function uses features of Python 2.5
+    generators.  If you need to be compatible with Python 2.4 or before, use
+    the L{deferredGenerator} function instead, which accomplishes the same
+    thing, but with somewhat more boilerplate.  For example::
+
+        def thingummy():
+            thing = yield makeSomeRequestResultingInDeferred()
+            print thing #the result! hoorj!
+        thingummy = inlineCallbacks(thingummy)
+
+    When you call anything that results in a L{Deferred}, you can simply yield it;
+    your generator will automatically be resumed when the Deferred's result is
+    available. The generator will be sent the result of the L{Deferred} with the
+    'send' method on generators, or if the result was a failure, 'throw'.
+
+    Your inlineCallbacks-enabled generator will return a L{Deferred} object, which
+    will result in the return value of the generator (or will fail with a
+    failure object if your generator raises an unhandled exception). Note that
+    you can't use C{return result} to return a value; use C{returnValue(result)}
+    instead. Falling off the end of the generator, or simply using C{return}
+    will cause the L{Deferred} to have a result of C{None}.
+
+    The L{Deferred} returned from your deferred generator may errback if your
+    generator raised an exception::
+
+        def thingummy():
+            thing = yield makeSomeRequestResultingInDeferred()
+            if thing == 'I love Twisted':
+                # will become the result of the Deferred
+                returnValue('TWISTED IS GREAT!')
+            else:
+                # will trigger an errback
+                raise Exception('DESTROY ALL LIFE')
+        thingummy = inlineCallbacks(thingummy)
+    """
+    def unwindGenerator(*args, **kwargs):
+        return _inlineCallbacks(None, f(*args, **kwargs), Deferred(),
+                                _scopes[:])
+    return mergeFunctionMetadata(f, unwindGenerator)
+
+
+## DeferredLock/DeferredQueue
+
+class _WaiterQueue(object):
+    """
+    A first-in, first-out queue of waiting L{Deferred}s, any of which can
+    be removed in constant time.
+
+    Removed L{Deferred}s are only marked as removed, and are dropped when
+    they reach the front of the queue, or when they make up more than half
+    of it.  The front of the queue is never a removed L{Deferred}.
+    """
+
+    def __init__(self):
+        self._queue = collections.deque()
+        self._removed = set()
+
+
+    def __len__(self):
+        return len(self._queue) - len(self._removed)
+
+
+    def __nonzero__(self):
+        return bool(self._queue)
+
+
+    def __iter__(self):
+        removed = self._removed
+        for d in self._queue:
+            if d not in removed:
+                yield d
+
+
+    def append(self, d):
+        self._queue.append(d)
+
+
+    def popleft(self):
+        d = self._queue.popleft()
+        if self._removed:
+            self._trim()
+        return d
+
+
+    def remove(self, d):
+        """
+        Remove C{d}, which must be in the queue.
+        """
+        self._removed.add(d)
+        self._trim()
+
+
+    def _trim(self):
+        """
+        Drop removed L{Deferred}s from the front of the queue, and from the
+        whole queue if they make up more than half of it.
+        """
+        queue = self._queue
+        removed = self._removed
+        while queue and queue[0] in removed:
+            removed.remove(queue.popleft())
+        if len(removed) > len(queue) // 2:
+            self._queue = collections.deque(
+                [d for d in queue if d not in removed])
+            removed.clear()
+
+
+
+class _ConcurrencyPrimitive(object):
+    def __init__(self):
+        self.waiting = _WaiterQueue()
+
+
+    def _releaseAndReturn(self, r, release=None):
+        if release is None:
+            release = self.release
+        release()
+        return r
+
+
+    def _tryAcquire(self):
+        """
+        Acquire without waiting, if that is possible.
+
+        @return: C{True} if acquired, C{False} if L{acquire} would have to
+            wait.
+        """
+        return False
+
+
+    def run(*args, **kwargs):
+        """
+        Acquire, run, release.
+
+        This function takes a callable as its first argument and any
+        number of other positional and keyword arguments.  When the
+        lock or semaphore is acquired, the callable will be invoked
+        with those arguments.
+
+        The callable may return a L{Deferred}; if it does, the lock or
+        semaphore won't be released until that L{Deferred} fires.
+
+        When the lock or semaphore is free, the callable is called straight
+        away without going through L{acquire}; only when it is not is a
+        L{Deferred} made to wait for it.
+
+        @return: L{Deferred} of function result.
+        """
+        if len(args) < 2:
+            if not args:
+                raise TypeError("run() takes at least 2 arguments, none given.")
+            raise TypeError("%s.run() takes at least 2 arguments, 1 given" % (
+                args[0].__class__.__name__,))
+        self, f = args[:2]
+        return self._run(self._tryAcquire, self.acquire, self.release,
+                         f, args[2:], kwargs)
+
+
+    def _run(self, tryAcquire, acquire, release, f, args, kwargs):
+        """
+        Implement L{run} with the given functions to acquire and release.
+        """
+        if tryAcquire():
+            try:
+                result = f(*args, **kwargs)
+            except:
+                release()
+                return fail()
+            if isinstance(result, Deferred):
+                result.addBoth(self._releaseAndReturn, release)
+                # Wait for the result by returning it from a callback, so
+                # that cancelling is forwarded to it.
+                d = Deferred()
+                d.callback(None)
+                d.addCallback(lambda ignored: result)
+                return d
+            release()
+            if isinstance(result, failure.Failure):
+                return fail(result)
+            return succeed(result)
+
+        scope = None
+        if _scopes:
+            scope = _scopes[-1]
+
+        def execute(ignoredResult):
+            if scope is not None:
+                _scopes.append(scope)
+            try:
+                d = maybeDeferred(f, *args, **kwargs)
+            finally:
+                if scope is not None:
+                    _scopes.pop()
+            d.addBoth(self._releaseAndReturn, release)
+            return d
+
+        d = acquire()
+        d.addCallback(execute)
+        return d
+
+
+
+class DeferredLock(_ConcurrencyPrimitive):
+    """
+    A lock for event driven systems.
+
+    @ivar locked: C{True} when this Lock has been acquired, false at all
+    other times.  Do not change this value, but it is useful to
+    examine for the equivalent of a "non-blocking" acquisition.
+    """
+
+    locked = 0
+
+
+    def _cancelAcquire(self, d):
+        """
+        Remove a deferred d from our waiting list, as the deferred has been
+        canceled.
+
+        Note: We do not need to wrap this in a try/except to catch d not
+        being in self.waiting because this canceller will not be called if
+        d has fired. release() pops a deferred out of self.waiting and
+        calls it, so the canceller will no longer be called.
+
+        @param d: The deferred that has been canceled.
+        """
+        self.waiting.remove(d)
+
+
+    def _tryAcquire(self):
+        if self.locked:
+            return False
+        self.locked = 1
+        return True
+
+
+    def acquire(self):
+        """
+        Attempt to acquire the lock.  Returns a L{Deferred} that fires on
+        lock acquisition with the L{DeferredLock} as the value.  If the lock
+        is locked, then the Deferred is placed at the end of a waiting list.
+
+        @return: a L{Deferred} which fires on lock acquisition.
+        @rtype: a L{Deferred}
+        """
+        d = Deferred(canceller=self._cancelAcquire)
+        if self.locked:
+            self.waiting.append(d)
+        else:
+            self.locked = 1
+            d.callback(self)
+        return d
+
+
+    def release(self):
+        """
+        Release the lock.  If there is a waiting list, then the first
+        L{Deferred} in that waiting list will be called back.
+
+        Should be called by whomever did the L{acquire}() when the shared
+        resource is free.
+        """
+        assert self.locked, "Tried to release an unlocked lock"
+        self.locked = 0
+        if self.waiting:
+            # someone is waiting to acquire lock
+            self.locked = 1
+            d = self.waiting.popleft()
+            d.callback(self)
+
+
+
+class DeferredSemaphore(_ConcurrencyPrimitive):
+    """
+    A semaphore for event driven systems.
+
+    @ivar tokens: At most this many users may acquire this semaphore at
+        once.
+    @type tokens: C{int}
+
+    @ivar limit: The difference between C{tokens} and the number of users
+        which have currently acquired this semaphore.
+    @type limit: C{int}
+    """
+
+    def __init__(self, tokens):
+        _ConcurrencyPrimitive.__init__(self)
+        if tokens < 1:
+            raise ValueError("DeferredSemaphore requires tokens >= 1")
+        self.tokens = tokens
+        self.limit = tokens
+
+
+    def _cancelAcquire(self, d):
+        """
+        Remove a deferred d from our waiting list, as the deferred has been
+        canceled.
+
+        Note: We do not need to wrap this in a try/except to catch d not
+        being in self.waiting because this canceller will not be called if
+        d has fired. release() pops a deferred out of self.waiting and
+        calls it, so the canceller will no longer be called.
+
+        @param d: The deferred that has been canceled.
+        """
+        self.waiting.remove(d)
+
+
+    def _tryAcquire(self):
+        if not self.tokens:
+            return False
+        self.tokens = self.tokens - 1
+        return True
+
+
+    def acquire(self):
+        """
+        Attempt to acquire the token.
+
+        @return: a L{Deferred} which fires on token acquisition.
+        """
+        assert self.tokens >= 0, "Internal inconsistency??  tokens should never be negative"
+        d = Deferred(canceller=self._cancelAcquire)
+        if not self.tokens:
+            self.waiting.append(d)
+        else:
+            self.tokens = self.tokens - 1
+            d.callback(self)
+        return d
+
+
+    def release(self):
+        """
+        Release the token.
+
+        Should be called by whoever did the L{acquire}() when the shared
+        resource is free.
+        """
+        assert self.tokens < self.limit, "Someone released me too many times: too many tokens!"
+        self.tokens = self.tokens + 1
+        if self.waiting:
+            # someone is waiting to acquire token
+            self.tokens = self.tokens - 1
+            d = self.waiting.popleft()
+            d.callback(self)
+
+
+
+def _median(values):
+    """
+    Return the median of a non-empty list of numbers.
+    """
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+
+class AdaptiveDeferredSemaphore(DeferredSemaphore):
+    """
+    A semaphore which adjusts its limit to how well the calls it runs are
+    going, so that it can replace a L{DeferredSemaphore} whose limit is
+    hard to choose.
+
+    The latency and outcome of each call made with L{run} are recorded.
+    Successful calls are taken in samples of C{limit} calls, or
+    C{sampleSize} if that is more, and single latencies are never judged
+    on their own, so that a noisy backend does not drive the limit down.
+    When a sample's median latency is above the latency target the limit
+    is multiplied by C{backoff}; otherwise it is raised by C{increase} if
+    at least half the limit was in use for most of the sample.  A failed
+    call lowers the limit too, at most once per C{limit} calls.  Without
+    an explicit C{latencyTarget}, the target is C{tolerance} times the
+    baseline latency, the median latency when the backend is not loaded.
+    To measure that, every C{baselineWindow} calls the limit is dropped to
+    C{minLimit} until the calls in progress and a few more have finished,
+    and then restored; the median latency of those last few calls is the
+    new baseline, and failures meanwhile lower the limit which is
+    restored.  Until the first measurement, the median of the first
+    sample is the baseline.  Calls which are cancelled are not counted.
+    Acquiring and releasing without L{run} works as for a
+    L{DeferredSemaphore} but teaches it nothing.
+
+    When the limit falls below the number of holders, the difference is
+    kept as a deficit, and that many releases are absorbed before waiters
+    are let in again.
+
+    @ivar limit: The current limit.
+    @ivar completed: The number of calls recorded.
+    @ivar failures: The number of recorded calls which failed.
+    """
+
+    def __init__(self, tokens=10, minLimit=1, maxLimit=1000,
+                 latencyTarget=None, tolerance=2.0, backoff=0.9,
+                 increase=1.0, window=100, baselineWindow=1000,
+                 sampleSize=20, timer=time.time):
+        """
+        @param tokens: The limit to start with.
+        @param minLimit: The lowest the limit can go.
+        @param maxLimit: The highest the limit can go.
+        @param latencyTarget: The latency, in seconds, above which calls
+            count as slow, or C{None} to derive it from recent latencies.
+        @param tolerance: How many times the baseline latency the median
+            of a sample may be without counting as slow, without
+            C{latencyTarget}.
+        @param backoff: What the limit is multiplied by when it is lowered.
+        @param increase: How much the limit is raised by per good sample.
+        @param window: How many recent latencies to keep for L{stats}.
+        @param baselineWindow: How many calls to make between measurements
+            of the baseline latency, without C{latencyTarget}.
+        @param sampleSize: The fewest successful calls whose median latency
+            is compared with the target.
+        @param timer: A function returning the current time in seconds.
+        """
+        DeferredSemaphore.__init__(self, tokens)
+        if not 1 <= minLimit <= tokens <= maxLimit:
+            raise ValueError("AdaptiveDeferredSemaphore requires "
+                             "1 <= minLimit <= tokens <= maxLimit")
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.latencyTarget = latencyTarget
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.increase = increase
+        self.baselineWindow = baselineWindow
+        self.sampleSize = sampleSize
+        self._timer = timer
+        self._baseline = None
+        self._untilProbe = baselineWindow
+        # The number of calls left to measure the baseline with, the
+        # latencies of the last few of them and the limit to go back to.
+        self._probe = 0
+        self._probeLatencies = []
+        self._resumeLimit = None
+        # The latencies of the current sample, and how many of its calls
+        # were made with at least half the limit in use.
+        self._sample = []
+        self._busy = 0
+        self._limit = float(tokens)
+        self._deficit = 0
+        self._sinceDecrease = tokens
+        self._latencies = collections.deque(maxlen=window)
+        self.completed = 0
+        self.failures = 0
+
+
+    def release(self):
+        """
+        Release the token, or pay off some of the deficit left by lowering
+        the limit.
+        """
+        if self._deficit:
+            self._deficit -= 1
+            return
+        DeferredSemaphore.release(self)
+
+
+    def run(*args, **kwargs):
+        """
+        Acquire, run and release, recording how long the call took and
+        whether it failed.
+
+        See L{DeferredSemaphore.run}.
+
+        @return: L{Deferred} of function result.
+        """
+        if len(args) < 2:
+            raise TypeError("run() takes at least 2 arguments")
+        self, f = args[:2]
+        return self._run(self._tryAcquire, self.acquire, self.release,
+                         self._measure, (f, args[2:], kwargs), {})
+
+
+    def _measure(self, f, args, kwargs):
+        """
+        Call C{f}, arranging for its latency and outcome to be recorded.
+        """
+        start = self._timer()
+        try:
+            result = f(*args, **kwargs)
+        except:
+            self._record(self._timer() - start, True)
+            raise
+        if isinstance(result, Deferred):
+            result.addBoth(self._recordResult, start)
+        else:
+            self._record(self._timer() - start,
+                         isinstance(result, failure.Failure))
+        return result
+
+
+    def _recordResult(self, result, start):
+        if not (isinstance(result, failure.Failure) and
+                result.check(CancelledError)):
+            self._record(self._timer() - start,
+                         isinstance(result, failure.Failure))
+        return result
+
+
+    def _record(self, latency, failed):
+        """
+        Record a call, and raise or lower the limit accordingly.
+        """
+        self.completed += 1
+        self._sinceDecrease += 1
+        self._latencies.append(latency)
+        if failed:
+            self.failures += 1
+            self._decrease()
+            if self._probe:
+                self._probeCall(None)
+            return
+        if self.latencyTarget is None and self._measureBaseline(latency):
+            return
+        sample = self._sample
+        sample.append(latency)
+        if (self.limit - self.tokens + self._deficit) * 2 >= self.limit:
+            self._busy += 1
+        if len(sample) < max(self.limit, self.sampleSize):
+            return
+        median = _median(sample)
+        # Only raise a limit which was at least half used.
+        busy = self._busy * 2 >= len(sample)
+        self._sample = []
+        self._busy = 0
+        if self._baseline is None and self.latencyTarget is None:
+            self._baseline = median
+        elif median > self.targetLatency():
+            self._decrease()
+        elif busy:
+            self._setLimit(min(self._limit + self.increase, self.maxLimit))
+
+
+    def _measureBaseline(self, latency):
+        """
+        Count a call towards the next measurement of the baseline latency,
+        starting one when it is due.
+
+        @return: C{True} if a probe is in progress, in which case the limit
+            must be left alone.
+        """
+        if self._probe:
+            self._probeCall(latency)
+            return True
+        self._untilProbe -= 1
+        if not self._untilProbe:
+            self._resumeLimit = self._limit
+            self._probe = self.limit + 10
+            self._probeLatencies = []
+            self._sample = []
+            self._busy = 0
+            self._setLimit(self.minLimit)
+            return True
+        return False
+
+
+    def _probeCall(self, latency):
+        """
+        Count a call made while measuring the baseline, and restore the
+        limit once enough have been made.  Only the last ten calls, which
+        were made at the lowered limit, are measured.
+
+        @param latency: The latency of the call, or C{None} if it failed.
+        """
+        if latency is not None and self._probe <= 10:
+            self._probeLatencies.append(latency)
+        self._probe -= 1
+        if not self._probe:
+            if self._probeLatencies:
+                self._baseline = _median(self._probeLatencies)
+            self._untilProbe = self.baselineWindow
+            self._setLimit(self._resumeLimit)
+
+
+    def _decrease(self):
+        """
+        Multiply the limit by C{backoff}, unless it was lowered too
+        recently.  While the baseline is being measured, the limit to go
+        back to afterwards is lowered instead.
+        """
+        if self._probe:
+            if self._sinceDecrease >= int(self._resumeLimit):
+                self._sinceDecrease = 0
+                self._resumeLimit = max(self._resumeLimit * self.backoff,
+                                        self.minLimit)
+        elif self._sinceDecrease >= self.limit:
+            self._sinceDecrease = 0
+            self._setLimit(max(self._limit * self.backoff, self.minLimit))
+
+
+    def _setLimit(self, limit):
+        """
+        Change the limit, letting waiters in if it has gone up, or taking
+        tokens away, and running up a deficit, if it has gone down.
+        """
+        self._limit = limit
+        change = int(limit) - self.limit
+        self.limit = int(limit)
+        if change > 0:
+            repaid = min(change, self._deficit)
+            self._deficit -= repaid
+            self.tokens += change - repaid
+            while self.tokens and self.waiting:
+                self.tokens -= 1
+                self.waiting.popleft().callback(self)
+        elif change < 0:
+            taken = min(-change, self.tokens)
+            self.tokens -= taken
+            self._deficit += -change - taken
+
+
+    def targetLatency(self):
+        """
+        Return the latency above which a call counts as slow.
+        """
+        if self.latencyTarget is not None:
+            return self.latencyTarget
+        if self._baseline is None:
+            return 0.0
+        return self._baseline * self.tolerance
+
+
+    def stats(self):
+        """
+        Return a C{dict} describing the semaphore: its current C{limit},
+        the number of calls C{inFlight} and C{waiting}, the C{completed}
+        calls and their C{failures}, and the C{latencyMean},
+        C{latencyP50}, C{latencyP99} and C{targetLatency} of recent calls,
+        in seconds.
+        """
+        latencies = sorted(self._latencies)
+        def percentile(p):
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1,
+                                 int(p / 100.0 * len(latencies)))]
+        mean = 0.0
+        if latencies:
+            mean = sum(latencies) / len(latencies)
+        return {'limit': self.limit,
+                'inFlight': self.limit - self.tokens + self._deficit,
+                'waiting': len(self.waiting), 'completed': self.completed,
+                'failures': self.failures, 'latencyMean': mean,
+                'latencyP50': percentile(50), 'latencyP99': percentile(99),
+                'targetLatency': self.targetLatency()}
+
+
+
+class DeferredRWLock(_ConcurrencyPrimitive):
+    """
+    A reader-writer lock for event driven systems.
+
+    Any number of readers may hold the lock at once, but a writer holds it
+    alone.  By default readers are let in whenever no writer holds the
+    lock, so a steady stream of readers can keep writers waiting forever;
+    with C{writerPreference}, readers also wait while a writer is waiting,
+    and waiting writers are let in before waiting readers.  Waiters of
+    each kind are let in in the order they came.
+
+    L{acquire}, L{release} and L{run} are the write side, so that this
+    lock can be used wherever a L{DeferredLock} is.
+
+    @ivar readers: The number of readers holding the lock.
+    @ivar writer: C{True} when a writer holds the lock.
+    @ivar readWaiting: The L{Deferred}s of readers waiting for the lock.
+    @ivar writeWaiting: The L{Deferred}s of writers waiting for the lock,
+        also available as C{waiting}.
+    """
+
+    writer = False
+
+    def __init__(self, writerPreference=False):
+        _ConcurrencyPrimitive.__init__(self)
+        self.writerPreference = writerPreference
+        self.readers = 0
+        self.readWaiting = _WaiterQueue()
+        self.writeWaiting = self.waiting
+
+
+    def _cancelAcquireRead(self, d):
+        """
+        Remove a deferred d from the readers' waiting list, as the deferred
+        has been canceled, and let in anyone it was keeping out.
+
+        @param d: The deferred that has been canceled.
+        """
+        self.readWaiting.remove(d)
+        self._wake()
+
+
+    def _cancelAcquire(self, d):
+        """
+        Remove a deferred d from the writers' waiting list, as the deferred
+        has been canceled, and let in anyone it was keeping out.
+
+        @param d: The deferred that has been canceled.
+        """
+        self.writeWaiting.remove(d)
+        self._wake()
+
+
+    def _tryAcquireRead(self):
+        if self.writer or (self.writerPreference and self.writeWaiting):
+            return False
+        self.readers += 1
+        return True
+
+
+    def _tryAcquireWrite(self):
+        if self.writer or self.readers or self.writeWaiting:
+            return False
+        self.writer = True
+        return True
+
+
+    def acquireRead(self):
+        """
+        Attempt to acquire the lock for reading.
+
+        @return: a L{Deferred} which fires with this lock once it has been
+            acquired for reading.
+        """
+        d = Deferred(canceller=self._cancelAcquireRead)
+        if self._tryAcquireRead():
+            d.callback(self)
+        else:
+            self.readWaiting.append(d)
+        return d
+
+
+    def acquireWrite(self):
+        """
+        Attempt to acquire the lock for writing.
+
+        @return: a L{Deferred} which fires with this lock once it has been
+            acquired for writing.
+        """
+        d = Deferred(canceller=self._cancelAcquire)
+        if self._tryAcquireWrite():
+            d.callback(self)
+        else:
+            self.writeWaiting.append(d)
+        return d
+
+
+    def releaseRead(self):
+        """
+        Release the lock after reading.
+        """
+        assert self.readers, "Tried to release a lock with no readers"
+        self.readers -= 1
+        self._wake()
+
+
+    def releaseWrite(self):
+        """
+        Release the lock after writing.
+        """
+        assert self.writer, "Tried to release a lock with no writer"
+        self.writer = False
+        self._wake()
+
+
+    def _wake(self):
+        """
+        Let in as many waiters as the lock now allows.
+        """
+        while not self.writer:
+            if (self.writeWaiting and not self.readers and
+                (self.writerPreference or not self.readWaiting)):
+                self.writer = True
+                self.writeWaiting.popleft().callback(self)
+            elif self.readWaiting and not (
+                self.writerPreference and self.writeWaiting):
+                self.readers += 1
+                self.readWaiting.popleft().callback(self)
+            else:
+                break
+
+
+    def runRead(*args, **kwargs):
+        """
+        Acquire for reading, run, release.
+
+        See L{run}.
+
+        @return: L{Deferred} of function result.
+        """
+        if len(args) < 2:
+            raise TypeError("runRead() takes at least 2 arguments")
+        self, f = args[:2]
+        return self._run(self._tryAcquireRead, self.acquireRead,
+                         self.releaseRead, f, args[2:], kwargs)
+
+
+    def runWrite(*args, **kwargs):
+        """
+        Acquire for writing, run, release.
+
+        See L{run}.
+
+        @return: L{Deferred} of function result.
+        """
+        if len(args) < 2:
+            raise TypeError("runWrite() takes at least 2 arguments")
+        self, f = args[:2]
+        return self._run(self._tryAcquireWrite, self.acquireWrite,
+                         self.releaseWrite, f, args[2:], kwargs)
+
+
+    _tryAcquire = _tryAcquireWrite
+    acquire = acquireWrite
+    release = releaseWrite
+
+
+
+class _KeyedLock(DeferredLock):
+    """
+    The L{DeferredLock} for one key of a L{KeyedDeferredLock}, which takes
+    itself out of its owner once it is idle.
+    """
+
+    def __init__(self, owner, key):
+        DeferredLock.__init__(self)
+        self.owner = owner
+        self.key = key
+
+
+    def release(self):
+        DeferredLock.release(self)
+        # A release with waiters hands the lock straight to the next one,
+        # so the lock is only unlocked once nobody is waiting.  A waiter
+        # may have released it and it may have been replaced meanwhile.
+        if not self.locked:
+            locks = self.owner.locks
+            if locks.get(self.key) is self:
+                del locks[self.key]
+
+
+
+class KeyedDeferredLock(object):
+    """
+    A L{DeferredLock} for each of any number of keys.
+
+    A key's lock is created when it is first acquired and dropped as soon
+    as it has neither a holder nor waiters, so only the keys in use take up
+    memory.  With C{stripes}, keys are hashed onto at most that many locks
+    instead, which bounds the memory used but makes keys which share a
+    lock wait for each other.
+
+    @ivar locks: A C{dict} mapping each key in use, or each stripe in use,
+        to its lock.
+    @ivar peakKeys: The largest number of keys or stripes in use at once.
+    @ivar created: The number of locks created.
+    """
+
+    def __init__(self, stripes=None):
+        """
+        @param stripes: The number of locks to hash keys onto, or C{None}
+            for a lock per key.
+        """
+        if stripes is not None and stripes < 1:
+            raise ValueError("KeyedDeferredLock requires stripes >= 1")
+        self.stripes = stripes
+        self.locks = {}
+        self.peakKeys = 0
+        self.created = 0
+
+
+    def __len__(self):
+        return len(self.locks)
+
+
+    def _lockFor(self, key):
+        """
+        Return the lock for a key, creating it if necessary.
+        """
+        if self.stripes is not None:
+            key = hash(key) % self.stripes
+        lock = self.locks.get(key)
+        if lock is None:
+            lock = self.locks[key] = _KeyedLock(self, key)
+            self.created += 1
+            if len(self.locks) > self.peakKeys:
+                self.peakKeys = len(self.locks)
+        return lock
+
+
+    def acquire(self, key):
+        """
+        Attempt to acquire the lock for a key.
+
+        @return: a L{Deferred} which fires on lock acquisition.
+        """
+        return self._lockFor(key).acquire()
+
+
+    def release(self, key):
+        """
+        Release the lock for a key.
+        """
+        if self.stripes is not None:
+            key = hash(key) % self.stripes
+        lock = self.locks.get(key)
+        assert lock is not None, "Tried to release an unlocked key"
+        lock.release()
+
+
+    def locked(self, key):
+        """
+        Return C{True} if the lock for a key is held.
+        """
+        if self.stripes is not None:
+            key = hash(key) % self.stripes
+        return key in self.locks
+
+
+    def run(*args, **kwargs):
+        """
+        Acquire the lock for a key, run, release.
+
+        This function takes a key and a callable as its first arguments,
+        and any number of other positional and keyword arguments.  See
+        L{DeferredLock.run}.
+
+        @return: L{Deferred} of function result.
+        """
+        if len(args) < 3:
+            raise TypeError("KeyedDeferredLock.run() takes at least 3 "
+                            "arguments, %d given" % (len(args),))
+        self, key, f = args[:3]
+        return self._lockFor(key).run(f, *args[3:], **kwargs)
+
+
+    def stats(self):
+        """
+        Return a C{dict} describing the locks: the number of C{activeKeys}
+        (or stripes) in use, the C{peakKeys} in use at once, the number of
+        callers C{waiting} and the number of locks C{created}.
+        """
+        waiting = 0
+        for lock in self.locks.itervalues():
+            waiting += len(lock.waiting)
+        return {'activeKeys': len(self.locks), 'peakKeys': self.peakKeys,
+                'waiting': waiting, 'created': self.created}
+
+
+
+class QueueOverflow(Exception):
+    pass
+
+
+
+class QueueUnderflow(Exception):
+    pass
+
+
+
+class DeferredQueue(object):
+    """
+    An event driven queue.
+
+    Objects may be added as usual to this queue.  When an attempt is
+    made to retrieve an object when the queue is empty, a L{Deferred} is
+    returned which will fire when an object becomes available.
+
+    @ivar size: The maximum number of objects to allow into the queue
+    at a time.  When an attempt to add a new object would exceed this
+    limit, L{QueueOverflow} is raised synchronously.  C{None} for no limit.
+
+    @ivar backlog: The maximum number of L{Deferred} gets to allow at
+    one time.  When an attempt is made to get an object which would
+    exceed this limit, L{QueueUnderflow} is raised synchronously.  C{None}
+    for no limit.
+    """
+
+    def __init__(self, size=None, backlog=None):
+        self.waiting = _WaiterQueue()
+        self.pending = collections.deque()
+        self.size = size
+        self.backlog = backlog
+
+
+    def _cancelGet(self, d):
+        """
+        Remove a deferred d from our waiting list, as the deferred has been
+        canceled.
+
+        Note: We do not need to wrap this in a try/except to catch d not
+        being in self.waiting because this canceller will not be called if
+        d has fired. put() pops a deferred out of self.waiting and calls
+        it, so the canceller will no longer be called.
+
+        @param d: The deferred that has been canceled.
+        """
+        self.waiting.remove(d)
+
+
+    def put(self, obj):
+        """
+        Add an object to this queue.
+
+        @raise QueueOverflow: Too many objects are in this queue.
+        """
+        if self.waiting:
+            self.waiting.popleft().callback(obj)
+        elif self.size is None or len(self.pending) < self.size:
+            self.pending.append(obj)
+        else:
+            raise QueueOverflow()
+
+
+    def get(self):
+        """
+        Attempt to retrieve and remove an object from the queue.
+
+        @return: a L{Deferred} which fires with the next object available in
+        the queue.
+
+        @raise QueueUnderflow: Too many (more than C{backlog})
+        L{Deferred}s are already waiting for an object from this queue.
+        """
+        if self.pending:
+            return succeed(self.pending.popleft())
+        elif self.backlog is None or len(self.waiting) < self.backlog:
+            d = Deferred(canceller=self._cancelGet)
+            self.waiting.append(d)
+            return d
+        else:
+            raise QueueUnderflow()
+
+
+
+class _PoolJob(object):
+    """
+    A call waiting for, or running in, a L{DeferredThreadPool}.
+
+    @ivar state: C{"queued"}, C{"running"}, C{"cancelled"} or C{"done"}.
+    """
+    __slots__ = ('f', 'args', 'kw', 'deferred', 'state')
+
+    def __init__(self, f, args, kw):
+        self.f = f
+        self.args = args
+        self.kw = kw
+        self.deferred = None
+        self.state = 'queued'
+
+
+
+class DeferredThreadPool(object):
+    """
+    Run blocking functions in a pool of threads, and get their results as
+    L{Deferred}s.
+
+    Rather than waking up the reactor once per finished call, results are
+    collected as they finish and delivered together: at most one
+    C{callFromThread} is outstanding at any time, and it fires the
+    L{Deferred}s of every call which finished before it ran.
+
+    Cancelling the L{Deferred} of a call which has not started yet removes
+    it from the queue.  A call which has started cannot be interrupted, so
+    its L{Deferred} fails with L{CancelledError} and the eventual result is
+    discarded.
+
+    @ivar threads: The number of worker threads.
+    """
+
+    def __init__(self, threads=4, reactor=None):
+        """
+        @param threads: The number of worker threads.
+        @param reactor: The object used to deliver results to the reactor
+            thread, which must have a C{callFromThread} method.  By default
+            the reactor.  This is parameterized for testing.
+        """
+        if threads < 1:
+            raise ValueError("DeferredThreadPool requires threads >= 1")
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self.threads = threads
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._queued = 0
+        self._busy = 0
+        self._busyTime = 0.0
+        self._startTime = None
+        self._finished = []
+        self._deliveryScheduled = False
+        self._workers = []
+        self._stopping = False
+        self.completed = 0
+        self.deliveries = 0
+
+
+    def start(self):
+        """
+        Start the worker threads.
+        """
+        assert not self._workers, "DeferredThreadPool already started."
+        self._stopping = False
+        self._startTime = time.time()
+        for i in xrange(self.threads):
+            worker = threading.Thread(target=self._work,
+                                      name='DeferredThreadPool-%d' % (i,))
+            self._workers.append(worker)
+            worker.start()
+
+
+    def stop(self):
+        """
+        Wait for the queued calls to finish, then stop the worker threads.
+        """
+        self._condition.acquire()
+        try:
+            self._stopping = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+
+    def run(self, f, *args, **kw):
+        """
+        Call C{f(*args, **kw)} in a worker thread.
+
+        @return: A L{Deferred} which fires with the result of the call, or
+            fails with the exception it raised.
+        """
+        return self._enqueue(_PoolJob(f, args, kw))
+
+
+    def _enqueue(self, job):
+        """
+        Add a job to the queue.
+
+        @return: The L{Deferred} for the job.
+        """
+        job.deferred = Deferred(lambda d: self._cancelJob(job))
+        self._condition.acquire()
+        try:
+            self._queue.append(job)
+            self._queued += 1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+        return job.deferred
+
+
+    def _cancelJob(self, job):
+        """
+        Take a job out of the queue, if it has not started yet.  Cancelled
+        jobs are skipped by the workers rather than searched for here.
+        """
+        self._condition.acquire()
+        try:
+            if job.state == 'queued':
+                job.state = 'cancelled'
+                self._queued -= 1
+        finally:
+            self._condition.release()
+
+
+    def _work(self):
+        """
+        The main loop of a worker thread.
+        """
+        worker = self._workerStarted()
+        try:
+            self._workLoop(worker)
+        finally:
+            self._workerStopped(worker)
+
+
+    def _workLoop(self, worker):
+        """
+        Run jobs from the queue until the pool is stopped.
+        """
+        condition = self._condition
+        while True:
+            condition.acquire()
+            try:
+                while True:
+                    if self._queue:
+                        job = self._queue.popleft()
+                        if job.state == 'queued':
+                            break
+                    elif self._stopping:
+                        return
+                    else:
+                        condition.wait()
+                job.state = 'running'
+                self._queued -= 1
+                self._busy += 1
+            finally:
+                condition.release()
+
+            start = time.time()
+            try:
+                result = self._execute(worker, job)
+            except:
+                result = Deferred._failureType()
+            elapsed = time.time() - start
+
+            condition.acquire()
+            try:
+                job.state = 'done'
+                self._busy -= 1
+                self._busyTime += elapsed
+                self._finished.append((job, result))
+                schedule = not self._deliveryScheduled
+                self._deliveryScheduled = True
+            finally:
+                condition.release()
+            if schedule:
+                self._reactor.callFromThread(self._deliver)
+
+
+    def _workerStarted(self):
+        """
+        Set up a worker thread.  Subclasses may override this.
+
+        @return: Whatever L{_execute} needs to run jobs in this thread.
+        """
+        return None
+
+
+    def _execute(self, worker, job):
+        """
+        Run a job in a worker thread.  Subclasses may override this.
+
+        @param worker: What L{_workerStarted} returned for this thread.
+        @return: The result of the job.
+        """
+        return job.f(*job.args, **job.kw)
+
+
+    def _workerStopped(self, worker):
+        """
+        Clean up a worker thread which is exiting.  Subclasses may override
+        this.
+        """
+
+
+    def _deliver(self):
+        """
+        Fire the L{Deferred}s of all the calls which have finished.  This
+        runs in the reactor thread.
+        """
+        self._condition.acquire()
+        try:
+            finished = self._finished
+            self._finished = []
+            self._deliveryScheduled = False
+        finally:
+            self._condition.release()
+        self.deliveries += 1
+        self.completed += len(finished)
+        for job, result in finished:
+            if isinstance(result, failure.Failure):
+                job.deferred.errback(result)
             else:
-                result = g.send(result)
-        except StopIteration:
-            # fell off the end, or "return" statement
-            deferred.callback(None)
-            return deferred
-        except _DefGen_Return, e:
-            # returnValue() was called; time to give a result to the original
-            # Deferred.  First though, let's try to identify the potentially
-            # confusing situation which results when returnValue() is
-            # accidentally invoked from a different function, one that wasn't
-            # decorated with @inlineCallbacks.
+                job.deferred.callback(result)
 
-            # The traceback starts in this frame (the one for
-            # _inlineCallbacks); the next one down should be the application
-            # code.
-            appCodeTrace = exc_info()[2].tb_next
-            if isFailure:
-                # If we invoked this generator frame by throwing an exception
-                # into it, then throwExceptionIntoGenerator will consume an
-                # additional stack frame itself, so we need to skip that too.
-                appCodeTrace = appCodeTrace.tb_next
-            # Now that we've identified the frame being exited by the
-            # exception, let's figure out if returnValue was called from it
-            # directly.  returnValue itself consumes a stack frame, so the
-            # application code will have a tb_next, but it will *not* have a
-            # second tb_next.
-            if appCodeTrace.tb_next.tb_next:
-                # If returnValue was invoked non-local to the frame which it is
-                # exiting, identify the frame that ultimately invoked
-                # returnValue so that we can warn the user, as this behavior is
-                # confusing.
-                ultimateTrace = appCodeTrace
-                while ultimateTrace.tb_next.tb_next:
-                    ultimateTrace = ultimateTrace.tb_next
-                filename = ultimateTrace.tb_frame.f_code.co_filename
-                lineno = ultimateTrace.tb_lineno
-                warnings.warn_explicit(
-                    "returnValue() in %r causing %r to exit: "
-                    "returnValue should only be invoked by functions decorated "
-                    "with inlineCallbacks" % (
-                        ultimateTrace.tb_frame.f_code.co_name,
-                        appCodeTrace.tb_frame.f_code.co_name),
-                    DeprecationWarning, filename, lineno)
-            deferred.callback(e.value)
-            return deferred
+
+    def queueDepth(self):
+        """
+        Return the number of calls waiting for a worker thread.
+        """
+        return self._queued
+
+
+    def stats(self):
+        """
+        Return a C{dict} describing the state of the pool: C{queued} and
+        C{busy} calls, C{threads}, C{completed} calls and the number of
+        C{deliveries} it took to deliver them, and C{utilisation}, the
+        fraction of the worker threads' time spent running calls since the
+        pool was started.
+        """
+        self._condition.acquire()
+        try:
+            queued, busy, busyTime = self._queued, self._busy, self._busyTime
+        finally:
+            self._condition.release()
+        utilisation = 0.0
+        if self._startTime is not None:
+            available = (time.time() - self._startTime) * self.threads
+            if available > 0:
+                utilisation = min(1.0, busyTime / available)
+        return {'queued': queued, 'busy': busy, 'threads': self.threads,
+                'completed': self.completed, 'deliveries': self.deliveries,
+                'utilisation': utilisation}
+
+
+
+class WorkerProcessError(Exception):
+    """
+    A L{DeferredProcessPool} worker process exited while running a call, or
+    a call raised an exception which could not be sent back.
+    """
+
+
+
+def _workerProcessMain(conn):
+    """
+    The main loop of a L{DeferredProcessPool} worker process.
+
+    Each message received is a C{(f, chunk)} pair, where C{chunk} is a list
+    of C{(args, kw)} pairs.  The reply is C{(True, results)}, or C{(False,
+    (exception, formattedTraceback))} for the first call which raised.  A
+    message of C{None} means exit.
+    """
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message is None:
+            return
+        f, chunk = message
+        try:
+            results = [f(*args, **kw) for args, kw in chunk]
         except:
-            deferred.errback()
-            return deferred
+            excType, excValue, tb = exc_info()
+            formatted = ''.join(traceback.format_exception(excType, excValue,
+                                                           tb))
+            del tb
+            try:
+                conn.send((False, (excValue, formatted)))
+            except:
+                conn.send((False, (WorkerProcessError(repr(excValue)),
+                                   formatted)))
+        else:
+            conn.send((True, results))
 
-        if isinstance(result, Deferred):
-            # a deferred was yielded, get the result.
-            def gotResult(r):
-                if waiting[0]:
-                    waiting[0] = False
-                    waiting[1] = r
-                else:
-                    _inlineCallbacks(r, g, deferred)
 
-            result.addBoth(gotResult)
-            if waiting[0]:
-                # Haven't called back yet, set flag so that we get reinvoked
-                # and return from the loop
-                waiting[0] = False
-                return deferred
 
-            result = waiting[1]
-            # Reset waiting to initial values for next loop.  gotResult uses
-            # waiting, but this isn't a problem because gotResult is only
-            # executed once, and if it hasn't been executed yet, the return
-            # branch above would have been taken.
+class _WorkerProcess(object):
+    """
+    A worker process of a L{DeferredProcessPool}, and the pipe to it.
+
+    @ivar terminated: C{True} if the process has been terminated because the
+        job it was running was cancelled.
+    """
 
+    terminated = False
 
-            waiting[0] = True
-            waiting[1] = None
+    def __init__(self):
+        self.start()
+
+
+    def start(self):
+        self.conn, childConn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_workerProcessMain,
+                                               args=(childConn,))
+        self.process.daemon = True
+        self.process.start()
+        childConn.close()
+
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except IOError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+
+    def restart(self):
+        self.process.join()
+        self.conn.close()
+        self.start()
+
+
+
+class DeferredProcessPool(DeferredThreadPool):
+    """
+    Run CPU-bound functions in a pool of processes, and get their results as
+    L{Deferred}s.
+
+    Each worker process is driven by a thread of a L{DeferredThreadPool},
+    so results are delivered to the reactor in batches in the same way.
+    Functions and their arguments and results must be picklable; in
+    particular, functions must be defined at the top level of a module.
+
+    Exceptions raised by a function are sent back and raised again, so the
+    L{failure.Failure} can be trapped as usual.  The formatted traceback from
+    the worker process is available as the C{remoteTraceback} attribute of
+    the exception.  Cancelling the L{Deferred} of a call which has not been
+    sent to a process yet skips it, and cancelling one which is running
+    terminates its worker process, which is then replaced.
+    """
+
+    def __init__(self, processes=None, reactor=None):
+        """
+        @param processes: The number of worker processes, by default the
+            number of CPUs.
+        @param reactor: See L{DeferredThreadPool.__init__}.
+        """
+        if multiprocessing is None:
+            raise ImportError(
+                "DeferredProcessPool requires the multiprocessing module")
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        DeferredThreadPool.__init__(self, processes, reactor)
+        self._running = {}
+
+
+    def run(self, f, *args, **kw):
+        """
+        Call C{f(*args, **kw)} in a worker process.
+
+        @return: A L{Deferred} which fires with the result of the call, or
+            fails with the exception it raised.
+        """
+        d = self._enqueue(_PoolJob(f, [(args, kw)], None))
+        return d.addCallback(lambda results: results[0])
+
+
+    def map(self, f, iterable, chunkSize=None):
+        """
+        Call C{f} with each item of C{iterable}, sending the calls to the
+        worker processes in chunks to save on communication.
+
+        @param chunkSize: The number of calls per chunk.  By default the
+            items are split into about four chunks per process.
+
+        @return: A L{Deferred} which fires with a list of the results in
+            order, or fails with the first exception raised, in which case
+            the chunks which have not finished are cancelled.  Cancelling it
+            cancels all the chunks.
+        """
+        calls = [((item,), {}) for item in iterable]
+        if chunkSize is None:
+            chunkSize = max(1, -(-len(calls) // (self.threads * 4)))
+        chunks = [self._enqueue(_PoolJob(f, calls[i:i + chunkSize], None))
+                  for i in xrange(0, len(calls), chunkSize)]
+
+        def cancelChunks(ignored=None):
+            for chunk in chunks:
+                chunk.cancel()
+
+        def collected(results):
+            return [result for succeeded, chunk in results for result in chunk]
+
+        def failed(reason):
+            reason.trap(FirstError)
+            cancelChunks()
+            return reason.value.subFailure
+
+        d = Deferred(cancelChunks)
+        combined = DeferredList(chunks, fireOnOneErrback=1, consumeErrors=1)
+        combined.addCallbacks(collected, failed)
+        combined.addCallbacks(d.callback, d.errback)
+        return d
+
+
+    def _cancelJob(self, job):
+        """
+        Skip a job which has not started, or terminate the worker process
+        running it.
+        """
+        DeferredThreadPool._cancelJob(self, job)
+        self._condition.acquire()
+        try:
+            worker = self._running.get(job)
+            if worker is not None:
+                worker.terminated = True
+                worker.process.terminate()
+        finally:
+            self._condition.release()
+
+
+    def _workerStarted(self):
+        return _WorkerProcess()
+
+
+    def _execute(self, worker, job):
+        self._condition.acquire()
+        try:
+            self._running[job] = worker
+        finally:
+            self._condition.release()
+        exited = False
+        try:
+            try:
+                worker.conn.send((job.f, job.args))
+                succeeded, value = worker.conn.recv()
+            except (EOFError, IOError):
+                exited = True
+        finally:
+            self._condition.acquire()
+            try:
+                del self._running[job]
+                # The job may have been cancelled after its result arrived,
+                # in which case the process was terminated all the same.
+                terminated = worker.terminated
+                worker.terminated = False
+            finally:
+                self._condition.release()
+        if exited or terminated:
+            worker.restart()
+        if exited:
+            raise WorkerProcessError("Worker process exited")
+        if succeeded:
+            return value
+        exception, formatted = value
+        exception.remoteTraceback = formatted
+        raise exception
+
+
+    def _workerStopped(self, worker):
+        worker.stop()
+
+
+
+class _Flight(object):
+    """
+    A call made by a L{DeferredCache}, and the callers waiting for it.
+
+    @ivar backend: The L{Deferred} returned by the call.
+    @ivar waiters: The L{Deferred}s given to callers who are still waiting.
+    @ivar result: The result of the call, once C{done} is set.
+    """
+
+    done = False
+    result = None
+
+    def __init__(self):
+        self.backend = None
+        self.waiters = []
+
+
+    def join(self):
+        """
+        Return a new L{Deferred} for the result of the call.
+        """
+        if self.done:
+            if isinstance(self.result, failure.Failure):
+                return fail(self.result)
+            return succeed(self.result)
+        d = Deferred(self._detach)
+        self.waiters.append(d)
+        return d
+
+
+    def _detach(self, d):
+        """
+        Stop waiting on behalf of a caller who has cancelled, and cancel the
+        call itself if nobody is waiting any more.
+        """
+        self.waiters.remove(d)
+        if not self.waiters:
+            self.backend.cancel()
+
+
+    def land(self, result):
+        """
+        Give the result of the call to everyone waiting for it.
+        """
+        self.done = True
+        self.result = result
+        waiters = self.waiters
+        self.waiters = []
+        for d in waiters:
+            if isinstance(result, failure.Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+
+class DeferredCache(object):
+    """
+    Memoize a function which returns L{Deferred}s.
+
+    Concurrent calls with the same arguments share a single call of the
+    function: each caller gets its own L{Deferred}, which fires with the
+    same result, so callbacks added by one caller never affect what another
+    sees.  Successful results are then kept, and evicted least recently used
+    first when there are more than C{maxEntries} of them or their total size
+    exceeds C{maxBytes}, or once they are older than C{ttl} seconds.
+    Failures are not kept.
+
+    A caller cancelling its L{Deferred} only stops waiting itself; the call
+    is cancelled once every caller waiting for it has cancelled.
 
+    A L{DeferredCache} with no options can be used as a decorator.
+
+    @ivar hits: The number of calls answered from the cache.
+    @ivar misses: The number of calls which called the function.
+    @ivar joins: The number of calls which waited for a call already in
+        progress.
+    """
+
+    def __init__(self, f, maxEntries=None, maxBytes=None, ttl=None,
+                 sizeOf=sys.getsizeof, key=None, clock=None):
+        """
+        @param f: The function to memoize.
+        @param maxEntries: The maximum number of results to keep, or C{None}.
+        @param maxBytes: The maximum total size of the results to keep, or
+            C{None}.
+        @param ttl: How long to keep results for, in seconds, or C{None}.
+        @param sizeOf: A function returning the size of a result in bytes.
+        @param key: A function which takes the arguments of a call and
+            returns a hashable cache key, by default the arguments
+            themselves.
+        @param clock: The L{IReactorTime} provider used to expire results,
+            by default the reactor.  This is parameterized for testing.
+        """
+        if ttl is not None and clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._f = f
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self._sizeOf = sizeOf
+        self._keyFunc = key
+        self._clock = clock
+        # Cache keys map to [expires, size, value, stamp] lists.  Each use
+        # of a key appends a (stamp, key) pair to _order and sets the
+        # entry's stamp to match, so the pairs whose stamps still match
+        # are in least recently used order; the others are skipped.
+        self._values = {}
+        self._order = collections.deque()
+        self._stamp = 0
+        self._flights = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.joins = 0
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+    def _key(self, args, kw):
+        if self._keyFunc is not None:
+            return self._keyFunc(*args, **kw)
+        if kw:
+            return args, tuple(sorted(kw.items()))
+        return args
+
+
+    def __call__(self, *args, **kw):
+        """
+        Call the function, or share a call in progress, or use a kept
+        result.
+
+        @return: A L{Deferred} which is this caller's alone.
+        """
+        key = self._key(args, kw)
+        entry = self._values.get(key)
+        if entry is not None:
+            expires, size, value, stamp = entry
+            if expires is None or expires > self._clock.seconds():
+                self._touch(key, entry)
+                self.hits += 1
+                return succeed(value)
+            self.invalidate(key)
+
+        flight = self._flights.get(key)
+        if flight is None:
+            self.misses += 1
+            flight = self._flights[key] = _Flight()
+            flight.backend = maybeDeferred(self._f, *args, **kw)
+            flight.backend.addBoth(self._landed, key, flight)
+        else:
+            self.joins += 1
+        return flight.join()
+
+
+    def _landed(self, result, key, flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not isinstance(result, failure.Failure):
+            self._store(key, result)
+        flight.land(result)
+
+
+    def _touch(self, key, entry):
+        """
+        Make C{key} the most recently used.
+        """
+        self._stamp += 1
+        entry[3] = self._stamp
+        order = self._order
+        order.append((self._stamp, key))
+        if len(order) > 2 * len(self._values) + 16:
+            values = self._values
+            self._order = collections.deque(
+                [(stamp, key) for (stamp, key) in order
+                 if key in values and values[key][3] == stamp])
+
+
+    def _evict(self):
+        """
+        Forget the least recently used result.
+        """
+        order = self._order
+        values = self._values
+        while True:
+            stamp, key = order.popleft()
+            entry = values.get(key)
+            if entry is not None and entry[3] == stamp:
+                del values[key]
+                self._bytes -= entry[1]
+                return
+
+
+    def _store(self, key, value):
+        """
+        Keep a result, evicting others to make room for it.
+        """
+        self.invalidate(key)
+        size = self._sizeOf(value)
+        if self.maxBytes is not None and size > self.maxBytes:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = self._clock.seconds() + self.ttl
+        entry = self._values[key] = [expires, size, value, None]
+        self._touch(key, entry)
+        self._bytes += size
+        while ((self.maxEntries is not None and
+                len(self._values) > self.maxEntries) or
+               (self.maxBytes is not None and self._bytes > self.maxBytes)):
+            self._evict()
+
+
+    def invalidate(self, key):
+        """
+        Forget the kept result for a cache key, if there is one.  A call in
+        progress is not affected.
+        """
+        entry = self._values.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+
+    def clear(self):
+        """
+        Forget all the kept results.
+        """
+        self._values.clear()
+        self._order.clear()
+        self._bytes = 0
+
+
+
+class _HedgedCall(object):
+    """
+    One call of a L{HedgedCaller}, and the attempts made for it.
+
+    @ivar deferred: The L{Deferred} given to the caller.
+    @ivar pending: A C{dict} mapping the number of each attempt still in
+        progress to its L{Deferred}, or C{None} once the call is over.
+    @ivar attempts: The number of attempts made so far.
+    """
+
+    timer = None
+
+    def __init__(self, caller, args, kw):
+        self.caller = caller
+        self.args = args
+        self.kw = kw
+        self.deferred = Deferred(self._cancel)
+        self.pending = {}
+        self.attempts = 0
+
+
+    def attempt(self):
+        """
+        Make another attempt, and arrange for a hedge to follow it if it
+        is slow.
+        """
+        caller = self.caller
+        number = self.attempts
+        self.attempts += 1
+        if number:
+            caller.hedges += 1
+            caller.outstandingHedges += 1
+        started = caller._scheduler.seconds()
+        d = maybeDeferred(caller._f, *self.args, **self.kw)
+        self.pending[number] = d
+        d.addBoth(self._attemptDone, number, started)
+        if self.pending is not None and self.attempts < caller.maxAttempts:
+            delay = caller.hedgeDelay()
+            if delay is not None:
+                self.timer = caller._scheduler.callLater(delay, self._hedge)
+
+
+    def _hedge(self):
+        self.timer = None
+        if self.caller._mayHedge():
+            self.attempt()
+
+
+    def _attemptDone(self, result, number, started):
+        caller = self.caller
+        if number:
+            caller.outstandingHedges -= 1
+        if self.pending is None:
+            return None
+        del self.pending[number]
+        if isinstance(result, failure.Failure):
+            if not self.pending:
+                self._finish()
+                self.deferred.errback(result)
+        else:
+            caller._observe(caller._scheduler.seconds() - started)
+            if number:
+                caller.hedgeWins += 1
+            self._finish()
+            self.deferred.callback(result)
+        return None
+
+
+    def _finish(self):
+        """
+        Stop hedging and cancel the attempts still in progress.
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending = self.pending
+        self.pending = None
+        for d in pending.values():
+            d.cancel()
+
+
+    def _cancel(self, d):
+        if self.pending is not None:
+            self._finish()
+
+
+
+class HedgedCaller(object):
+    """
+    Call a function which returns L{Deferred}s, making backup calls when
+    the first is slow.
+
+    If a call has not fired after a delay, another call with the same
+    arguments is made, and so on up to C{maxAttempts} calls.  The first
+    call to succeed provides the result and the others are cancelled.  The
+    result is a failure only when every call made has failed, in which
+    case it is the failure of the last one; a failure does not itself start
+    another call.  Cancelling the L{Deferred} returned cancels all the
+    calls in progress.
+
+    The delay is either fixed, or adapts to the given C{percentile} of the
+    latency of recent successful calls, so that only the slowest calls are
+    hedged.
+
+    @ivar calls: The number of times I have been called.
+    @ivar hedges: The number of backup calls made.
+    @ivar hedgeWins: The number of times a backup call provided the result.
+    @ivar outstandingHedges: The number of backup calls in progress.
+    """
+
+    def __init__(self, f, delay=None, percentile=None, maxAttempts=2,
+                 maxOutstandingHedges=None, window=100, minSamples=10,
+                 scheduler=None):
+        """
+        @param f: The function to call.
+        @param delay: The number of seconds to wait before making a backup
+            call, or, with C{percentile}, to use until enough latencies
+            have been seen; C{None} means not to hedge until then.
+        @param percentile: If not C{None}, the percentile (between 0 and
+            100) of recent latencies to use as the delay.
+        @param maxAttempts: The maximum number of calls, including the
+            first, made for each call of mine.
+        @param maxOutstandingHedges: The maximum number of backup calls in
+            progress at once, across all calls of mine, or C{None}.  Backup
+            calls beyond it are not made.
+        @param window: How many recent latencies to remember.
+        @param minSamples: How many latencies must be seen before
+            C{percentile} is used.
+        @param scheduler: An object which provides L{IReactorTime}, by
+            default the reactor.  This is parameterized for testing.
+        """
+        if delay is None and percentile is None:
+            raise ValueError("HedgedCaller needs a delay or a percentile")
+        if percentile is not None and not 0 < percentile <= 100:
+            raise ValueError("percentile must be between 0 and 100")
+        if scheduler is None:
+            from twisted.internet import reactor
+            scheduler = reactor
+        self._f = f
+        self.delay = delay
+        self.percentile = percentile
+        self.maxAttempts = maxAttempts
+        self.maxOutstandingHedges = maxOutstandingHedges
+        self.minSamples = minSamples
+        self._scheduler = scheduler
+        self._latencies = collections.deque(maxlen=window)
+        self.calls = 0
+        self.hedges = 0
+        self.hedgeWins = 0
+        self.outstandingHedges = 0
+
+
+    def __call__(self, *args, **kw):
+        """
+        Call the function, hedging if it is slow.
 
-    return deferred
+        @return: A L{Deferred} which fires with the result of the first
+            call to succeed.
+        """
+        self.calls += 1
+        call = _HedgedCall(self, args, kw)
+        call.attempt()
+        return call.deferred
 
 
+    def hedgeDelay(self):
+        """
+        Return the number of seconds a call is currently given before a
+        backup call is made, or C{None} if no backup call would be made.
+        """
+        if self.percentile is None or len(self._latencies) < self.minSamples:
+            return self.delay
+        latencies = sorted(self._latencies)
+        index = int(math.ceil(self.percentile / 100.0 * len(latencies))) - 1
+        return latencies[max(index, 0)]
 
-def inlineCallbacks(f):
-    """
-    WARNING: this function will not work in Python 2.4 and earlier!
 
-    inlineCallbacks helps you write Deferred-using code that looks like a
-    regular sequential function. This function uses features of Python 2.5
-    generators.  If you need to be compatible with Python 2.4 or before, use
-    the L{deferredGenerator} function instead, which accomplishes the same
-    thing, but with somewhat more boilerplate.  For example::
+    def _mayHedge(self):
+        return (self.maxOutstandingHedges is None or
+                self.outstandingHedges < self.maxOutstandingHedges)
 
-        def thingummy():
-            thing = yield makeSomeRequestResultingInDeferred()
-            print thing #the result! hoorj!
-        thingummy = inlineCallbacks(thingummy)
 
-    When you call anything that results in a L{Deferred}, you can simply yield it;
-    your generator will automatically be resumed when the Deferred's result is
-    available. The generator will be sent the result of the L{Deferred} with the
-    'send' method on generators, or if the result was a failure, 'throw'.
+    def _observe(self, latency):
+        self._latencies.append(latency)
 
-    Your inlineCallbacks-enabled generator will return a L{Deferred} object, which
-    will result in the return value of the generator (or will fail with a
-    failure object if your generator raises an unhandled exception). Note that
-    you can't use C{return result} to return a value; use C{returnValue(result)}
-    instead. Falling off the end of the generator, or simply using C{return}
-    will cause the L{Deferred} to have a result of C{None}.
 
-    The L{Deferred} returned from your deferred generator may errback if your
-    generator raised an exception::
 
-        def thingummy():
-            thing = yield makeSomeRequestResultingInDeferred()
-            if thing == 'I love Twisted':
-                # will become the result of the Deferred
-                returnValue('TWISTED IS GREAT!')
-            else:
-                # will trigger an errback
-                raise Exception('DESTROY ALL LIFE')
-        thingummy = inlineCallbacks(thingummy)
+def _failureMatcher(spec):
     """
-    def unwindGenerator(*args, **kwargs):
-        return _inlineCallbacks(None, f(*args, **kwargs), Deferred())
-    return mergeFunctionMetadata(f, unwindGenerator)
-
+    Return a function which tells whether a L{failure.Failure} matches
+    C{spec}: either exception types, checked with L{failure.Failure.check},
+    or a function which is called with the failure.
+    """
+    if isinstance(spec, (tuple, type, types.ClassType)):
+        if not isinstance(spec, tuple):
+            spec = (spec,)
+        return lambda reason: reason.check(*spec)
+    return spec
 
-## DeferredLock/DeferredQueue
 
-class _ConcurrencyPrimitive(object):
-    def __init__(self):
-        self.waiting = []
 
+class RetryBudget(object):
+    """
+    A limit on retries, shared by several L{RetryingCaller}s, so that a
+    failing backend is not sent many times its usual load.
 
-    def _releaseAndReturn(self, r):
-        self.release()
-        return r
+    Every first attempt earns C{ratio} of a retry, and every retry spends
+    one.  C{reserve} retries are available to begin with, so that callers
+    which are rarely used can still retry; the balance never exceeds
+    C{maxBalance}.
 
+    @ivar balance: The number of retries currently available.
+    """
 
-    def run(*args, **kwargs):
+    def __init__(self, ratio=0.1, reserve=10, maxBalance=None):
         """
-        Acquire, run, release.
-
-        This function takes a callable as its first argument and any
-        number of other positional and keyword arguments.  When the
-        lock or semaphore is acquired, the callable will be invoked
-        with those arguments.
+        @param ratio: The number of retries allowed per first attempt.
+        @param reserve: The number of retries available to begin with.
+        @param maxBalance: The most retries that can be saved up, by
+            default C{reserve}.
+        """
+        if maxBalance is None:
+            maxBalance = reserve
+        self.ratio = ratio
+        self.maxBalance = maxBalance
+        self.balance = float(reserve)
 
-        The callable may return a L{Deferred}; if it does, the lock or
-        semaphore won't be released until that L{Deferred} fires.
 
-        @return: L{Deferred} of function result.
+    def deposit(self):
         """
-        if len(args) < 2:
-            if not args:
-                raise TypeError("run() takes at least 2 arguments, none given.")
-            raise TypeError("%s.run() takes at least 2 arguments, 1 given" % (
-                args[0].__class__.__name__,))
-        self, f = args[:2]
-        args = args[2:]
+        Record a first attempt.
+        """
+        self.balance = min(self.balance + self.ratio, self.maxBalance)
 
-        def execute(ignoredResult):
-            d = maybeDeferred(f, *args, **kwargs)
-            d.addBoth(self._releaseAndReturn)
-            return d
 
-        d = self.acquire()
-        d.addCallback(execute)
-        return d
+    def withdraw(self):
+        """
+        Spend a retry, if one is available.
 
+        @return: C{True} if the retry may be made, C{False} otherwise.
+        """
+        if self.balance < 1:
+            return False
+        self.balance -= 1
+        return True
 
 
-class DeferredLock(_ConcurrencyPrimitive):
+
+class _RetryingCall(object):
     """
-    A lock for event driven systems.
+    One call of a L{RetryingCaller}.
 
-    @ivar locked: C{True} when this Lock has been acquired, false at all
-    other times.  Do not change this value, but it is useful to
-    examine for the equivalent of a "non-blocking" acquisition.
+    @ivar deferred: The L{Deferred} given to the caller.
+    @ivar current: The L{Deferred} of the attempt in progress, if any.
+    @ivar timer: The delayed call which will make the next attempt, if
+        one is waiting.
     """
 
-    locked = 0
+    current = None
+    timer = None
+    done = False
+
+    def __init__(self, caller, args, kw):
+        self.caller = caller
+        self.args = args
+        self.kw = kw
+        self.deferred = Deferred(self._cancel)
+        self.attempts = 0
+
+
+    def attempt(self):
+        self.timer = None
+        self.attempts += 1
+        d = self.current = maybeDeferred(self.caller._f, *self.args,
+                                         **self.kw)
+        d.addBoth(self._attemptDone)
+
+
+    def _attemptDone(self, result):
+        self.current = None
+        if self.done:
+            return None
+        caller = self.caller
+        if (isinstance(result, failure.Failure) and
+            caller._shouldRetry(result, self.attempts)):
+            caller.retries += 1
+            self.timer = caller._scheduler.callLater(
+                caller.backoff(self.attempts), self.attempt)
+            return None
+        self.done = True
+        if isinstance(result, failure.Failure):
+            self.deferred.errback(result)
+        else:
+            self.deferred.callback(result)
+        return None
 
 
-    def _cancelAcquire(self, d):
+    def _cancel(self, d):
         """
-        Remove a deferred d from our waiting list, as the deferred has been
-        canceled.
+        Stop retrying: cancel the waiting attempt or the one in progress.
+        """
+        self.done = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.current is not None:
+            self.current.cancel()
 
-        Note: We do not need to wrap this in a try/except to catch d not
-        being in self.waiting because this canceller will not be called if
-        d has fired. release() pops a deferred out of self.waiting and
-        calls it, so the canceller will no longer be called.
 
-        @param d: The deferred that has been canceled.
+
+class RetryingCaller(object):
+    """
+    Call a function which returns L{Deferred}s, retrying it when it fails.
+
+    Retries wait for an exponentially growing delay: C{initialDelay} before
+    the first, multiplied by C{factor} for each one after that, up to
+    C{maxDelay}.  With C{jitter}, up to that proportion of each delay is
+    taken off at random, so that callers which failed together do not retry
+    together.
+
+    Cancelling the L{Deferred} returned cancels the attempt in progress, or
+    stops the wait for the next one; no further attempts are made.  A
+    L{CancelledError} is never retried.
+
+    @ivar calls: The number of times I have been called.
+    @ivar retries: The number of retries made.
+    @ivar budgetExhausted: The number of retries not made because the
+        L{RetryBudget} had run out.
+    """
+
+    def __init__(self, f, maxAttempts=5, initialDelay=0.1, maxDelay=10.0,
+                 factor=2.0, jitter=1.0, retryOn=(Exception,), budget=None,
+                 scheduler=None, random=random.random):
         """
-        self.waiting.remove(d)
+        @param f: The function to call.
+        @param maxAttempts: The maximum number of attempts, including the
+            first, made for each call of mine.
+        @param initialDelay: The number of seconds to wait before the first
+            retry.
+        @param maxDelay: The longest wait between attempts, in seconds.
+        @param factor: What each delay is multiplied by for the next one.
+        @param jitter: The proportion, between 0 and 1, of each delay which
+            may be taken off at random.
+        @param retryOn: Either a tuple of exception types to retry, checked
+            with L{failure.Failure.check}, or a function which is called
+            with a L{failure.Failure} and returns whether to retry it.
+        @param budget: A L{RetryBudget}, or C{None} for no limit beyond
+            C{maxAttempts}.
+        @param scheduler: An object which provides L{IReactorTime}, by
+            default the reactor.  This is parameterized for testing.
+        @param random: A function returning a random number between 0 and
+            1.  This is parameterized for testing.
+        """
+        if scheduler is None:
+            from twisted.internet import reactor
+            scheduler = reactor
+        self._f = f
+        self.maxAttempts = maxAttempts
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.factor = factor
+        self.jitter = jitter
+        self._retryable = _failureMatcher(retryOn)
+        self.budget = budget
+        self._scheduler = scheduler
+        self._random = random
+        self.calls = 0
+        self.retries = 0
+        self.budgetExhausted = 0
 
 
-    def acquire(self):
+    def __call__(self, *args, **kw):
         """
-        Attempt to acquire the lock.  Returns a L{Deferred} that fires on
-        lock acquisition with the L{DeferredLock} as the value.  If the lock
-        is locked, then the Deferred is placed at the end of a waiting list.
+        Call the function, retrying it until it succeeds or no more
+        attempts may be made.
 
-        @return: a L{Deferred} which fires on lock acquisition.
-        @rtype: a L{Deferred}
+        @return: A L{Deferred} which fires with the result of the attempt
+            which succeeded, or the failure of the last attempt.
         """
-        d = Deferred(canceller=self._cancelAcquire)
-        if self.locked:
-            self.waiting.append(d)
-        else:
-            self.locked = 1
-            d.callback(self)
-        return d
+        self.calls += 1
+        if self.budget is not None:
+            self.budget.deposit()
+        call = _RetryingCall(self, args, kw)
+        call.attempt()
+        return call.deferred
 
 
-    def release(self):
+    def backoff(self, attempts):
         """
-        Release the lock.  If there is a waiting list, then the first
-        L{Deferred} in that waiting list will be called back.
-
-        Should be called by whomever did the L{acquire}() when the shared
-        resource is free.
+        Return the number of seconds to wait after the given number of
+        failed attempts.
         """
-        assert self.locked, "Tried to release an unlocked lock"
-        self.locked = 0
-        if self.waiting:
-            # someone is waiting to acquire lock
-            self.locked = 1
-            d = self.waiting.pop(0)
-            d.callback(self)
+        delay = min(self.initialDelay * self.factor ** (attempts - 1),
+                    self.maxDelay)
+        return delay * (1 - self.jitter * self._random())
 
 
+    def _shouldRetry(self, reason, attempts):
+        if attempts >= self.maxAttempts or reason.check(CancelledError):
+            return False
+        if not self._retryable(reason):
+            return False
+        if self.budget is not None and not self.budget.withdraw():
+            self.budgetExhausted += 1
+            return False
+        return True
 
-class DeferredSemaphore(_ConcurrencyPrimitive):
+
+
+class CircuitOpenError(Exception):
     """
-    A semaphore for event driven systems.
+    A call was refused because a L{CircuitBreaker} is open.
 
-    @ivar tokens: At most this many users may acquire this semaphore at
-        once.
-    @type tokens: C{int}
+    @ivar retryAt: When the breaker will let calls through again, in
+        seconds of its clock.
+    """
+    def __init__(self, retryAt):
+        Exception.__init__(self, "Circuit open until %s" % (retryAt,))
+        self.retryAt = retryAt
 
-    @ivar limit: The difference between C{tokens} and the number of users
-        which have currently acquired this semaphore.
-    @type limit: C{int}
+
+
+class CircuitBreaker(object):
+    """
+    Stop calling a function which returns L{Deferred}s while it keeps
+    failing.
+
+    While I am I{closed}, calls go through and their outcomes are counted
+    over the last C{window} seconds.  Once at least C{minimumCalls} have
+    been counted and the proportion which failed reaches
+    C{failureThreshold}, I I{open}: calls fail at once with a
+    L{CircuitOpenError} instead of going through.  After C{resetTimeout}
+    seconds I am I{half-open}, and let up to C{halfOpenCalls} calls through
+    at once as probes, still refusing the rest.  When that many probes
+    have succeeded I close again; when one fails I open again.
+
+    Which failures count is decided by C{failOn}.  A L{CancelledError} is
+    never counted, and a cancelled probe makes way for another.  Calls
+    which finish after I have changed state since they started are not
+    counted either, so a slow probe cannot close me in a later half-open
+    period.  The
+    L{Deferred} returned for a call which goes through is the one returned
+    by the function, so cancelling it cancels the call.
+
+    @ivar state: L{CLOSED}, L{OPEN} or L{HALF_OPEN}.
+    @ivar calls: The number of calls which went through.
+    @ivar rejected: The number of calls refused.
     """
 
-    def __init__(self, tokens):
-        _ConcurrencyPrimitive.__init__(self)
-        if tokens < 1:
-            raise ValueError("DeferredSemaphore requires tokens >= 1")
-        self.tokens = tokens
-        self.limit = tokens
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
 
+    state = CLOSED
 
-    def _cancelAcquire(self, d):
+    def __init__(self, f, failureThreshold=0.5, minimumCalls=20,
+                 window=10.0, buckets=10, resetTimeout=30.0,
+                 halfOpenCalls=3, failOn=(Exception,), clock=None):
         """
-        Remove a deferred d from our waiting list, as the deferred has been
-        canceled.
-
-        Note: We do not need to wrap this in a try/except to catch d not
-        being in self.waiting because this canceller will not be called if
-        d has fired. release() pops a deferred out of self.waiting and
-        calls it, so the canceller will no longer be called.
+        @param f: The function to call.
+        @param failureThreshold: The proportion of calls which must fail
+            for me to open.
+        @param minimumCalls: How many calls must be counted in the window
+            before I may open.
+        @param window: How many seconds of calls to count.
+        @param buckets: How many pieces to divide the window into; calls
+            leave the count a piece at a time.
+        @param resetTimeout: How many seconds to stay open for.
+        @param halfOpenCalls: How many probes to let through at once when
+            half-open, and how many must succeed to close.
+        @param failOn: Either a tuple of exception types which count as
+            failures, checked with L{failure.Failure.check}, or a function
+            which is called with a L{failure.Failure} and returns whether
+            it counts.
+        @param clock: An object which provides L{IReactorTime}, by default
+            the reactor.  This is parameterized for testing.
+        """
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self._f = f
+        self.failureThreshold = failureThreshold
+        self.minimumCalls = minimumCalls
+        self.window = window
+        self._bucketLength = float(window) / buckets
+        self._bucketCount = buckets
+        self.resetTimeout = resetTimeout
+        self.halfOpenCalls = halfOpenCalls
+        self._counts = _failureMatcher(failOn)
+        self._clock = clock
+        # [bucket number, successes, failures] for each piece of the
+        # window, oldest first.
+        self._buckets = collections.deque()
+        self._openedAt = None
+        # Incremented on every change of state, to tell which calls
+        # started in the current one.
+        self._generation = 0
+        self._probes = 0
+        self._probeSuccesses = 0
+        self.calls = 0
+        self.rejected = 0
+
+
+    def __call__(self, *args, **kw):
+        """
+        Call the function, unless I am open.
 
-        @param d: The deferred that has been canceled.
+        @return: A L{Deferred} which fires with the result of the call, or
+            fails with L{CircuitOpenError} if it was refused.
         """
-        self.waiting.remove(d)
+        state = self._currentState()
+        if state == self.OPEN or (state == self.HALF_OPEN and
+                                  self._probes >= self.halfOpenCalls):
+            self.rejected += 1
+            return fail(CircuitOpenError(self._openedAt + self.resetTimeout))
+        probe = state == self.HALF_OPEN
+        if probe:
+            self._probes += 1
+        self.calls += 1
+        d = maybeDeferred(self._f, *args, **kw)
+        d.addBoth(self._record, probe, self._generation)
+        return d
 
 
-    def acquire(self):
-        """
-        Attempt to acquire the token.
+    def _currentState(self):
+        if (self.state == self.OPEN and
+            self._clock.seconds() >= self._openedAt + self.resetTimeout):
+            self.state = self.HALF_OPEN
+            self._generation += 1
+            self._probes = 0
+            self._probeSuccesses = 0
+        return self.state
 
-        @return: a L{Deferred} which fires on token acquisition.
+
+    def _record(self, result, probe, generation):
         """
-        assert self.tokens >= 0, "Internal inconsistency??  tokens should never be negative"
-        d = Deferred(canceller=self._cancelAcquire)
-        if not self.tokens:
-            self.waiting.append(d)
+        Count the outcome of a call which started in C{generation}, and open
+        or close accordingly.
+        """
+        if generation != self._generation:
+            return result
+        failed = isinstance(result, failure.Failure)
+        if failed and (result.check(CancelledError) or
+                       not self._counts(result)):
+            if probe:
+                self._probes -= 1
+            return result
+        if probe:
+            self._probes -= 1
+            if failed:
+                self._open()
+            else:
+                self._probeSuccesses += 1
+                if self._probeSuccesses >= self.halfOpenCalls:
+                    self._close()
         else:
-            self.tokens = self.tokens - 1
-            d.callback(self)
-        return d
+            bucket = self._bucket()
+            bucket[failed and 2 or 1] += 1
+            if failed:
+                successes, failures = self.counts()
+                total = successes + failures
+                if (total >= self.minimumCalls and
+                    failures >= self.failureThreshold * total):
+                    self._open()
+        return result
 
 
-    def release(self):
+    def _bucket(self):
         """
-        Release the token.
+        Return the bucket for now, dropping those which have left the
+        window.
+        """
+        number = int(self._clock.seconds() / self._bucketLength)
+        buckets = self._buckets
+        while buckets and buckets[0][0] <= number - self._bucketCount:
+            buckets.popleft()
+        if not buckets or buckets[-1][0] != number:
+            buckets.append([number, 0, 0])
+        return buckets[-1]
 
-        Should be called by whoever did the L{acquire}() when the shared
-        resource is free.
+
+    def counts(self):
         """
-        assert self.tokens < self.limit, "Someone released me too many times: too many tokens!"
-        self.tokens = self.tokens + 1
-        if self.waiting:
-            # someone is waiting to acquire token
-            self.tokens = self.tokens - 1
-            d = self.waiting.pop(0)
-            d.callback(self)
+        Return the numbers of successes and failures counted in the
+        window.
+        """
+        self._bucket()
+        successes = failures = 0
+        for number, s, f in self._buckets:
+            successes += s
+            failures += f
+        return successes, failures
 
 
+    def _open(self):
+        self.state = self.OPEN
+        self._generation += 1
+        self._openedAt = self._clock.seconds()
+        self._buckets.clear()
 
-class QueueOverflow(Exception):
-    pass
 
+    def _close(self):
+        self.state = self.CLOSED
+        self._generation += 1
+        self._buckets.clear()
 
 
-class QueueUnderflow(Exception):
-    pass
+    def stats(self):
+        """
+        Return a C{dict} describing the breaker: its C{state}, the
+        C{successes} and C{failures} counted in the window, and the numbers
+        of C{calls} let through and C{rejected}.
+        """
+        successes, failures = self.counts()
+        return {'state': self._currentState(), 'successes': successes,
+                'failures': failures, 'calls': self.calls,
+                'rejected': self.rejected}
 
 
 
-class DeferredQueue(object):
+class _BatchEntry(object):
     """
-    An event driven queue.
+    An item waiting to be sent by a L{DeferredBatcher}, and the
+    L{Deferred}s of the callers who added it.
+    """
+    __slots__ = ('item', 'waiters', 'sent')
 
-    Objects may be added as usual to this queue.  When an attempt is
-    made to retrieve an object when the queue is empty, a L{Deferred} is
-    returned which will fire when an object becomes available.
+    def __init__(self, item):
+        self.item = item
+        self.waiters = []
+        self.sent = False
 
-    @ivar size: The maximum number of objects to allow into the queue
-    at a time.  When an attempt to add a new object would exceed this
-    limit, L{QueueOverflow} is raised synchronously.  C{None} for no limit.
 
-    @ivar backlog: The maximum number of L{Deferred} gets to allow at
-    one time.  When an attempt is made to get an object which would
-    exceed this limit, L{QueueUnderflow} is raised synchronously.  C{None}
-    for no limit.
-    """
 
-    def __init__(self, size=None, backlog=None):
-        self.waiting = []
-        self.pending = []
-        self.size = size
-        self.backlog = backlog
+class DeferredBatcher(object):
+    """
+    Collect items into batches for a function which handles many at once.
+
+    Each caller of L{add} gets a L{Deferred} for its own item.  A batch is
+    sent once it holds C{maxSize} items, or C{maxDelay} seconds after its
+    first item was added, whichever comes first.  The bulk function is
+    called with a list of the items and must return, or return a
+    L{Deferred} of, a list of their results in the same order; a result
+    may be a L{failure.Failure}, which fails just that item.  If the bulk
+    function fails, or returns something other than a list of as many
+    results as there were items, every item in the batch fails.
+
+    With C{coalesce}, an item equal to one already waiting in the batch is
+    not added again, and both callers get its result.
+
+    Cancelling the L{Deferred} for an item takes it out of the batch if
+    the batch has not been sent yet; otherwise the caller just stops
+    waiting for it.
+
+    @ivar batches: The number of batches sent.
+    @ivar items: The number of items sent.
+    """
 
+    _timer = None
 
-    def _cancelGet(self, d):
+    def __init__(self, bulk, maxSize=100, maxDelay=0.01, coalesce=False,
+                 scheduler=None):
         """
-        Remove a deferred d from our waiting list, as the deferred has been
-        canceled.
+        @param bulk: The function to call with each batch.
+        @param maxSize: The most items to put in a batch.
+        @param maxDelay: The longest to hold an item before sending it, in
+            seconds, or C{None} to wait for the batch to fill or for
+            L{flush}.
+        @param coalesce: Whether to send equal items only once per batch.
+            They must be hashable.
+        @param scheduler: An object which provides L{IReactorTime}, by
+            default the reactor.  This is parameterized for testing.
+        """
+        if maxSize < 1:
+            raise ValueError("DeferredBatcher requires maxSize >= 1")
+        if scheduler is None and maxDelay is not None:
+            from twisted.internet import reactor
+            scheduler = reactor
+        self._bulk = bulk
+        self.maxSize = maxSize
+        self.maxDelay = maxDelay
+        self.coalesce = coalesce
+        self._scheduler = scheduler
+        self._entries = []
+        self._byItem = {}
+        self.batches = 0
+        self.items = 0
 
-        Note: We do not need to wrap this in a try/except to catch d not
-        being in self.waiting because this canceller will not be called if
-        d has fired. put() pops a deferred out of self.waiting and calls
-        it, so the canceller will no longer be called.
 
-        @param d: The deferred that has been canceled.
-        """
-        self.waiting.remove(d)
+    def __len__(self):
+        return len(self._entries)
 
 
-    def put(self, obj):
+    def add(self, item):
         """
-        Add an object to this queue.
+        Add an item to the next batch.
 
-        @raise QueueOverflow: Too many objects are in this queue.
+        @return: A L{Deferred} which fires with the result for the item.
         """
-        if self.waiting:
-            self.waiting.pop(0).callback(obj)
-        elif self.size is None or len(self.pending) < self.size:
-            self.pending.append(obj)
-        else:
-            raise QueueOverflow()
+        entry = None
+        if self.coalesce:
+            entry = self._byItem.get(item)
+        if entry is None:
+            entry = _BatchEntry(item)
+            self._entries.append(entry)
+            if self.coalesce:
+                self._byItem[item] = entry
+        d = Deferred(lambda d: self._cancel(d, entry))
+        entry.waiters.append(d)
+        if len(self._entries) >= self.maxSize:
+            self.flush()
+        elif self._timer is None and self.maxDelay is not None:
+            self._timer = self._scheduler.callLater(self.maxDelay, self.flush)
+        return d
 
 
-    def get(self):
+    def _cancel(self, d, entry):
         """
-        Attempt to retrieve and remove an object from the queue.
+        Take a cancelled caller's item out of the batch, unless it has been
+        sent or another caller is waiting for it too.
+        """
+        if entry.sent:
+            return
+        entry.waiters.remove(d)
+        if not entry.waiters:
+            self._entries.remove(entry)
+            if self.coalesce:
+                del self._byItem[entry.item]
+            if not self._entries and self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
 
-        @return: a L{Deferred} which fires with the next object available in
-        the queue.
 
-        @raise QueueUnderflow: Too many (more than C{backlog})
-        L{Deferred}s are already waiting for an object from this queue.
+    def flush(self):
         """
-        if self.pending:
-            return succeed(self.pending.pop(0))
-        elif self.backlog is None or len(self.waiting) < self.backlog:
-            d = Deferred(canceller=self._cancelGet)
-            self.waiting.append(d)
-            return d
-        else:
-            raise QueueUnderflow()
+        Send the items waiting, if there are any, without waiting for the
+        batch to fill.
+        """
+        if self._timer is not None:
+            if self._timer.active():
+                self._timer.cancel()
+            self._timer = None
+        entries = self._entries
+        if not entries:
+            return
+        self._entries = []
+        self._byItem = {}
+        for entry in entries:
+            entry.sent = True
+        self.batches += 1
+        self.items += len(entries)
+        d = maybeDeferred(self._bulk, [entry.item for entry in entries])
+        d.addCallback(self._fanOut, entries)
+        d.addErrback(self._failAll, entries)
+
+
+    def _fanOut(self, results, entries):
+        """
+        Give each caller the result for its item.
+
+        @raise TypeError: If C{results} is not a sequence.
+        @raise ValueError: If there are not as many results as items.
+        """
+        results = list(results)
+        if len(results) != len(entries):
+            raise ValueError(
+                "Bulk function returned %d results for %d items" % (
+                    len(results), len(entries)))
+        for entry, result in zip(entries, results):
+            for d in entry.waiters:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+
+    def _failAll(self, reason, entries):
+        for entry in entries:
+            for d in entry.waiters:
+                d.errback(reason)
 
 
 
@@ -1408,5 +5591,20 @@ __all__ = ["Deferred", "DeferredList", "succeed", "fail", "FAILURE", "SUCCESS",
            "waitForDeferred", "deferredGenerator", "inlineCallbacks",
            "returnValue",
            "DeferredLock", "DeferredSemaphore", "DeferredQueue",
+           "DeferredRWLock", "KeyedDeferredLock",
+           "AdaptiveDeferredSemaphore",
            "DeferredFilesystemLock", "AlreadyTryingToLockError",
+           "DeferredThreadPool", "DeferredProcessPool", "WorkerProcessError",
+           "DeferredCache", "HedgedCaller", "RetryingCaller", "RetryBudget",
+           "CircuitBreaker", "CircuitOpenError", "DeferredBatcher",
+           "DeferredQuorum", "QuorumError", "race",
+           "CallbackProfiler", "setProfiler", "getProfiler",
+           "PendingDeferredRegistry", "setPendingRegistry",
+           "getPendingRegistry",
+           "CausalTracer", "setTracer", "getTracer",
+           "CooperativeRunner", "setCooperative", "getCooperative",
+           "TimerWheel", "getTimerWheel", "setTimerWheel", "VirtualClock",
+           "CancelScope",
+           "LightweightFailure", "setLightweightFailures",
+           "getLightweightFailures",
           ]
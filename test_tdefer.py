@@ -0,0 +1,2231 @@
+"""
+Tests for tdefer.py.
+
+Run them with trial:
+
+    $ trial test_tdefer
+"""
+
+import Queue
+import gc
+import optparse
+import random
+import sys
+import time
+import weakref
+
+from twisted.trial import unittest
+
+import simulate
+import stress
+import tdefer as defer
+
+
+class TestCase(unittest.TestCase):
+    """
+    A test case with helpers for looking at the results of L{Deferred}s.
+    """
+
+    def successResultOf(self, d):
+        """
+        Return the result C{d} has succeeded with.
+        """
+        results = []
+        d.addBoth(results.append)
+        self.assertEqual(len(results), 1, "%r has not fired" % (d,))
+        if isinstance(results[0], defer.failure.Failure):
+            results[0].raiseException()
+        return results[0]
+
+
+    def failureResultOf(self, d, *errorTypes):
+        """
+        Return the L{failure.Failure} C{d} has failed with, which must be
+        one of C{errorTypes}.
+        """
+        results = []
+        d.addBoth(results.append)
+        self.assertEqual(len(results), 1, "%r has not fired" % (d,))
+        self.assertIsInstance(results[0], defer.failure.Failure)
+        self.assertTrue(results[0].check(*errorTypes), results[0])
+        return results[0]
+
+
+    def assertNoResult(self, d):
+        """
+        Assert that C{d} has no result yet.
+        """
+        results = []
+
+        def passOn(result):
+            results.append(result)
+            return result
+        d.addBoth(passOn)
+        self.assertEqual(results, [])
+
+
+
+class CancelScopeTests(TestCase):
+    """
+    Tests for L{defer.CancelScope}.
+    """
+
+    def test_scopeAcrossYield(self):
+        """
+        A scope entered by an inlineCallbacks generator and held across a
+        C{yield} does not collect L{Deferred}s created elsewhere while the
+        generator waits, and is not left on the stack of active scopes.
+        """
+        scopes = []
+        waiting = []
+
+        def g():
+            with defer.CancelScope() as scope:
+                scopes.append(scope)
+                waiting.append(defer.Deferred())
+                yield waiting[0]
+        d = defer.inlineCallbacks(g)()
+
+        self.assertEqual(defer._scopes, [])
+        unrelated = defer.Deferred()
+        scopes[0].cancel()
+        self.assertFalse(unrelated.called)
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(defer._scopes, [])
+
+
+    def test_scopeAcrossYieldInsideScope(self):
+        """
+        A generator started inside one scope, which enters another and holds
+        it across a C{yield}, leaves the outer scope active when it
+        suspends, and exits its own scope cleanly when it resumes.
+        """
+        waiting = defer.Deferred()
+        inner = []
+
+        def g():
+            with defer.CancelScope() as scope:
+                inner.append(scope)
+                yield waiting
+                later = defer.Deferred()
+            defer.returnValue([later])
+
+        with defer.CancelScope() as outer:
+            d = defer.inlineCallbacks(g)()
+            self.assertEqual(defer._scopes, [outer])
+            sibling = defer.Deferred()
+        self.assertEqual(defer._scopes, [])
+
+        waiting.callback(None)
+        self.assertEqual(defer._scopes, [])
+        [later] = self.successResultOf(d)
+        inner[0].cancel()
+        self.failureResultOf(later, defer.CancelledError)
+        self.assertFalse(sibling.called)
+        outer.cancel()
+        self.failureResultOf(sibling, defer.CancelledError)
+
+
+    def test_noErrbackUnlessCancellingSiblings(self):
+        """
+        Members only get an errback added when C{cancelSiblingsOnFailure}
+        is on.
+        """
+        with defer.CancelScope():
+            d = defer.Deferred()
+        self.assertEqual(list(d.callbacks), [])
+        with defer.CancelScope(cancelSiblingsOnFailure=True):
+            d = defer.Deferred()
+        self.assertEqual(len(d.callbacks), 1)
+
+
+
+class DeferredBatcherTests(TestCase):
+    """
+    Tests for L{defer.DeferredBatcher}.
+    """
+
+    def test_bulkReturnsNone(self):
+        """
+        If the bulk function returns something which is not a list of
+        results, every item in the batch fails with the error.
+        """
+        batcher = defer.DeferredBatcher(lambda items: None, maxDelay=None)
+        d1 = batcher.add(1)
+        d2 = batcher.add(2)
+        batcher.flush()
+        self.failureResultOf(d1, TypeError)
+        self.failureResultOf(d2, TypeError)
+
+
+    def test_bulkReturnsTooFewResults(self):
+        """
+        If the bulk function returns fewer results than there were items,
+        every item in the batch fails with L{ValueError}.
+        """
+        batcher = defer.DeferredBatcher(lambda items: items[:1],
+                                        maxDelay=None)
+        d1 = batcher.add(1)
+        d2 = batcher.add(2)
+        batcher.flush()
+        self.failureResultOf(d1, ValueError)
+        self.failureResultOf(d2, ValueError)
+
+
+    def test_results(self):
+        """
+        Each caller gets the result for its own item.
+        """
+        batcher = defer.DeferredBatcher(
+            lambda items: defer.succeed([item * 2 for item in items]),
+            maxDelay=None)
+        d1 = batcher.add(1)
+        d2 = batcher.add(2)
+        batcher.flush()
+        self.assertEqual(self.successResultOf(d1), 2)
+        self.assertEqual(self.successResultOf(d2), 4)
+
+
+
+class CausalTracerTests(TestCase):
+    """
+    Tests for L{defer.CausalTracer}.
+    """
+
+    def setUp(self):
+        self.tracer = defer.CausalTracer()
+        defer.setTracer(self.tracer)
+        self.addCleanup(defer.setTracer, None)
+
+
+    def test_resetDoesNotReuseIds(self):
+        """
+        A L{Deferred} traced before L{defer.CausalTracer.reset} is not
+        confused with one traced after it.
+        """
+        old = defer.Deferred()
+        self.tracer.reset()
+        new = defer.Deferred()
+        self.assertNotIdentical(self.tracer._node(old),
+                                self.tracer._node(new))
+        self.assertEqual(len(self.tracer.nodes), 2)
+
+
+    def test_tracersDoNotShareIds(self):
+        """
+        Installing a second tracer does not disturb the ids the first one
+        gave to L{Deferred}s.
+        """
+        d = defer.Deferred()
+        first = self.tracer._node(d)
+        second = defer.CausalTracer()
+        defer.setTracer(second)
+        defer.Deferred()
+        second._node(d)
+        self.assertIdentical(self.tracer._node(d), first)
+
+
+
+class CircuitBreakerTests(TestCase):
+    """
+    Tests for L{defer.CircuitBreaker}.
+    """
+
+    def test_lateProbe(self):
+        """
+        A probe which finishes after the half-open period it started in has
+        ended is not counted towards a later one.
+        """
+        clock = defer.VirtualClock()
+        calls = []
+
+        def f():
+            calls.append(defer.Deferred())
+            return calls[-1]
+
+        breaker = defer.CircuitBreaker(f, minimumCalls=1, resetTimeout=10,
+                                       halfOpenCalls=2, clock=clock)
+        breaker().addErrback(lambda reason: None)
+        calls[-1].errback(ValueError())
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        clock.advance(10)
+        slow = breaker()
+        slowCall = calls[-1]
+        breaker().addErrback(lambda reason: None)
+        calls[-1].errback(ValueError())
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        clock.advance(10)
+        breaker()
+        self.assertEqual(breaker.stats()['state'], breaker.HALF_OPEN)
+        slowCall.callback(None)
+        self.successResultOf(slow)
+        calls[-1].callback(None)
+        self.assertEqual(breaker.state, breaker.HALF_OPEN)
+        self.assertEqual(breaker._probes, 0)
+
+
+
+class CallbackProfilerTests(TestCase):
+    """
+    Tests for L{defer.CallbackProfiler}.
+    """
+
+    def test_classmethodName(self):
+        """
+        A classmethod is named after the class it belongs to.
+        """
+        class Owner(object):
+            def method(cls, result):
+                return result
+            method = classmethod(method)
+
+        name, location = defer._callbackKey(Owner.method)
+        self.assertTrue(name.endswith('.Owner.method'), name)
+
+
+    def test_callbacksNotKeptAlive(self):
+        """
+        Profiling a closure does not keep it alive.
+        """
+        profiler = defer.CallbackProfiler()
+        closure = lambda result: result
+        profiler.runCallback(closure, None, (), {})
+        ref = weakref.ref(closure)
+        del closure
+        gc.collect()
+        self.assertIdentical(ref(), None)
+
+
+
+class DeferredCacheTests(TestCase):
+    """
+    Tests for L{defer.DeferredCache}.
+    """
+
+    def setUp(self):
+        self.calls = []
+
+
+    def backend(self, key):
+        d = defer.Deferred()
+        self.calls.append((key, d))
+        return d
+
+
+    def test_singleFlight(self):
+        """
+        Concurrent calls with the same arguments share one call of the
+        function, and each caller gets its own L{Deferred}.
+        """
+        cache = defer.DeferredCache(self.backend)
+        d1 = cache('a')
+        d2 = cache('a')
+        self.assertEqual(len(self.calls), 1)
+        self.assertNotIdentical(d1, d2)
+        d1.addCallback(lambda result: 'changed')
+        self.calls[0][1].callback('value')
+        self.assertEqual(self.successResultOf(d1), 'changed')
+        self.assertEqual(self.successResultOf(d2), 'value')
+        self.assertEqual(self.successResultOf(cache('a')), 'value')
+        self.assertEqual((cache.misses, cache.joins, cache.hits), (1, 1, 1))
+
+
+    def test_cancelSharedFlight(self):
+        """
+        The shared call is only cancelled once every caller waiting for it
+        has cancelled.
+        """
+        cache = defer.DeferredCache(self.backend)
+        d1 = cache('a')
+        d2 = cache('a')
+        backend = self.calls[0][1]
+        d1.cancel()
+        self.failureResultOf(d1, defer.CancelledError)
+        self.assertFalse(backend.called)
+        d2.cancel()
+        self.failureResultOf(d2, defer.CancelledError)
+        self.assertTrue(backend.called)
+        self.assertEqual(len(cache), 0)
+        cache('a')
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_leastRecentlyUsed(self):
+        """
+        With C{maxEntries}, the least recently used result is evicted.
+        """
+        cache = defer.DeferredCache(defer.succeed, maxEntries=2)
+        cache('a')
+        cache('b')
+        cache('a')
+        cache('c')
+        self.assertEqual(sorted(cache._values), [('a',), ('c',)])
+
+
+    def test_oversizedResultReplacesOld(self):
+        """
+        A result too big to keep still replaces the result kept for the
+        same key.
+        """
+        cache = defer.DeferredCache(self.backend, maxBytes=10, sizeOf=len)
+        cache._store(('a',), 'small')
+        self.assertEqual(len(cache), 1)
+        cache._store(('a',), 'much too large')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache._bytes, 0)
+
+
+    def test_ttl(self):
+        """
+        Results are kept for C{ttl} seconds.
+        """
+        clock = defer.VirtualClock()
+        cache = defer.DeferredCache(self.backend, ttl=10, clock=clock)
+        cache('a')
+        self.calls[-1][1].callback(1)
+        clock.advance(9)
+        self.assertEqual(self.successResultOf(cache('a')), 1)
+        clock.advance(1)
+        cache('a')
+        self.assertEqual(len(self.calls), 2)
+
+
+
+class ConcurrencyPrimitiveRunTests(TestCase):
+    """
+    Tests for L{defer.DeferredLock.run} and L{defer.DeferredSemaphore.run}.
+    """
+
+    def primitives(self):
+        return [(defer.DeferredLock(), lambda lock: not lock.locked),
+                (defer.DeferredSemaphore(1),
+                 lambda semaphore: semaphore.tokens == 1)]
+
+
+    def test_synchronousSuccess(self):
+        """
+        A callable which returns a value is released straight away.
+        """
+        for primitive, free in self.primitives():
+            d = primitive.run(lambda: 'result')
+            self.assertEqual(self.successResultOf(d), 'result')
+            self.assertTrue(free(primitive))
+
+
+    def test_synchronousFailure(self):
+        """
+        A callable which raises is released straight away, and the
+        L{Deferred} fails with its exception.
+        """
+        for primitive, free in self.primitives():
+            d = primitive.run(lambda: 1 / 0)
+            self.failureResultOf(d, ZeroDivisionError)
+            self.assertTrue(free(primitive))
+
+
+    def test_deferredSuccess(self):
+        """
+        A callable which returns a L{Deferred} is released when it
+        succeeds.
+        """
+        for primitive, free in self.primitives():
+            inner = defer.Deferred()
+            d = primitive.run(lambda: inner)
+            self.assertFalse(free(primitive))
+            self.assertNoResult(d)
+            inner.callback('result')
+            self.assertEqual(self.successResultOf(d), 'result')
+            self.assertTrue(free(primitive))
+
+
+    def test_deferredFailure(self):
+        """
+        A callable which returns a L{Deferred} is released when it fails.
+        """
+        for primitive, free in self.primitives():
+            inner = defer.Deferred()
+            d = primitive.run(lambda: inner)
+            inner.errback(ValueError())
+            self.failureResultOf(d, ValueError)
+            self.assertTrue(free(primitive))
+
+
+    def test_cancelForwarded(self):
+        """
+        Cancelling the L{Deferred} returned by C{run} cancels the one the
+        callable returned, and releases.
+        """
+        for primitive, free in self.primitives():
+            inner = defer.Deferred()
+            d = primitive.run(lambda: inner)
+            d.cancel()
+            self.failureResultOf(d, defer.CancelledError)
+            self.assertTrue(inner.called)
+            self.assertTrue(free(primitive))
+
+
+    def test_contended(self):
+        """
+        Calls made while the primitive is held run in order once it is
+        released.
+        """
+        for primitive, free in self.primitives():
+            primitive.acquire()
+            results = []
+            for i in range(3):
+                primitive.run(results.append, i)
+            self.assertEqual(results, [])
+            primitive.release()
+            self.assertEqual(results, [0, 1, 2])
+            self.assertTrue(free(primitive))
+
+
+
+class FiredDeferredTests(TestCase):
+    """
+    Tests for the L{Deferred}s returned by L{defer.succeed} and
+    L{defer.fail}.
+    """
+
+    def test_pauseUnpause(self):
+        """
+        Pausing and unpausing a pre-fired L{Deferred} with no callbacks
+        leaves its result alone.
+        """
+        d = defer.succeed(1)
+        d.pause()
+        d.unpause()
+        self.assertEqual(self.successResultOf(d), 1)
+
+
+    def test_pausedCallbacks(self):
+        """
+        Callbacks added to a paused pre-fired L{Deferred} run when it is
+        unpaused.
+        """
+        d = defer.succeed(1)
+        d.pause()
+        results = []
+        d.addCallback(results.append)
+        self.assertEqual(results, [])
+        d.unpause()
+        self.assertEqual(results, [1])
+
+
+    def test_succeed(self):
+        """
+        Callbacks added to the result of L{defer.succeed} run at once, in
+        order.
+        """
+        d = defer.succeed(1)
+        d.addCallback(lambda result: result + 1)
+        self.assertEqual(self.successResultOf(d), 2)
+
+
+    def test_fail(self):
+        """
+        Errbacks added to the result of L{defer.fail} get its failure.
+        """
+        d = defer.fail(ValueError())
+        self.failureResultOf(d, ValueError)
+
+
+    def test_debugging(self):
+        """
+        With debugging on, L{defer.succeed} returns an ordinary
+        L{Deferred}.
+        """
+        defer.setDebugging(True)
+        self.addCleanup(defer.setDebugging, False)
+        d = defer.succeed(1)
+        self.assertIdentical(d.__class__, defer.Deferred)
+        self.assertEqual(self.successResultOf(d), 1)
+
+
+    def test_chainedToFired(self):
+        """
+        A callback returning a pre-fired L{Deferred} passes its result on.
+        """
+        d = defer.succeed(None)
+        d.addCallback(lambda ignored: defer.succeed(2))
+        self.assertEqual(self.successResultOf(d), 2)
+
+
+
+class AdaptiveDeferredSemaphoreTests(TestCase):
+    """
+    Tests for L{defer.AdaptiveDeferredSemaphore}.
+    """
+
+    def simulate(self, noise, clients=40, until=5.0, **kwargs):
+        """
+        Run C{clients} callers, each making one call after another, through
+        an L{defer.AdaptiveDeferredSemaphore} to a simulated backend which
+        is healthy up to 20 concurrent calls, with latencies of 10ms times
+        C{noise()}, for C{until} seconds of virtual time.
+
+        @return: The mean limit over the second half of the run.
+        """
+        clock = defer.VirtualClock()
+        semaphore = defer.AdaptiveDeferredSemaphore(timer=clock.seconds,
+                                                    **kwargs)
+        inFlight = [0]
+        def backend():
+            inFlight[0] += 1
+            d = defer.Deferred()
+            def done():
+                inFlight[0] -= 1
+                d.callback(None)
+            clock.callLater(0.01 * noise() * max(1.0, inFlight[0] / 20.0),
+                            done)
+            return d
+        def call(ignored=None):
+            if clock.seconds() < until:
+                semaphore.run(backend).addCallback(call)
+        for i in range(clients):
+            call()
+        limits = []
+        def sample():
+            if clock.seconds() >= until / 2:
+                limits.append(semaphore.limit)
+            if clock.seconds() < until:
+                clock.callLater(0.1, sample)
+        sample()
+        clock.run()
+        return sum(limits) / float(len(limits))
+
+
+    def test_noisyLatency(self):
+        """
+        The limit stays well above C{minLimit} when latencies are noisy but
+        the backend is not overloaded.
+        """
+        rnd = random.Random(0)
+        for noise in [lambda: rnd.uniform(0.5, 1.5),
+                      lambda: rnd.lognormvariate(0, 0.5),
+                      lambda: rnd.expovariate(1.0)]:
+            self.assertTrue(self.simulate(noise) > 10)
+
+
+    def test_latencyTarget(self):
+        """
+        With an explicit C{latencyTarget}, the limit settles where the
+        median latency reaches it.
+        """
+        rnd = random.Random(0)
+        limit = self.simulate(lambda: rnd.expovariate(1.0), clients=60,
+                              latencyTarget=0.01)
+        self.assertTrue(20 < limit < 40, limit)
+
+
+    def test_overloaded(self):
+        """
+        The limit is lowered when calls become slow.
+        """
+        clock = defer.VirtualClock()
+        semaphore = defer.AdaptiveDeferredSemaphore(
+            tokens=10, latencyTarget=1.0, sampleSize=10,
+            timer=clock.seconds)
+        def slow():
+            d = defer.Deferred()
+            clock.callLater(2.0, d.callback, None)
+            return d
+        for i in range(10):
+            semaphore.run(slow)
+        clock.run()
+        self.assertEqual(semaphore.limit, 9)
+
+
+    def test_failures(self):
+        """
+        A failed call lowers the limit, at most once per C{limit} calls.
+        """
+        semaphore = defer.AdaptiveDeferredSemaphore(tokens=10)
+        for i in range(9):
+            d = semaphore.run(lambda: defer.fail(ValueError()))
+            self.failureResultOf(d, ValueError)
+        self.assertEqual(semaphore.limit, 9)
+        d = semaphore.run(lambda: defer.fail(ValueError()))
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(semaphore.limit, 8)
+        self.assertEqual(semaphore.stats()['failures'], 10)
+
+
+    def test_probe(self):
+        """
+        Every C{baselineWindow} calls, the limit is dropped to C{minLimit}
+        while the baseline latency is measured, and then restored.
+        """
+        semaphore = defer.AdaptiveDeferredSemaphore(
+            tokens=10, baselineWindow=5, timer=lambda: 0.0)
+        for i in range(5):
+            semaphore.run(lambda: None)
+        self.assertEqual(semaphore.limit, 1)
+        for i in range(20):
+            semaphore.run(lambda: None)
+        self.assertEqual(semaphore.limit, 10)
+
+
+
+class PendingDeferredRegistryTests(TestCase):
+    """
+    Tests for L{defer.PendingDeferredRegistry}.
+    """
+
+    def setUp(self):
+        self.now = [0.0]
+        self.registry = defer.PendingDeferredRegistry(
+            clock=lambda: self.now[0])
+        defer.setPendingRegistry(self.registry)
+        self.addCleanup(defer.setPendingRegistry, None)
+
+
+    def test_firedAndCollected(self):
+        """
+        L{Deferred}s leave the registry when they are fired or garbage
+        collected.
+        """
+        first = defer.Deferred()
+        second = defer.Deferred()
+        self.assertEqual(len(self.registry), 2)
+        first.callback(None)
+        self.assertEqual(len(self.registry), 1)
+        del second
+        gc.collect()
+        self.assertEqual(len(self.registry), 0)
+
+
+    def test_oldest(self):
+        """
+        L{defer.PendingDeferredRegistry.oldest} lists pending L{Deferred}s
+        oldest first, with their ages and the sites which created them.
+        """
+        first = defer.Deferred()
+        self.now[0] = 1.0
+        second = defer.Deferred()
+        self.now[0] = 3.0
+        [(age1, site1, d1), (age2, site2, d2)] = self.registry.oldest()
+        self.assertEqual((age1, d1, age2, d2), (3.0, first, 2.0, second))
+        self.assertIn('test_oldest', site1)
+        self.assertEqual(self.registry.oldest(1), [(3.0, site1, first)])
+
+
+    def test_countBySite(self):
+        """
+        L{defer.PendingDeferredRegistry.countBySite} counts pending
+        L{Deferred}s by the site which created them.
+        """
+        many = [defer.Deferred() for i in range(3)]
+        one = defer.Deferred()
+        [(site, count), (otherSite, otherCount)] = (
+            self.registry.countBySite())
+        self.assertEqual((count, otherCount), (3, 1))
+        self.assertNotEqual(site, otherSite)
+
+
+    def test_sampling(self):
+        """
+        Only one in every C{sampleEvery} L{Deferred}s is registered.
+        """
+        registry = defer.PendingDeferredRegistry(sampleEvery=3)
+        defer.setPendingRegistry(registry)
+        pending = [defer.Deferred() for i in range(9)]
+        self.assertEqual(len(registry), 3)
+
+
+    def test_chained(self):
+        """
+        The registry knows which L{Deferred}s a pending one was chained to
+        with L{Deferred.chainDeferred}, and the reverse.
+        """
+        parent = defer.Deferred()
+        child = defer.Deferred()
+        parent.chainDeferred(child)
+        self.assertEqual(self.registry.parents(child), [parent])
+        self.assertEqual(self.registry.children(parent), [child])
+        self.assertEqual(self.registry.children(defer.succeed(None)), [])
+
+
+
+class ExtendCallbacksTests(TestCase):
+    """
+    Tests for L{Deferred.extendCallbacks}.
+    """
+
+    def stages(self, log):
+        """
+        Return stages which log what they are given, recover from a
+        failure and then fail.
+        """
+        def good(result, tag):
+            log.append((tag, result))
+            return result + 1
+        def bad(reason, tag):
+            log.append((tag, reason.type))
+            return 0
+        def fail(result):
+            raise ValueError()
+        return [(good, None, ('a',), None),
+                (None, bad, ('b',), None),
+                (fail, None, None, None),
+                (good, bad, None, {'tag': 'c'})]
+
+
+    def test_unfired(self):
+        """
+        Stages added to an unfired L{Deferred} run in order when it fires,
+        exactly as if each had been added with L{Deferred.addCallbacks}.
+        """
+        log = []
+        d = defer.Deferred()
+        self.assertIdentical(d.extendCallbacks(self.stages(log)), d)
+        d.callback(1)
+        self.assertEqual(log, [('a', 1), ('c', ValueError)])
+        self.assertEqual(self.successResultOf(d), 0)
+
+
+    def test_fired(self):
+        """
+        Stages added to a fired L{Deferred} all run at once.
+        """
+        log = []
+        d = defer.Deferred()
+        d.callback(1)
+        d.extendCallbacks(self.stages(log))
+        self.assertEqual(log, [('a', 1), ('c', ValueError)])
+        self.assertEqual(self.successResultOf(d), 0)
+
+
+    def test_failed(self):
+        """
+        A failure skips the callback of each stage until an errback
+        handles it.
+        """
+        log = []
+        d = defer.fail(KeyError())
+        d.extendCallbacks(self.stages(log))
+        self.assertEqual(log, [('b', KeyError), ('c', ValueError)])
+        self.assertEqual(self.successResultOf(d), 0)
+
+
+    def test_preFired(self):
+        """
+        Stages can be added to the L{Deferred}s returned by
+        L{defer.succeed}, which do not have a callback list of their own.
+        """
+        log = []
+        d = defer.succeed(1)
+        d.extendCallbacks(self.stages(log))
+        self.assertEqual(log, [('a', 1), ('c', ValueError)])
+        self.assertIdentical(defer.succeed(2).callbacks, ())
+
+
+
+class TimerWheelTests(TestCase):
+    """
+    Tests for L{defer.TimerWheel} and L{Deferred.addTimeout}.
+    """
+
+    def setUp(self):
+        self.clock = defer.VirtualClock()
+        # A small wheel, so that timers cascade and overflow.
+        self.wheel = defer.TimerWheel(self.clock, resolution=0.01,
+                                      slotBits=2, levels=2)
+
+
+    def test_neverEarly(self):
+        """
+        Timers fire no earlier than they are due and at most one tick late,
+        whichever level of the wheel they start in.
+        """
+        rnd = random.Random(0)
+        fired = []
+        for i in range(500):
+            delay = rnd.uniform(0, 2.0)
+            self.wheel.callLater(delay, lambda due: fired.append(
+                    (due, self.clock.seconds())), delay)
+        self.clock.run()
+        self.assertEqual(len(fired), 500)
+        self.assertEqual(len(self.wheel), 0)
+        for due, when in fired:
+            self.assertTrue(due <= when <= due + 0.01 + 1e-9, (due, when))
+
+
+    def test_cancel(self):
+        """
+        A cancelled timer never fires, even when cancelled by a timer due in
+        the same tick.
+        """
+        fired = []
+        timers = [self.wheel.callLater(delay, fired.append, delay)
+                  for delay in (0.05, 0.5, 1.5)]
+        timers[1].cancel()
+        self.assertFalse(timers[1].active())
+        timers[1].cancel()
+        pair = []
+        def cancelOther(index):
+            fired.append(index)
+            pair[1 - index].cancel()
+        pair.append(self.wheel.callLater(0.002, cancelOther, 0))
+        pair.append(self.wheel.callLater(0.003, cancelOther, 1))
+        self.clock.run()
+        self.assertEqual(len(fired), 3)
+        self.assertIn(fired[0], [0, 1])
+        self.assertEqual(fired[1:], [0.05, 1.5])
+        self.assertFalse(timers[0].active())
+
+
+    def test_reactorTimer(self):
+        """
+        The wheel only keeps a timer on its clock while it has timers.
+        """
+        timer = self.wheel.callLater(1.0, lambda: None)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        timer.cancel()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_addTimeout(self):
+        """
+        L{Deferred.addTimeout} cancels the L{Deferred} when the timeout
+        expires, failing it with L{defer.TimeoutError}.
+        """
+        cancelled = []
+        d = defer.Deferred(cancelled.append)
+        d.addTimeout(1.0, self.wheel)
+        self.clock.advance(0.99)
+        self.assertNoResult(d)
+        self.clock.advance(0.02)
+        self.assertEqual(cancelled, [d])
+        self.failureResultOf(d, defer.TimeoutError)
+
+
+    def test_addTimeoutFired(self):
+        """
+        The timeout is stopped when the L{Deferred} fires in time, and other
+        cancellation is not reported as a timeout.
+        """
+        d = defer.Deferred()
+        d.addTimeout(1.0, self.wheel)
+        d.callback(1)
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.successResultOf(d), 1)
+        d = defer.Deferred()
+        d.addTimeout(1.0, self.wheel)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(len(self.wheel), 0)
+
+
+
+class AsyncioTests(TestCase):
+    """
+    Tests for L{Deferred.asFuture} and L{Deferred.fromFuture}.
+    """
+
+    if defer.asyncio is None:
+        skip = "asyncio (or trollius) is not available"
+
+    def setUp(self):
+        self.loop = defer.asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+
+    def runOnce(self):
+        """
+        Run the event loop until the callbacks due now have been called.
+        """
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+
+
+    def test_asFutureResult(self):
+        """
+        The C{Future} returned by L{Deferred.asFuture} gets the result of
+        the L{Deferred}.
+        """
+        d = defer.Deferred()
+        future = d.asFuture(self.loop)
+        self.assertFalse(future.done())
+        d.callback(1)
+        self.assertEqual(future.result(), 1)
+        self.assertIdentical(self.successResultOf(d), None)
+
+
+    def test_asFutureFailure(self):
+        """
+        The C{Future} returned by L{Deferred.asFuture} gets the exception of
+        a failed L{Deferred}.
+        """
+        future = defer.fail(KeyError('x')).asFuture(self.loop)
+        self.assertRaises(KeyError, future.result)
+
+
+    def test_asFutureCancel(self):
+        """
+        Cancelling the C{Future} returned by L{Deferred.asFuture} cancels
+        the L{Deferred}.
+        """
+        cancelled = []
+        d = defer.Deferred(cancelled.append)
+        future = d.asFuture(self.loop)
+        future.cancel()
+        self.runOnce()
+        self.assertEqual(cancelled, [d])
+        self.assertTrue(d.called)
+
+
+    def test_fromFutureResult(self):
+        """
+        The L{Deferred} returned by L{Deferred.fromFuture} fires with the
+        result of the C{Future}, or fails with its exception.
+        """
+        future = defer.asyncio.Future(loop=self.loop)
+        d = defer.Deferred.fromFuture(future)
+        future.set_result(1)
+        self.runOnce()
+        self.assertEqual(self.successResultOf(d), 1)
+        future = defer.asyncio.Future(loop=self.loop)
+        d = defer.Deferred.fromFuture(future)
+        future.set_exception(KeyError('x'))
+        self.runOnce()
+        self.failureResultOf(d, KeyError)
+
+
+    def test_fromFutureFailureType(self):
+        """
+        The failures of L{Deferred.fromFuture} are built with the
+        L{failure.Failure} type chosen with L{defer.setLightweightFailures}.
+        """
+        defer.setLightweightFailures(True)
+        self.addCleanup(defer.setLightweightFailures, False)
+        future = defer.asyncio.Future(loop=self.loop)
+        d = defer.Deferred.fromFuture(future)
+        future.set_exception(KeyError('x'))
+        self.runOnce()
+        self.assertIsInstance(self.failureResultOf(d, KeyError),
+                              defer.LightweightFailure)
+
+
+    def test_fromFutureCancel(self):
+        """
+        Cancelling the L{Deferred} returned by L{Deferred.fromFuture}
+        cancels the C{Future}, and cancelling the C{Future} fails the
+        L{Deferred} with L{defer.CancelledError}.
+        """
+        future = defer.asyncio.Future(loop=self.loop)
+        d = defer.Deferred.fromFuture(future)
+        d.cancel()
+        self.runOnce()
+        self.assertTrue(future.cancelled())
+        self.failureResultOf(d, defer.CancelledError)
+        future = defer.asyncio.Future(loop=self.loop)
+        d = defer.Deferred.fromFuture(future)
+        future.cancel()
+        self.runOnce()
+        self.failureResultOf(d, defer.CancelledError)
+
+
+
+class FakeThreadReactor(object):
+    """
+    A reactor which keeps the calls made to it from other threads until
+    they are run with L{runCalls}.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+
+    def callFromThread(self, f, *args, **kw):
+        self.calls.append((f, args, kw))
+
+
+    def runCalls(self):
+        calls, self.calls = self.calls, []
+        for f, args, kw in calls:
+            f(*args, **kw)
+
+
+
+class DeferredThreadPoolTests(TestCase):
+    """
+    Tests for L{defer.DeferredThreadPool}.
+    """
+
+    def setUp(self):
+        self.reactor = FakeThreadReactor()
+        self.pool = defer.DeferredThreadPool(2, reactor=self.reactor)
+
+
+    def test_coalescedDelivery(self):
+        """
+        Calls which finish while a delivery is outstanding are delivered
+        with it, so one reactor call fires many L{Deferred}s.
+        """
+        ds = [self.pool.run(lambda x: x * 2, i) for i in range(10)]
+        self.pool.start()
+        self.pool.stop()
+        self.assertEqual(len(self.reactor.calls), 1)
+        self.assertNoResult(ds[0])
+        self.reactor.runCalls()
+        self.assertEqual(sorted(self.successResultOf(d) for d in ds),
+                         range(0, 20, 2))
+        stats = self.pool.stats()
+        self.assertEqual((stats['completed'], stats['deliveries']), (10, 1))
+
+
+    def test_failure(self):
+        """
+        A call which raises fails its L{Deferred}, with the
+        L{failure.Failure} type chosen with
+        L{defer.setLightweightFailures}.
+        """
+        defer.setLightweightFailures(True)
+        self.addCleanup(defer.setLightweightFailures, False)
+        d = self.pool.run(lambda: 1 / 0)
+        self.pool.start()
+        self.pool.stop()
+        self.reactor.runCalls()
+        self.assertIsInstance(self.failureResultOf(d, ZeroDivisionError),
+                              defer.LightweightFailure)
+
+
+    def test_cancelQueued(self):
+        """
+        Cancelling the L{Deferred} of a call which has not started takes it
+        out of the queue.
+        """
+        called = []
+        d = self.pool.run(called.append, 1)
+        other = self.pool.run(called.append, 2)
+        self.assertEqual(self.pool.queueDepth(), 2)
+        d.cancel()
+        self.assertEqual(self.pool.queueDepth(), 1)
+        self.failureResultOf(d, defer.CancelledError)
+        self.pool.start()
+        self.pool.stop()
+        self.reactor.runCalls()
+        self.assertEqual(called, [2])
+        self.assertEqual(self.pool.stats()['completed'], 1)
+
+
+
+def square(x):
+    """
+    Return C{x} squared, in a L{defer.DeferredProcessPool} worker.
+    """
+    return x * x
+
+
+
+def failOnSeven(x):
+    """
+    Return C{x}, or raise L{KeyError} if it is 7.
+    """
+    if x == 7:
+        raise KeyError(x)
+    return x
+
+
+
+def sleepFor(seconds):
+    """
+    Sleep, then return how long for.
+    """
+    time.sleep(seconds)
+    return seconds
+
+
+
+class ThreadPumpReactor(object):
+    """
+    A reactor which queues the calls made to it from other threads, and
+    runs them in the test's thread when asked to.
+    """
+
+    def __init__(self):
+        self.calls = Queue.Queue()
+
+
+    def callFromThread(self, f, *args, **kw):
+        self.calls.put((f, args, kw))
+
+
+    def runUntilFired(self, d):
+        """
+        Run the queued calls until C{d} has fired.
+        """
+        while not d.called:
+            f, args, kw = self.calls.get(timeout=10)
+            f(*args, **kw)
+
+
+
+class DeferredProcessPoolTests(TestCase):
+    """
+    Tests for L{defer.DeferredProcessPool}.
+    """
+
+    if defer.multiprocessing is None:
+        skip = "multiprocessing is not available"
+
+    def setUp(self):
+        self.reactor = ThreadPumpReactor()
+        self.pool = defer.DeferredProcessPool(2, reactor=self.reactor)
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+
+    def test_run(self):
+        """
+        L{defer.DeferredProcessPool.run} runs a call in a worker process.
+        """
+        d = self.pool.run(square, 9)
+        self.reactor.runUntilFired(d)
+        self.assertEqual(self.successResultOf(d), 81)
+
+
+    def test_map(self):
+        """
+        L{defer.DeferredProcessPool.map} returns the results in order,
+        whatever the chunk size.
+        """
+        for chunkSize in (None, 1, 3, 100):
+            d = self.pool.map(square, range(20), chunkSize)
+            self.reactor.runUntilFired(d)
+            self.assertEqual(self.successResultOf(d),
+                             [x * x for x in range(20)])
+
+
+    def test_remoteException(self):
+        """
+        An exception raised in a worker process fails the L{Deferred} with
+        the same exception, carrying the remote traceback.
+        """
+        d = self.pool.map(failOnSeven, range(20), 2)
+        self.reactor.runUntilFired(d)
+        reason = self.failureResultOf(d, KeyError)
+        self.assertIn('KeyError', reason.value.remoteTraceback)
+
+
+    def test_cancelRunning(self):
+        """
+        Cancelling a running call terminates its worker process, which is
+        replaced.
+        """
+        d = self.pool.run(sleepFor, 10)
+        while not self.pool._running:
+            time.sleep(0.01)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        d = self.pool.run(square, 3)
+        self.reactor.runUntilFired(d)
+        self.assertEqual(self.successResultOf(d), 9)
+
+
+
+class LightweightFailureTests(TestCase):
+    """
+    Tests for L{defer.LightweightFailure} and
+    L{defer.setLightweightFailures}.
+    """
+
+    def setUp(self):
+        defer.setLightweightFailures(True)
+        self.addCleanup(defer.setLightweightFailures, False)
+
+
+    def raiseKeyError(self, ignored=None):
+        raise KeyError('x')
+
+
+    def test_callbackFailure(self):
+        """
+        An exception raised by a callback becomes a
+        L{defer.LightweightFailure}, which can be checked and trapped by
+        class or by qualified name.
+        """
+        d = defer.succeed(None)
+        d.addCallback(self.raiseKeyError)
+        reason = self.failureResultOf(d, KeyError)
+        self.assertIsInstance(reason, defer.LightweightFailure)
+        self.assertIdentical(reason.check(LookupError), LookupError)
+        self.assertEqual(reason.check('exceptions.LookupError'),
+                         'exceptions.LookupError')
+        self.assertIdentical(reason.check(ValueError), None)
+        self.assertIdentical(reason.trap(KeyError), KeyError)
+        self.assertRaises(defer.failure.Failure, reason.trap, ValueError)
+
+
+    def test_traceback(self):
+        """
+        The traceback of a L{defer.LightweightFailure} names the frames it
+        went through, even after it has been cleaned.
+        """
+        d = defer.maybeDeferred(self.raiseKeyError)
+        reason = self.failureResultOf(d, KeyError)
+        self.assertIn('raiseKeyError', reason.getTraceback())
+        reason.cleanFailure()
+        self.assertIdentical(reason.tb, None)
+        self.assertIn('raiseKeyError', reason.getTraceback())
+        self.assertEqual(reason.frames[-1][0], 'raiseKeyError')
+
+
+    def test_inlineCallbacks(self):
+        """
+        A L{defer.LightweightFailure} is raised into an L{inlineCallbacks}
+        generator as its exception.
+        """
+        caught = []
+        def gen():
+            try:
+                yield defer.fail(KeyError('y'))
+            except KeyError, e:
+                caught.append(e.args)
+        self.successResultOf(defer.inlineCallbacks(gen)())
+        self.assertEqual(caught, [('y',)])
+
+
+    def test_construction(self):
+        """
+        A L{defer.LightweightFailure} can be built from an exception, or
+        from the current exception, but not from nothing.
+        """
+        reason = defer.LightweightFailure(KeyError('z'))
+        self.assertIdentical(reason.type, KeyError)
+        self.assertRaises(KeyError, reason.raiseException)
+        try:
+            1 / 0
+        except:
+            reason = defer.LightweightFailure()
+        self.assertIdentical(reason.type, ZeroDivisionError)
+        sys.exc_clear()
+        self.assertRaises(defer.failure.NoCurrentExceptionError,
+                          defer.LightweightFailure)
+
+
+    def test_off(self):
+        """
+        Turning lightweight failures off goes back to L{failure.Failure}.
+        """
+        defer.setLightweightFailures(False)
+        self.assertFalse(defer.getLightweightFailures())
+        reason = self.failureResultOf(
+            defer.maybeDeferred(self.raiseKeyError), KeyError)
+        self.assertNotIsInstance(reason, defer.LightweightFailure)
+
+
+
+class DeferredQuorumTests(TestCase):
+    """
+    Tests for L{defer.DeferredQuorum} and L{defer.race}.
+    """
+
+    def setUp(self):
+        self.cancelled = []
+        self.ds = [defer.Deferred(self.cancelled.append) for i in range(3)]
+
+
+    def test_race(self):
+        """
+        L{defer.race} fires with the first result and its index, and cancels
+        the losers, consuming the failures caused by that.
+        """
+        d = defer.race(self.ds)
+        self.ds[0].errback(KeyError())
+        self.ds[1].callback('b')
+        self.assertEqual(self.successResultOf(d), ('b', 1))
+        self.assertEqual(self.cancelled, [self.ds[2]])
+        self.assertIdentical(self.successResultOf(self.ds[2]), None)
+
+
+    def test_raceAllFail(self):
+        """
+        L{defer.race} fails with a L{defer.QuorumError} holding every
+        failure, in the order they happened, if all the L{Deferred}s fail.
+        """
+        d = defer.race(self.ds)
+        self.ds[2].errback(KeyError())
+        self.ds[0].errback(ValueError())
+        self.assertNoResult(d)
+        self.ds[1].errback(TypeError())
+        error = self.failureResultOf(d, defer.QuorumError).value
+        self.assertEqual([(index, reason.type)
+                          for index, reason in error.subFailures],
+                         [(2, KeyError), (0, ValueError), (1, TypeError)])
+        self.assertEqual(self.cancelled, [])
+
+
+    def test_quorum(self):
+        """
+        L{defer.DeferredQuorum} fires once C{required} L{Deferred}s have
+        succeeded, with their results in the order they succeeded, and
+        cancels the rest.
+        """
+        d = defer.DeferredQuorum(self.ds, 2)
+        self.ds[2].callback('c')
+        self.assertNoResult(d)
+        self.ds[0].callback('a')
+        self.assertEqual(self.successResultOf(d), [(2, 'c'), (0, 'a')])
+        self.assertEqual(self.cancelled, [self.ds[1]])
+        self.assertEqual(self.successResultOf(self.ds[0]), 'a')
+
+
+    def test_quorumImpossible(self):
+        """
+        L{defer.DeferredQuorum} fails as soon as too many L{Deferred}s have
+        failed for it to succeed, and cancels the rest.
+        """
+        d = defer.DeferredQuorum(self.ds, 2)
+        self.ds[1].errback(KeyError())
+        self.assertNoResult(d)
+        self.ds[0].errback(ValueError())
+        error = self.failureResultOf(d, defer.QuorumError).value
+        self.assertEqual([index for index, reason in error.subFailures],
+                         [1, 0])
+        self.assertEqual(self.cancelled, [self.ds[2]])
+        self.assertIdentical(self.successResultOf(self.ds[1]), None)
+
+
+    def test_cancel(self):
+        """
+        Cancelling a L{defer.DeferredQuorum} cancels the L{Deferred}s which
+        have not fired.
+        """
+        d = defer.DeferredQuorum(self.ds, 2)
+        self.ds[0].callback('a')
+        d.cancel()
+        self.assertEqual(self.cancelled, self.ds[1:])
+        self.failureResultOf(d, defer.CancelledError)
+
+
+    def test_required(self):
+        """
+        A L{defer.DeferredQuorum} needing no results fires at once and
+        cancels everything; one needing more than it has is an error.
+        """
+        d = defer.DeferredQuorum(self.ds, 0)
+        self.assertEqual(self.successResultOf(d), [])
+        self.assertEqual(self.cancelled, self.ds)
+        self.assertRaises(ValueError, defer.DeferredQuorum, self.ds, 4)
+
+
+
+class HedgedCallerTests(TestCase):
+    """
+    Tests for L{defer.HedgedCaller}.
+    """
+
+    def setUp(self):
+        self.clock = defer.VirtualClock()
+        self.calls = []
+        self.cancelled = []
+
+
+    def backend(self, *args):
+        """
+        Return a new L{Deferred}, remembering it and its arguments.
+        """
+        d = defer.Deferred(self.cancelled.append)
+        self.calls.append((args, d))
+        return d
+
+
+    def test_fast(self):
+        """
+        A call which fires before the delay is not hedged.
+        """
+        caller = defer.HedgedCaller(self.backend, delay=1.0,
+                                    scheduler=self.clock)
+        d = caller('x')
+        self.clock.advance(0.5)
+        self.calls[0][1].callback(1)
+        self.clock.run()
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertEqual((len(self.calls), caller.hedges), (1, 0))
+
+
+    def test_hedgeWins(self):
+        """
+        A backup call with the same arguments is made after the delay; when
+        it wins, the first call is cancelled.
+        """
+        caller = defer.HedgedCaller(self.backend, delay=1.0,
+                                    scheduler=self.clock)
+        d = caller('x')
+        self.clock.advance(1.0)
+        self.assertEqual([args for args, call in self.calls],
+                         [('x',), ('x',)])
+        self.assertEqual(caller.outstandingHedges, 1)
+        self.calls[1][1].callback(2)
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual(self.cancelled, [self.calls[0][1]])
+        self.assertEqual((caller.hedges, caller.hedgeWins,
+                          caller.outstandingHedges), (1, 1, 0))
+
+
+    def test_allFail(self):
+        """
+        The result is a failure only when every call made has failed, and
+        then it is the failure of the last one.
+        """
+        caller = defer.HedgedCaller(self.backend, delay=1.0, maxAttempts=3,
+                                    scheduler=self.clock)
+        d = caller()
+        self.clock.advance(2.0)
+        self.assertEqual(len(self.calls), 3)
+        self.calls[0][1].errback(KeyError())
+        self.calls[2][1].errback(ValueError())
+        self.assertNoResult(d)
+        self.calls[1][1].errback(TypeError())
+        self.failureResultOf(d, TypeError)
+        self.clock.run()
+        self.assertEqual(len(self.calls), 3)
+
+
+    def test_cancel(self):
+        """
+        Cancelling the result cancels every call in progress and stops
+        hedging.
+        """
+        caller = defer.HedgedCaller(self.backend, delay=1.0, maxAttempts=3,
+                                    scheduler=self.clock)
+        d = caller()
+        self.clock.advance(1.0)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(sorted(self.cancelled),
+                         sorted(call for args, call in self.calls))
+        self.clock.run()
+        self.assertEqual(len(self.calls), 2)
+
+
+    def test_maxOutstandingHedges(self):
+        """
+        No more than C{maxOutstandingHedges} backup calls are in progress
+        at once.
+        """
+        caller = defer.HedgedCaller(self.backend, delay=1.0,
+                                    maxOutstandingHedges=1,
+                                    scheduler=self.clock)
+        first, second = caller(), caller()
+        self.clock.advance(1.0)
+        self.assertEqual((len(self.calls), caller.outstandingHedges), (3, 1))
+
+
+    def test_percentile(self):
+        """
+        With a C{percentile}, the delay follows the latencies of recent
+        successful calls once enough have been seen.
+        """
+        caller = defer.HedgedCaller(self.backend, percentile=50,
+                                    minSamples=4, scheduler=self.clock)
+        self.assertIdentical(caller.hedgeDelay(), None)
+        for latency in (0.1, 0.2, 0.3, 0.4):
+            d = caller()
+            self.clock.advance(latency)
+            self.calls[-1][1].callback(None)
+        self.assertEqual(len(self.calls), 4)
+        self.assertAlmostEqual(caller.hedgeDelay(), 0.2)
+
+
+
+class RetryingCallerTests(TestCase):
+    """
+    Tests for L{defer.RetryingCaller} and L{defer.RetryBudget}.
+    """
+
+    def setUp(self):
+        self.clock = defer.VirtualClock()
+        self.attempts = []
+        self.results = []
+
+
+    def backend(self, *args):
+        """
+        Record an attempt, and fail or succeed with the next of
+        C{self.results}, or never fire if there are none left.
+        """
+        self.attempts.append((self.clock.seconds(), args))
+        if not self.results:
+            return defer.Deferred()
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        return defer.succeed(result)
+
+
+    def caller(self, **kwargs):
+        kwargs.setdefault('jitter', 0.0)
+        return defer.RetryingCaller(self.backend, scheduler=self.clock,
+                                    **kwargs)
+
+
+    def test_backoff(self):
+        """
+        Retries wait for exponentially growing delays, up to C{maxDelay},
+        until an attempt succeeds.
+        """
+        self.results = [KeyError(), KeyError(), KeyError(), KeyError(), 'ok']
+        caller = self.caller(initialDelay=1.0, maxDelay=3.0)
+        d = caller('x')
+        self.clock.run()
+        self.assertEqual(self.successResultOf(d), 'ok')
+        self.assertEqual(self.attempts, [(0.0, ('x',)), (1.0, ('x',)),
+                                         (3.0, ('x',)), (6.0, ('x',)),
+                                         (9.0, ('x',))])
+        self.assertEqual(caller.retries, 4)
+
+
+    def test_jitter(self):
+        """
+        Jitter takes up to that proportion of each delay off at random.
+        """
+        caller = self.caller(initialDelay=1.0, jitter=0.5,
+                             random=lambda: 1.0)
+        self.assertEqual(caller.backoff(1), 0.5)
+        self.assertEqual(caller.backoff(2), 1.0)
+
+
+    def test_maxAttempts(self):
+        """
+        After C{maxAttempts} attempts the failure of the last one is the
+        result.
+        """
+        self.results = [KeyError(), ValueError(), TypeError()]
+        d = self.caller(maxAttempts=2)()
+        self.clock.run()
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(len(self.attempts), 2)
+
+
+    def test_retryOn(self):
+        """
+        Only failures matching C{retryOn} are retried.
+        """
+        self.results = [KeyError(), ValueError(), 'ok']
+        d = self.caller(retryOn=(KeyError,))()
+        self.clock.run()
+        self.failureResultOf(d, ValueError)
+        self.results = [KeyError(), ValueError(), 'ok']
+        d = self.caller(retryOn=lambda reason: True)()
+        self.clock.run()
+        self.assertEqual(self.successResultOf(d), 'ok')
+
+
+    def test_cancel(self):
+        """
+        Cancelling the result stops the wait for the next attempt, or
+        cancels the attempt in progress, and no more attempts are made.
+        """
+        self.results = [KeyError()]
+        d = self.caller()()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.clock.run()
+        self.assertEqual(len(self.attempts), 1)
+        d = self.caller()()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(len(self.attempts), 2)
+
+
+    def test_budget(self):
+        """
+        A shared L{defer.RetryBudget} limits the retries of every caller
+        using it.
+        """
+        budget = defer.RetryBudget(ratio=0.5, reserve=1)
+        first = self.caller(budget=budget)
+        second = self.caller(budget=budget)
+        self.results = [KeyError(), KeyError(), KeyError()]
+        d = first()
+        self.clock.run()
+        self.failureResultOf(d, KeyError)
+        self.results = [KeyError()]
+        d = second()
+        self.clock.run()
+        self.failureResultOf(d, KeyError)
+        self.assertEqual(len(self.attempts), 3)
+        self.assertEqual((first.retries, first.budgetExhausted), (1, 1))
+        self.assertEqual((second.retries, second.budgetExhausted), (0, 1))
+
+
+
+class VirtualClockTests(TestCase):
+    """
+    Tests for L{defer.VirtualClock}.
+    """
+
+    def setUp(self):
+        self.clock = defer.VirtualClock()
+        self.log = []
+
+
+    def test_advance(self):
+        """
+        L{defer.VirtualClock.advance} makes the calls which fall due, in
+        time order and then in the order they were scheduled.
+        """
+        self.clock.callLater(2.0, self.log.append, 'c')
+        self.clock.callLater(1.0, self.log.append, 'a')
+        self.clock.callLater(1.0, self.log.append, 'b')
+        self.clock.callLater(3.0, self.log.append, 'd')
+        self.clock.advance(2.5)
+        self.assertEqual(self.log, ['a', 'b', 'c'])
+        self.assertEqual(self.clock.seconds(), 2.5)
+        self.assertEqual(len(self.clock), 1)
+        self.assertEqual(self.clock.calls, 3)
+
+
+    def test_nested(self):
+        """
+        Calls scheduled by calls are made if they fall due too, at their own
+        time.
+        """
+        def first():
+            self.log.append(self.clock.seconds())
+            self.clock.callLater(0.5, second)
+        def second():
+            self.log.append(self.clock.seconds())
+        self.clock.callLater(1.0, first)
+        self.clock.advance(2.0)
+        self.assertEqual(self.log, [1.0, 1.5])
+
+
+    def test_cancel(self):
+        """
+        Cancelled calls are not made, and are left out of
+        L{defer.VirtualClock.getDelayedCalls}.
+        """
+        call = self.clock.callLater(1.0, self.log.append, 'a')
+        other = self.clock.callLater(2.0, self.log.append, 'b')
+        self.assertEqual(call.getTime(), 1.0)
+        call.cancel()
+        call.cancel()
+        self.assertFalse(call.active())
+        self.assertEqual(self.clock.getDelayedCalls(), [other])
+        self.assertEqual(len(self.clock), 1)
+        self.assertEqual(self.clock.run(), 2.0)
+        self.assertEqual(self.log, ['b'])
+        self.assertFalse(other.active())
+
+
+    def test_simulationDeterministic(self):
+        """
+        A simulation run against a L{defer.VirtualClock} with a given seed
+        always gives the same results.
+        """
+        def run():
+            options = optparse.Values({'seed': 1, 'ops': 200, 'clients': 10,
+                                       'workers': 2, 'service': 0.01,
+                                       'think': 0.05})
+            sim = simulate.Simulation(options)
+            semaphore = defer.DeferredSemaphore(options.workers)
+            for i in range(options.clients):
+                simulate.acquireLoop(sim, semaphore, i)()
+            return sim.clock.run(), sim.waits, sim.completed
+        first = run()
+        self.assertEqual(sum(first[2]), 200)
+        self.assertEqual(run(), first)
+
+
+
+class WaiterQueueTests(TestCase):
+    """
+    Tests for cancelling the waiters of the concurrency primitives and of
+    L{defer.DeferredQueue}, which are kept in a L{defer._WaiterQueue}.
+    """
+
+    def test_cancelAnyOrder(self):
+        """
+        Waiters cancelled in any order are skipped, and the rest are let in
+        in the order they came.
+        """
+        semaphore = defer.DeferredSemaphore(1)
+        semaphore.acquire()
+        ds = [semaphore.acquire() for i in range(10)]
+        rnd = random.Random(0)
+        cancelled = rnd.sample(range(10), 6)
+        for i in cancelled:
+            ds[i].cancel()
+            self.failureResultOf(ds[i], defer.CancelledError)
+        self.assertEqual(len(semaphore.waiting), 4)
+        let = []
+        for i, d in enumerate(ds):
+            if i not in cancelled:
+                d.addCallback(lambda ignored, i=i: let.append(i))
+        for i in range(4):
+            semaphore.release()
+        self.assertEqual(let, sorted(set(range(10)) - set(cancelled)))
+
+
+    def test_compaction(self):
+        """
+        Cancelled waiters are dropped once they make up more than half of
+        the queue, so that cancelling does not leak memory.
+        """
+        lock = defer.DeferredLock()
+        lock.acquire()
+        ds = [lock.acquire() for i in range(100)]
+        for d in ds[1:]:
+            d.cancel()
+            d.addErrback(lambda reason: None)
+        self.assertEqual(len(lock.waiting), 1)
+        self.assertTrue(len(lock.waiting._queue) <= 2)
+        self.assertEqual(list(lock.waiting), ds[:1])
+        lock.release()
+        self.assertIdentical(self.successResultOf(ds[0]), lock)
+
+
+    def test_cancelGets(self):
+        """
+        A put on a L{defer.DeferredQueue} gets past gets which were
+        cancelled.
+        """
+        queue = defer.DeferredQueue()
+        ds = [queue.get() for i in range(5)]
+        for d in ds[:4]:
+            d.cancel()
+            self.failureResultOf(d, defer.CancelledError)
+        queue.put('x')
+        self.assertEqual(self.successResultOf(ds[4]), 'x')
+        self.assertEqual(len(queue.waiting), 0)
+
+
+
+class StressTests(TestCase):
+    """
+    Tests for the measurements of C{stress.py}.
+    """
+
+    def test_exponent(self):
+        """
+        L{stress.exponent} finds the power law followed by some points.
+        """
+        self.assertAlmostEqual(
+            stress.exponent([(n, 3.0 * n) for n in (10, 100, 1000)]), 1.0)
+        self.assertAlmostEqual(
+            stress.exponent([(n, n ** 2) for n in (10, 100, 1000)]), 2.0)
+        self.assertEqual(stress.exponent([(10, 0.0), (100, 1.0)]), 0.0)
+
+
+    def test_workloads(self):
+        """
+        The cancellation workloads leave no waiters behind.
+        """
+        for workload in (stress.cancelWaiters, stress.cancelWaitersReversed,
+                         stress.cancelWaitersRandomly):
+            lock, ds = workload(100)
+            self.assertEqual(len(lock.waiting), 0)
+        queue, ds = stress.cancelGets(100)
+        self.assertEqual(len(queue.waiting), 0)
+        self.assertEqual(list(queue.pending), [None])
+
+
+
+class DeferredRWLockTests(TestCase):
+    """
+    Tests for L{defer.DeferredRWLock}.
+    """
+
+    def test_readers(self):
+        """
+        Any number of readers hold the lock at once, and a writer waits for
+        all of them to release it.
+        """
+        lock = defer.DeferredRWLock()
+        readers = [lock.acquireRead() for i in range(3)]
+        for d in readers:
+            self.assertIdentical(self.successResultOf(d), lock)
+        write = lock.acquireWrite()
+        for i in range(3):
+            self.assertNoResult(write)
+            lock.releaseRead()
+        self.assertIdentical(self.successResultOf(write), lock)
+        self.assertTrue(lock.writer)
+
+
+    def test_writer(self):
+        """
+        A writer holds the lock alone; when it releases it, the waiting
+        readers are let in together.
+        """
+        lock = defer.DeferredRWLock()
+        lock.acquireWrite()
+        reads = [lock.acquireRead() for i in range(2)]
+        write = lock.acquireWrite()
+        self.assertNoResult(reads[0])
+        lock.releaseWrite()
+        self.assertEqual(lock.readers, 2)
+        self.assertNoResult(write)
+        lock.releaseRead()
+        lock.releaseRead()
+        self.successResultOf(write)
+
+
+    def test_readerPreference(self):
+        """
+        By default, readers are let in while a writer is waiting.
+        """
+        lock = defer.DeferredRWLock()
+        lock.acquireRead()
+        write = lock.acquireWrite()
+        read = lock.acquireRead()
+        self.successResultOf(read)
+        self.assertNoResult(write)
+
+
+    def test_writerPreference(self):
+        """
+        With C{writerPreference}, readers wait while a writer is waiting,
+        and waiting writers are let in, in order, before waiting readers.
+        """
+        lock = defer.DeferredRWLock(writerPreference=True)
+        order = []
+        lock.acquireRead()
+        lock.acquireWrite().addCallback(lambda lock: order.append('w1'))
+        lock.acquireRead().addCallback(lambda lock: order.append('r1'))
+        lock.acquireWrite().addCallback(lambda lock: order.append('w2'))
+        lock.acquireRead().addCallback(lambda lock: order.append('r2'))
+        self.assertEqual(order, [])
+        lock.releaseRead()
+        self.assertEqual(order, ['w1'])
+        lock.releaseWrite()
+        self.assertEqual(order, ['w1', 'w2'])
+        lock.releaseWrite()
+        self.assertEqual(order, ['w1', 'w2', 'r1', 'r2'])
+        self.assertEqual(lock.readers, 2)
+
+
+    def test_cancelWriter(self):
+        """
+        Cancelling the only waiting writer lets in the readers it was
+        keeping out.
+        """
+        lock = defer.DeferredRWLock(writerPreference=True)
+        lock.acquireRead()
+        write = lock.acquireWrite()
+        read = lock.acquireRead()
+        self.assertNoResult(read)
+        write.cancel()
+        self.failureResultOf(write, defer.CancelledError)
+        self.successResultOf(read)
+        self.assertEqual(lock.readers, 2)
+
+
+    def test_cancelReader(self):
+        """
+        A cancelled reader is not let in, and does not keep a writer out.
+        """
+        lock = defer.DeferredRWLock()
+        lock.acquireWrite()
+        read = lock.acquireRead()
+        write = lock.acquireWrite()
+        read.cancel()
+        self.failureResultOf(read, defer.CancelledError)
+        lock.releaseWrite()
+        self.assertEqual(lock.readers, 0)
+        self.successResultOf(write)
+
+
+    def test_run(self):
+        """
+        L{defer.DeferredRWLock.runRead} and
+        L{defer.DeferredRWLock.runWrite} hold the lock for the call and
+        release it afterwards, even when it fails.
+        """
+        lock = defer.DeferredRWLock()
+        d = lock.runRead(lambda: lock.readers)
+        self.assertEqual(self.successResultOf(d), 1)
+        d = lock.runWrite(lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        d = lock.run(lambda: lock.writer)
+        self.assertEqual(self.successResultOf(d), True)
+        self.assertEqual((lock.readers, lock.writer), (0, False))
+
+
+
+class KeyedDeferredLockTests(TestCase):
+    """
+    Tests for L{defer.KeyedDeferredLock}.
+    """
+
+    def test_cleanup(self):
+        """
+        A key's lock is dropped once its last holder releases it with
+        nobody waiting.
+        """
+        locks = defer.KeyedDeferredLock()
+        first = locks.acquire('a')
+        second = locks.acquire('a')
+        self.successResultOf(first)
+        self.assertNoResult(second)
+        self.assertTrue(locks.locked('a'))
+        locks.release('a')
+        self.successResultOf(second)
+        self.assertEqual(len(locks), 1)
+        locks.release('a')
+        self.assertEqual(len(locks), 0)
+        self.assertFalse(locks.locked('a'))
+        self.assertEqual(locks.stats(), {'activeKeys': 0, 'peakKeys': 1,
+                                         'waiting': 0, 'created': 1})
+
+
+    def test_cancelledWaiter(self):
+        """
+        A key's lock is dropped when released even if its waiters were
+        cancelled.
+        """
+        locks = defer.KeyedDeferredLock()
+        locks.acquire('a')
+        waiter = locks.acquire('a')
+        waiter.cancel()
+        self.failureResultOf(waiter, defer.CancelledError)
+        locks.release('a')
+        self.assertEqual(len(locks), 0)
+
+
+    def test_keysIndependent(self):
+        """
+        Holding one key's lock does not keep others waiting.
+        """
+        locks = defer.KeyedDeferredLock()
+        locks.acquire('a')
+        self.successResultOf(locks.acquire('b'))
+        self.assertEqual(locks.stats()['activeKeys'], 2)
+
+
+    def test_run(self):
+        """
+        L{defer.KeyedDeferredLock.run} holds the key's lock for the call,
+        then releases and drops it, even when the call fails.
+        """
+        locks = defer.KeyedDeferredLock()
+        d = locks.run('a', lambda x: locks.locked('a') and x, 1)
+        self.assertEqual(self.successResultOf(d), 1)
+        d = locks.run('a', lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        self.assertEqual(len(locks), 0)
+        self.assertRaises(TypeError, locks.run, 'a')
+
+
+    def test_stripes(self):
+        """
+        With C{stripes}, keys are hashed onto that many locks at most.
+        """
+        locks = defer.KeyedDeferredLock(stripes=2)
+        ds = [locks.acquire(key) for key in range(4)]
+        self.assertEqual(len(locks), 2)
+        self.assertEqual(len([d for d in ds if d.called]), 2)
+        for key in range(4):
+            locks.release(key)
+        self.assertEqual(len(locks), 0)
+        self.assertEqual(locks.stats()['created'], 2)
+
+
+
+class CollapseTests(TestCase):
+    """
+    Tests for collapsing chains of L{Deferred}s whose callbacks return
+    L{Deferred}s.
+
+    Each chain is also built with an extra pass-through callback on every
+    L{Deferred}, which stops it from being collapsed, and must give the
+    same results.
+    """
+
+    def chain(self, depth, collapse):
+        """
+        Build a chain of C{depth} L{Deferred}s, each of which is fired with
+        the number of the next and returns the next from its callback.
+
+        @return: The list of the L{Deferred}s, and the list of those which
+            were cancelled.
+        """
+        ds = []
+        cancelled = []
+        def returnNext(index):
+            if index == depth:
+                return 'done'
+            d = defer.Deferred(cancelled.append)
+            d.addCallback(returnNext)
+            if not collapse:
+                d.addBoth(lambda result: result)
+            ds.append(d)
+            return d
+        returnNext(0)
+        return ds, cancelled
+
+
+    def fire(self, ds, start, stop):
+        """
+        Fire the L{Deferred}s of a chain from C{start} up to C{stop}, each
+        of which creates the next.
+        """
+        for index in range(start, stop):
+            ds[index].callback(index + 1)
+
+
+    def test_result(self):
+        """
+        A chain much deeper than the recursion limit gives the result of
+        its last L{Deferred} to the first.
+        """
+        depth = sys.getrecursionlimit() * 3
+        ds, cancelled = self.chain(depth, True)
+        self.fire(ds, 0, depth)
+        self.assertEqual(self.successResultOf(ds[0]), 'done')
+
+
+    def test_failure(self):
+        """
+        A failure at the end of the chain reaches the first L{Deferred}.
+        """
+        for collapse in (True, False):
+            ds, cancelled = self.chain(10, collapse)
+            self.fire(ds, 0, 9)
+            ds[9].errback(KeyError())
+            self.failureResultOf(ds[0], KeyError)
+
+
+    def test_cancel(self):
+        """
+        Cancelling the first L{Deferred} of a chain cancels the one it is
+        waiting for at the end.
+        """
+        for collapse in (True, False):
+            ds, cancelled = self.chain(10, collapse)
+            self.fire(ds, 0, 5)
+            ds[0].cancel()
+            self.assertEqual(cancelled, [ds[5]])
+            self.failureResultOf(ds[0], defer.CancelledError)
+
+
+    def test_intermediate(self):
+        """
+        A L{Deferred} in the middle of a collapsed chain, having passed its
+        result on, is left with C{None}, and callbacks added to it later
+        run once the chain has fired.
+        """
+        results = {}
+        for collapse in (True, False):
+            ds, cancelled = self.chain(10, collapse)
+            self.fire(ds, 0, 5)
+            late = []
+            ds[2].addCallback(late.append)
+            self.assertEqual(late, [])
+            self.fire(ds, 5, 10)
+            results[collapse] = (late, self.successResultOf(ds[0]),
+                                 self.successResultOf(ds[2]))
+        self.assertEqual(results[True], results[False])
+        self.assertEqual(results[True], ([None], 'done', None))
+
+
+
+class CooperativeRunnerTests(TestCase):
+    """
+    Tests for L{defer.CooperativeRunner}.
+    """
+
+    def setUp(self):
+        self.clock = defer.VirtualClock()
+        # Time the slices in milliseconds, which add up exactly.
+        self.now = [0]
+        self.runner = defer.CooperativeRunner(
+            timeSlice=5, scheduler=self.clock, timer=lambda: self.now[0])
+        defer.setCooperative(self.runner)
+        self.addCleanup(defer.setCooperative, None)
+
+
+    def work(self, result, log, tag):
+        """
+        A callback which takes a millisecond of the runner's time.
+        """
+        self.now[0] += 1
+        log.append(tag)
+        return result
+
+
+    def test_immediate(self):
+        """
+        A L{Deferred} fired when nothing is queued runs its callbacks before
+        firing it returns.
+        """
+        log = []
+        d = defer.Deferred()
+        d.addCallback(self.work, log, 'a')
+        d.callback(None)
+        self.assertEqual(log, ['a'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_slices(self):
+        """
+        Callbacks which run for longer than a slice are carried on in later
+        slices, scheduled with the clock.
+        """
+        log = []
+        d = defer.Deferred()
+        for i in range(12):
+            d.addCallback(self.work, log, i)
+        d.callback(None)
+        self.assertEqual(log, range(5))
+        self.assertEqual(len(self.runner), 1)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(0)
+        self.assertEqual(log, range(12))
+        self.assertEqual([(duration, left) for start, duration, ran, left
+                          in self.runner.history],
+                         [(5, 1), (5, 1), (2, 0)])
+        stats = self.runner.stats()
+        self.assertEqual((stats['slices'], stats['yields'], stats['queued']),
+                         (3, 2, 0))
+        self.assertEqual(stats['maxSlice'], 5)
+
+
+    def test_breadthFirst(self):
+        """
+        L{Deferred}s fired by callbacks join the end of the queue instead of
+        running inside the callback which fired them.
+        """
+        log = []
+        inner = defer.Deferred()
+        inner.addCallback(self.work, log, 'inner')
+        outer = defer.Deferred()
+        outer.addCallback(lambda result: inner.callback(None))
+        outer.addCallback(self.work, log, 'outer')
+        outer.callback(None)
+        self.assertEqual(log, ['outer', 'inner'])
+
+
+    def test_flush(self):
+        """
+        L{defer.CooperativeRunner.flush} runs everything queued at once.
+        """
+        log = []
+        d = defer.Deferred()
+        for i in range(12):
+            d.addCallback(self.work, log, i)
+        d.callback(None)
+        self.runner.flush()
+        self.assertEqual(log, range(12))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.runner), 0)
+
+
+    def test_uninstall(self):
+        """
+        With no runner installed, callbacks run straight away again.
+        """
+        defer.setCooperative(None)
+        self.assertIdentical(defer.getCooperative(), None)
+        log = []
+        d = defer.Deferred()
+        for i in range(12):
+            d.addCallback(self.work, log, i)
+        d.callback(None)
+        self.assertEqual(log, range(12))